@@ -44,7 +44,7 @@ from qtum_electrum.plugins import run_hook
 from qtum_electrum.i18n import _
 from qtum_electrum.util import (bh2u, bfh, format_time, format_satoshis, format_fee_satoshis,PrintError, format_satoshis_plain,
                                 NotEnoughFunds, UserCancelled, profiler, export_meta, import_meta, open_browser,
-                                InvalidPassword,Print)
+                                InvalidPassword)
 from qtum_electrum import Transaction
 from qtum_electrum import util, bitcoin, commands, coinchooser
 from qtum_electrum import paymentrequest
@@ -1385,16 +1385,7 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         freeze_fee = self.fee_e.isVisible() and self.fee_e.isModified() and (self.fee_e.text() or self.fee_e.hasFocus())
         fee = self.fee_e.get_amount() if freeze_fee else None
         coins = self.get_coins()
-        ########debug_info##########
-        with open('./read_send_tab.txt', 'a') as f:
-            try:
-                f.write('file:main_window.py,func_name:read_send_tab,label:' + str(label))
-                f.write('file:main_window.py,func_name:read_send_tab,outputs:' + str(outputs))
-                f.write('file:main_window.py,func_name:read_send_tab,fee:' + str(fee))
-                f.write('file:main_window.py,func_name:read_send_tab,coins:' + str(coins))
-            except:
-                pass
-
+        util.trace('read_send_tab', label=label, outputs=outputs, fee=fee, coins=coins)
         return outputs, fee, label, coins
 
     def do_preview(self):
@@ -1414,8 +1405,6 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         for i,output in enumerate(outputs):
             tp, addr, _amount = output
             if tp == TYPE_SCRIPT:
-                prefix_addr = util.Print('prefix_addr')
-                prefix_addr.add_var(pre_addr = addr)
                 addr = addr[4:]
                 outputs[i] = (tp, addr, _amount)
             elif tp == TYPE_ADDRESS:
@@ -1530,27 +1519,11 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
             callback(False)
 
         if self.tx_external_keypairs:#don't know
-            """-----debug information-----"""
-
-            with open('./debug_info_var.txt','a') as f:
-                try:
-                    f.write('tx_external_keypairs:'+str(self.tx_external_keypairs)+'\n')
-                    f.write('Transaction.sign_info:' + str(Transaction.__class__.__name__) + '\n')
-                except:
-                    f.write('tx_external_keypairs: can not get' + 'self.tx_external_keypairs' + '\n')
-                    f.write('Transaction.sign_info:not found' + 'Transaction.__class__.__name__' + '\n')
             # can sign directly
             task = partial(Transaction.sign, tx, self.tx_external_keypairs)#
         else:
             # call hook to see if plugin needs gui interaction
-            """-----debug information-----"""
-
-            with open('./debug_info_step.txt', 'a') as f:
-                try:
-                    f.write('file_name:qt/main_window.py,function_name:sign_tx_with_password:' + '\n' + 'step 1:wallet_info:' + str(self.wallet.__class__.__name__) + '\n')
-                except:
-                    f.write('file_name:qt/main_window.py,function_name:sign_tx_with_password:' + 'step1 False:wallet_info:can not get ' + 'self.wallet.__class__.__name__'+ '\n')
-
+            util.trace('sign_tx_with_password', wallet=self.wallet.__class__.__name__)
             run_hook('sign_tx', self, tx)  #don't know
             task = partial(self.wallet.sign_transaction, tx, password)
 
@@ -1872,7 +1845,7 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
                                  'window': self})
         console.updateNamespace({'util': util, 'bitcoin': bitcoin})
 
-        c = commands.Commands(self.config, self.wallet, self.network, lambda: self.console.set_json(True))
+        c = commands.Commands(self.config, self.wallet, self.network, lambda: self.console.set_json(True), fx=self.fx)
         methods = {}
 
         def mkfunc(f, method):
@@ -3236,15 +3209,6 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
             traceback.print_exc(file=sys.stderr)
             dialog.show_message(str(e))
 
-        with open('./Token_script.txt','a') as f:
-            try:
-                f.write('file:main_window.py,funcname:do_token_pay:'+'\n''\n')
-                f.write('output:'+str(outputs)+ '\n''\n')
-                f.write('tx_desc:'+str(tx_desc)+'\n')
-                f.write('token.bind_addr:' + str(token.bind_addr) + '\n')
-            except:
-                pass
-
     def _smart_contract_broadcast(self, outputs, desc, gas_fee, sender, dialog):
         coins = self.get_coins()#相当于主链币交易中的inputs
         #print("coins",coins)
@@ -21,8 +21,11 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import shutil
 import threading
+import time
 import sqlite3
+from collections import OrderedDict
 from . import util
 from . import qtum
 from . import constants
@@ -30,6 +33,226 @@ from .qtum import *
 
 
 blockchains = {}
+# the chains of blockchains and their parent_id change together: forks are
+# added and chains swapped by the network thread and the chunk thread
+blockchains_lock = threading.RLock()
+
+HEADER_CACHE_SIZE = 20000
+SQLITE_PAGE_SIZE = 4096
+SQLITE_CACHE_KB = 16 * 1024
+
+
+class HeaderCache(object):
+    """
+    Bounded LRU cache of deserialized headers, keyed by (checkpoint, height).
+    Cached headers are shared between callers and must not be modified.
+    """
+
+    def __init__(self, max_size=HEADER_CACHE_SIZE):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.headers = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, checkpoint, height):
+        key = (checkpoint, height)
+        with self.lock:
+            header = self.headers.get(key)
+            if header is None:
+                self.misses += 1
+                return None
+            self.headers.move_to_end(key)
+            self.hits += 1
+            return header
+
+    def put(self, checkpoint, height, header):
+        with self.lock:
+            self.headers[(checkpoint, height)] = header
+            self.headers.move_to_end((checkpoint, height))
+            while len(self.headers) > self.max_size:
+                self.headers.popitem(last=False)
+
+    def invalidate(self, checkpoint, height=None):
+        """drop one cached height of a chain, or the whole chain if height is None"""
+        with self.lock:
+            if height is not None:
+                self.headers.pop((checkpoint, height), None)
+                return
+            for key in [k for k in self.headers if k[0] == checkpoint]:
+                del self.headers[key]
+
+    def clear(self):
+        with self.lock:
+            self.headers.clear()
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'size': len(self.headers),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+header_cache = HeaderCache()
+
+
+class HeaderDB(util.PrintError):
+    """
+    Headers of all chains live in one sqlite db, in a table keyed by
+    (branch, height) where branch is the checkpoint of the chain owning
+    the row, 0 for the main chain. The branch table keeps the parent of
+    every fork, so a reorg only moves the rows of the fork between two
+    branches instead of copying headers between files.
+
+    There is one persistent connection per db, guarded by lock. Writes
+    are committed by flush(), once per network poll cycle; until then
+    they are only visible through this connection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.lock = threading.Lock()
+        self.uncommitted = False
+        with self.lock:
+            self.init_db()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        # in WAL mode, synchronous=NORMAL only risks losing the last commits
+        # on power failure, never corrupting the db. headers can be refetched.
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA cache_size=-%d' % SQLITE_CACHE_KB)
+        return conn
+
+    def init_db(self):
+        # callers hold lock
+        self.conn = self._connect()
+        cursor = self.conn.cursor()
+        try:
+            # page_size only applies to a new db, so set it before WAL
+            cursor.execute('PRAGMA page_size=%d' % SQLITE_PAGE_SIZE)
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('CREATE TABLE IF NOT EXISTS branch '
+                           '(checkpoint INT PRIMARY KEY NOT NULL, parent INT)')
+            cursor.execute('CREATE TABLE IF NOT EXISTS branch_header '
+                           '(branch INT NOT NULL, height INT NOT NULL, data BLOB NOT NULL, '
+                           'PRIMARY KEY (branch, height))')
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='header'")
+            if cursor.fetchone():
+                # main chain db of older versions, with a single header table
+                self.print_error('migrating headers to branch_header')
+                cursor.execute('INSERT OR REPLACE INTO branch_header (branch, height, data) '
+                               'SELECT 0, height, data FROM header')
+                cursor.execute('DROP TABLE header')
+            cursor.execute('INSERT OR IGNORE INTO branch (checkpoint, parent) VALUES (0, NULL)')
+            self.conn.commit()
+        except (sqlite3.DatabaseError, ) as e:
+            print_error('error when init_db', e, 'will delete the db file and recreate')
+            self.conn.close()
+            os.remove(self.path)
+            self.conn = None
+            self.init_db()
+        finally:
+            cursor.close()
+
+    def get_conn(self):
+        # callers hold lock
+        if self.conn is None:
+            self.init_db()
+        return self.conn
+
+    def execute(self, sql, params=()):
+        # callers hold lock
+        cursor = self.get_conn().cursor()
+        try:
+            cursor.execute(sql, params)
+            self.uncommitted = True
+            return cursor.rowcount
+        finally:
+            cursor.close()
+
+    def query(self, sql, params=()):
+        # callers hold lock
+        cursor = self.get_conn().cursor()
+        try:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def commit(self):
+        # callers hold lock
+        self.get_conn().commit()
+        self.uncommitted = False
+
+    def flush(self):
+        """ commit the headers written since the last flush """
+        with self.lock:
+            if self.uncommitted:
+                self.commit()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+
+    def get_branches(self):
+        """ (checkpoint, parent) of every fork, parents first """
+        with self.lock:
+            return self.query('SELECT checkpoint, parent FROM branch '
+                              'WHERE parent IS NOT NULL ORDER BY parent, checkpoint')
+
+    def swap(self, checkpoint, parent_id, reparented=()):
+        """
+        Exchange the rows of branch checkpoint with the rows of its parent
+        from checkpoint on, and move the forks in reparented, a list of
+        (checkpoint, parent) tuples, in a single transaction. Callers hold
+        lock.
+        """
+        conn = self.get_conn()
+        if self.uncommitted:
+            conn.commit()
+        try:
+            # -1 is never a checkpoint, use it to park the rows of the parent
+            self.execute('UPDATE branch_header SET branch=-1 WHERE branch=? AND height>=?',
+                         (parent_id, checkpoint))
+            self.execute('UPDATE branch_header SET branch=? WHERE branch=?', (parent_id, checkpoint))
+            self.execute('UPDATE branch_header SET branch=? WHERE branch=-1', (checkpoint,))
+            for fork_checkpoint, fork_parent_id in reparented:
+                self.execute('UPDATE branch SET parent=? WHERE checkpoint=?', (fork_parent_id, fork_checkpoint))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self.uncommitted = False
+
+
+header_dbs = {}
+header_dbs_lock = threading.Lock()
+
+
+def get_header_db(config):
+    path = os.path.join(util.get_headers_dir(config), 'blockchain_headers')
+    with header_dbs_lock:
+        if path not in header_dbs:
+            header_dbs[path] = HeaderDB(path)
+        return header_dbs[path]
+
+
+def close_header_dbs():
+    """ Commit and close the header dbs shared by the chains, once on
+    shutdown. A db used again afterwards is reopened. """
+    with header_dbs_lock:
+        dbs = list(header_dbs.values())
+    for db in dbs:
+        db.close()
 
 
 def read_blockchains(config):
@@ -37,15 +260,13 @@ def read_blockchains(config):
     main_chain = Blockchain(config, 0, None)
     blockchains[0] = main_chain
 
+    # forks used to be stored in files of their own, they are refetched
     fdir = os.path.join(util.get_headers_dir(config), 'forks')
-    util.make_dir(fdir)
-    l = filter(lambda x: x.startswith('fork_'), os.listdir(fdir))
-    l = sorted(l, key = lambda x: int(x.split('_')[1]))
+    if os.path.isdir(fdir):
+        shutil.rmtree(fdir, ignore_errors=True)
     bad_chains = []
     main_chain_height = main_chain.height()
-    for filename in l:
-        checkpoint = int(filename.split('_')[2])
-        parent_id = int(filename.split('_')[1])
+    for checkpoint, parent_id in main_chain.db.get_branches():
         b = Blockchain(config, checkpoint, parent_id)
         if not b.is_valid():
             bad_chains.append(b.checkpoint)
@@ -64,7 +285,7 @@ def read_blockchains(config):
 
 def remove_chain(cp, chains):
     try:
-        os.remove(chains[cp].path())
+        chains[cp].remove()
         del chains[cp]
         print_error('chain removed', cp)
     except (BaseException,) as e:
@@ -75,7 +296,7 @@ def remove_chain(cp, chains):
 
 
 def check_header(header):
-    if type(header) is not dict:
+    if not isinstance(header, (dict, Header)):
         print_error('[check_header] header not dic')
         return False
     for b in blockchains.values():
@@ -103,39 +324,36 @@ class Blockchain(util.PrintError):
         self.checkpoints = constants.net.CHECKPOINTS
         self.parent_id = parent_id
         self.lock = threading.Lock()
-        self.swaping = threading.Event()
-        self.conn = None
-        self.init_db()
+        self.db = get_header_db(config)
+        if parent_id is not None:
+            with self.db.lock:
+                self.db.execute('INSERT OR REPLACE INTO branch (checkpoint, parent) VALUES (?,?)',
+                                (checkpoint, parent_id))
         with self.lock:
             self.update_size()
 
-    def init_db(self):
-        self.conn = sqlite3.connect(self.path(), check_same_thread=False)
-        cursor = self.conn.cursor()
-        try:
-            cursor.execute('CREATE TABLE IF NOT EXISTS header '
-                           '(height INT PRIMARY KEY NOT NULL, data BLOB NOT NULL)')
-            self.conn.commit()
-        except (sqlite3.DatabaseError, ) as e:
-            print_error('error when init_db', e, 'will delete the db file and recreate')
-            os.remove(self.path())
-            self.conn = None
-            self.init_db()
-        finally:
-            cursor.close()
+    def flush(self):
+        """ commit the headers written since the last flush """
+        self.db.flush()
+
+    def remove(self):
+        """ delete the headers and the branch record of this chain """
+        with self.lock:
+            with self.db.lock:
+                self.db.execute('DELETE FROM branch_header WHERE branch=?', (self.checkpoint,))
+                self.db.execute('DELETE FROM branch WHERE checkpoint=?', (self.checkpoint,))
+                self.db.commit()
+                header_cache.invalidate(self.checkpoint)
+            self._size = 0
 
     def is_valid(self):
         with self.lock:
-            conn = sqlite3.connect(self.path(), check_same_thread=False)
-            cursor = conn.cursor()
-            cursor.execute('SELECT min(height), max(height) FROM header')
-            min_height, max_height = cursor.fetchone()
+            with self.db.lock:
+                min_height, max_height, size = self.db.query(
+                    'SELECT MIN(height), MAX(height), COUNT(*) FROM branch_header WHERE branch=?',
+                    (self.checkpoint,))[0]
             max_height = max_height or 0
             min_height = min_height or 0
-            cursor.execute('SELECT COUNT(*) FROM header')
-            size = int(cursor.fetchone()[0])
-            cursor.close()
-            conn.close()
             if not min_height == self.checkpoint:
                 return False
             if size > 0 and not size == max_height - min_height + 1:
@@ -143,10 +361,7 @@ class Blockchain(util.PrintError):
         return True
 
     def path(self):
-        d = util.get_headers_dir(self.config)
-        filename = 'blockchain_headers' if self.parent_id is None \
-            else os.path.join('forks', 'fork_%d_%d'%(self.parent_id, self.checkpoint))
-        return os.path.join(d, filename)
+        return self.db.path
 
     def parent(self):
         return blockchains[self.parent_id]
@@ -183,67 +398,60 @@ class Blockchain(util.PrintError):
             return self._size
 
     def update_size(self):
-        conn = sqlite3.connect(self.path(), check_same_thread=False)
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM header')
-        count = int(cursor.fetchone()[0])
-        self._size = count
-        cursor.close()
+        # resync the in-memory size with the db; writes keep it up to date
+        # incrementally, so this is only needed on startup and after swaps.
+        # (branch, height) is the primary key, so MAX() is an index lookup.
+        with self.db.lock:
+            max_height = self.db.query('SELECT MAX(height) FROM branch_header WHERE branch=? AND height>=?',
+                                       (self.checkpoint, self.checkpoint))[0][0]
+        self._size = 0 if max_height is None else max_height - self.checkpoint + 1
 
     def swap_with_parent(self):
+        with blockchains_lock:
+            self._swap_with_parent()
+
+    def _swap_with_parent(self):
         if self.parent_id is None:
             return
-        parent_id = self.parent_id
-        checkpoint = self.checkpoint
         parent = self.parent()
-        self.update_size()
-        parent.update_size()
-        parent_branch_size = parent._height() - self.checkpoint + 1
-        if parent_branch_size >= self._size:
-            return
-        if self.swaping.is_set() or parent.swaping.is_set():
-            return
-        self.swaping.set()
-        parent.swaping.set()
-        global blockchains
-        try:
+        # writes to either chain wait for the swap instead of being dropped.
+        # chain locks are always taken child first, then the db lock.
+        with self.lock, parent.lock:
+            parent_branch_size = parent._height() - self.checkpoint + 1
+            if parent_branch_size >= self._size:
+                return
             print_error('swap', self.checkpoint, self.parent_id)
-            for i in range(checkpoint, checkpoint + self._size):
-                print_error('swaping', i)
-                header = self.read_header(i, deserialize=False)
-                parent_header = parent.read_header(i, deserialize=False)
-                parent._write(header, i)
-                if parent_header:
-                    self._write(parent_header, i)
-                else:
-                    self._delete(i)
-        except (BaseException,) as e:
-            self.print_error('swap error', e)
-        # update size
-        self.update_size()
-        parent.update_size()
-        self.swaping.clear()
-        parent.swaping.clear()
+            # forks of the rows that move follow them to the other chain
+            reparented = {}
+            for b in blockchains.values():
+                if b.parent_id == parent.checkpoint and b.checkpoint > self.checkpoint:
+                    reparented[b] = self.checkpoint
+                elif b.parent_id == self.checkpoint:
+                    reparented[b] = parent.checkpoint
+            with self.db.lock:
+                self.db.swap(self.checkpoint, parent.checkpoint,
+                             [(b.checkpoint, parent_id) for b, parent_id in reparented.items()])
+                for b, parent_id in reparented.items():
+                    b.parent_id = parent_id
+                header_cache.invalidate(self.checkpoint)
+                header_cache.invalidate(parent.checkpoint)
+            self.update_size()
+            parent.update_size()
         print_error('swap finished')
-        parent.swap_with_parent()
+        parent._swap_with_parent()
 
     def _write(self, raw_header, height):
-        self.print_error('{} try to write {}'.format(self.checkpoint, height))
+        self.print_error(self.checkpoint, 'try to write', height)
         if height > self._size + self.checkpoint:
             return
-        try:
-            conn = self.conn
-            cursor = self.conn.cursor()
-        except (sqlite3.ProgrammingError, AttributeError):
-            conn = sqlite3.connect(self.path(), check_same_thread=False)
-            cursor = conn.cursor()
-        cursor.execute('REPLACE INTO header (height, data) VALUES(?,?)', (height, raw_header))
-        cursor.close()
-        conn.commit()
+        with self.db.lock:
+            self.db.execute('REPLACE INTO branch_header (branch, height, data) VALUES(?,?,?)',
+                            (self.checkpoint, height, raw_header))
+            header_cache.invalidate(self.checkpoint, height)
+        if height == self.checkpoint + self._size:
+            self._size += 1
 
     def write(self, raw_header, height):
-        if self.swaping.is_set():
-            return
         if self.checkpoint > 0 and height < self.checkpoint:
             return
         if not raw_header:
@@ -253,45 +461,30 @@ class Blockchain(util.PrintError):
                 self.delete_all()
             return
         with self.lock:
-            self.update_size()
             self._write(raw_header, height)
-            self.update_size()
 
     def _delete(self, height):
-        self.print_error('{} try to delete {}'.format(self.checkpoint, height))
-        try:
-            conn = self.conn
-            cursor = conn.cursor()
-        except (sqlite3.ProgrammingError, AttributeError):
-            conn = sqlite3.connect(self.path(), check_same_thread=False)
-            cursor = conn.cursor()
-        cursor.execute('DELETE FROM header where height=?', (height,))
-        cursor.close()
-        conn.commit()
+        self.print_error(self.checkpoint, 'try to delete', height)
+        with self.db.lock:
+            deleted = self.db.execute('DELETE FROM branch_header WHERE branch=? AND height=?',
+                                      (self.checkpoint, height))
+            header_cache.invalidate(self.checkpoint, height)
+        if deleted and height == self.checkpoint + self._size - 1:
+            self._size -= 1
 
     def delete(self, height):
-        if self.swaping.is_set():
-            return
-        self.print_error('{} try to delete {}'.format(self.checkpoint, height))
+        self.print_error(self.checkpoint, 'try to delete', height)
         if self.checkpoint > 0 and height < self.checkpoint:
             return
         with self.lock:
             self._delete(height)
-            self.update_size()
 
     def delete_all(self):
-        if self.swaping.is_set():
-            return
         with self.lock:
-            try:
-                conn = self.conn
-                cursor = self.conn.cursor()
-            except (sqlite3.ProgrammingError, AttributeError):
-                conn = sqlite3.connect(self.path(), check_same_thread=False)
-                cursor = conn.cursor()
-            cursor.execute('DELETE FROM header')
-            cursor.close()
-            conn.commit()
+            with self.db.lock:
+                self.db.execute('DELETE FROM branch_header WHERE branch=?', (self.checkpoint,))
+                self.db.commit()
+                header_cache.invalidate(self.checkpoint)
             self._size = 0
 
     def save_header(self, header):
@@ -306,22 +499,26 @@ class Blockchain(util.PrintError):
         if height > self._height():
             return
         if height < self.checkpoint:
-            return self.parent().read_header(height)
-
-        conn = sqlite3.connect(self.path(), check_same_thread=False)
-        cursor = conn.cursor()
-        cursor.execute('SELECT data FROM header WHERE height=?', (height,))
-        result = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        if not result or len(result) < 1:
-            print_error('read_header 4', height, self.checkpoint, self.parent_id, result, self._height())
-            self.update_size()
-            return
-        header = result[0]
+            return self.parent().read_header(height, deserialize)
+
         if deserialize:
-            return deserialize_header(header, height)
-        return header
+            header = header_cache.get(self.checkpoint, height)
+            if header is not None:
+                return header
+        with self.db.lock:
+            result = self.db.query('SELECT data FROM branch_header WHERE branch=? AND height=?',
+                                   (self.checkpoint, height))
+            if result:
+                header = result[0][0]
+                if deserialize:
+                    header = deserialize_header(header, height)
+                    header_cache.put(self.checkpoint, height, header)
+                return header
+        print_error('read_header 4', height, self.checkpoint, self.parent_id, result, self._height())
+        self.update_size()
+
+    def get_cache_stats(self):
+        return header_cache.get_stats()
 
     def verify_header(self, header, prev_header, bits, target):
         prev_hash = hash_header(prev_header)
@@ -350,21 +547,41 @@ class Blockchain(util.PrintError):
         return header_hash == real_hash
 
     def save_chunk(self, index, raw_headers):
-        print_error('{} try to save chunk {}'.format(self.checkpoint, index * CHUNK_SIZE))
-        if self.swaping.is_set():
-            return
+        self.import_chunks([(index, raw_headers)])
+
+    def import_chunks(self, chunks):
+        """
+        Bulk import path for connect_chunk. chunks is an iterable of
+        (index, raw_headers) tuples; all of them are streamed into the
+        db and committed in a single transaction.
+        """
+        heights = []
+
+        def rows():
+            for index, raw_headers in chunks:
+                print_error(self.checkpoint, 'try to save chunk', index * CHUNK_SIZE)
+                for i, raw_header in enumerate(raw_headers):
+                    heights.append(index * CHUNK_SIZE + i)
+                    yield self.checkpoint, heights[-1], raw_header
+
         with self.lock:
-            try:
-                conn = self.conn
-                cursor = self.conn.cursor()
-            except (sqlite3.ProgrammingError, AttributeError):
-                conn = sqlite3.connect(self.path(), check_same_thread=False)
+            with self.db.lock:
+                conn = self.db.get_conn()
+                if self.db.uncommitted:
+                    conn.commit()
                 cursor = conn.cursor()
-            headers = list([(index * CHUNK_SIZE + i, v) for i, v in enumerate(raw_headers)])
-            cursor.executemany('REPLACE INTO header (height, data) VALUES(?,?)', headers)
-            cursor.close()
-            conn.commit()
-            self.update_size()
+                try:
+                    cursor.executemany('REPLACE INTO branch_header (branch, height, data) VALUES(?,?,?)', rows())
+                    conn.commit()
+                except BaseException:
+                    conn.rollback()
+                    raise
+                finally:
+                    self.db.uncommitted = False
+                    cursor.close()
+                header_cache.invalidate(self.checkpoint)
+            if heights:
+                self._size = max(self._size, max(heights) - self.checkpoint + 1)
         self.swap_with_parent()
 
     def read_chunk(self, data):
@@ -378,18 +595,39 @@ class Blockchain(util.PrintError):
         return raw_headers
 
     def verify_chunk(self, index, raw_headers):
+        """
+        Verify a chunk in a single pass. Every header is hashed once, from
+        its raw bytes, and that hash is reused for the prev hash check of
+        the next header. Headers at checkpoint heights must match them.
+        """
+        t0 = time.time()
         prev_header = None
         pprev_header = None
         if index != 0:
             prev_header = self.read_header(index * CHUNK_SIZE - 1)
             pprev_header = self.read_header(index * CHUNK_SIZE - 2)
+        prev_hash = hash_decode(hash_header(prev_header))
         for i, raw_header in enumerate(raw_headers):
             height = index * CHUNK_SIZE + i
-            header = deserialize_header(raw_header, height)
-            bits, target = self.get_target(height, prev_header=prev_header, pprev_header=pprev_header)
-            self.verify_header(header, prev_header, bits, target)
+            header = Header(raw_header, height)
+            if header.prev_hash_bytes() != prev_hash:
+                raise Exception("prev hash mismatch at %d: %s vs %s" %
+                                (height, hash_encode(prev_hash), header['prev_block_hash']))
+            _hash = header.hash_bytes()
+            checkpoint = self.checkpoints.get(str(height))
+            if checkpoint is not None and hash_encode(_hash) != checkpoint:
+                raise Exception("checkpoint mismatch at %d: %s vs %s" % (height, hash_encode(_hash), checkpoint))
+            if not constants.net.TESTNET:
+                bits, target = self.get_target(height, prev_header=prev_header, pprev_header=pprev_header)
+                if bits != header['bits']:
+                    raise Exception("bits mismatch at %d: %s vs %s" % (height, hex(bits), hex(header['bits'])))
+                if not is_pos(header) and int.from_bytes(_hash, 'little') > target:
+                    raise Exception("insufficient proof of work at %d: %s vs target %s" %
+                                    (height, hash_encode(_hash), target))
             pprev_header = prev_header
             prev_header = header
+            prev_hash = _hash
+        self.print_error('verified chunk %d (%d headers) in %.3fs' % (index, len(raw_headers), time.time() - t0))
 
     def get_hash(self, height):
         if height == -1:
@@ -23,11 +23,12 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 from collections import defaultdict, namedtuple
+from itertools import accumulate
 from math import floor, log10
 
 from .bitcoin import sha256, COIN, TYPE_ADDRESS
 from .transaction import Transaction
-from .util import NotEnoughFunds, PrintError, profiler
+from .util import NotEnoughFunds, PrintError, profiler, trace
 
 
 # A simple deterministic PRNG.  Used to deterministically shuffle a
@@ -125,8 +126,6 @@ class CoinChooserBase(PrintError):
             size = Transaction.virtual_size_from_weight(weight)#
             value = sum(coin['value'] for coin in coins)#这里面的coins在我理解看来,其实只有一个coin,单元素
             return Bucket(desc, size, value, coins)
-        print("buckets.keys()",buckets.keys())
-        print("buckets.values()",buckets.values())
 
         return list(map(make_Bucket, buckets.keys(), buckets.values()))
 
@@ -219,30 +218,24 @@ class CoinChooserBase(PrintError):
         # Copy the ouputs so when adding change we don't modify "outputs"
         #创建了一个没有输入和找零的tx
         tx = Transaction.from_io([], outputs[:])
-        with open('./debug_info_var.txt','a') as f:
-            try:
-                f.write('outputs'+str(outputs[:])+'\n')
-                f.write('utxos:'+ str(utxos)+'\n')
-                f.write('self.p:'+ str(self.p)+'\n')
-                f.write('file:coinchooser.py,var:from_io_tx:'+str(tx)+'\n')
-                f.write('file:coinchooser.py,func:from_io,var:tx.output():'+str(tx.outputs())+'\n')
-                #f.write('file:coinchooser.py,var:from_io,var:tx.intput():' + str(tx.intput()) + '\n')
-            except:
-                #print('##############wrong!!!!!!!!!!')
-                #print('##############wrong!!!!!!!!!!')
-                print('##############wrong!!!!!!!!!!')
+        trace('coinchooser.make_tx', outputs=outputs, utxos=utxos)
         # Size of the transaction with no inputs and no change
         base_size = tx.estimated_size()
         spent_amount = tx.output_value()#script时候为0
+        # used by is_sufficient, and by choosers that keep running sums
+        self.base_size = base_size
+        self.spent_amount = spent_amount
+        self.fee_estimator = fee_estimator
+        self.dust_threshold = dust_threshold
 
         def sufficient_funds(buckets):
             '''Given a list of buckets, return True if it has enough
             value to pay for the transaction'''
             total_input = sum(bucket.value for bucket in buckets)#所有的输入
-            # buckets所有的大小 + 基础大小
-            total_size = sum(bucket.size for bucket in buckets) + base_size
+            # buckets所有的大小
+            total_size = sum(bucket.size for bucket in buckets)
             #判断UTXO够不够用
-            return total_input >= spent_amount + fee_estimator(total_size)
+            return self.is_sufficient(total_input, total_size)
 
         # Collect the coins into buckets, choose a subset of the buckets
         buckets = self.bucketize_coins(coins)## ?
@@ -269,6 +262,11 @@ class CoinChooserBase(PrintError):
 
         return tx
 
+    def is_sufficient(self, total_input, total_size):
+        '''Whether inputs of this total value and size pay for the
+        transaction of the current make_tx'''
+        return total_input >= self.spent_amount + self.fee_estimator(total_size + self.base_size)
+
     def choose_buckets(self, buckets, sufficient_funds, penalty_func, sender=None):
         raise NotImplemented('To be subclassed')#子类中要用
 
@@ -290,11 +288,12 @@ class CoinChooserOldestFirst(CoinChooserBase):
         adj_height = lambda height: 99999999 if height <= 0 else height
         buckets.sort(key = lambda b: max(adj_height(coin['height'])
                                          for coin in b.coins))
-        selected = []
-        for bucket in buckets:
-            selected.append(bucket)
-            if sufficient_funds(selected):
-                return strip_unneeded(selected, sufficient_funds)
+        total_input = total_size = 0
+        for n, bucket in enumerate(buckets):
+            total_input += bucket.value
+            total_size += bucket.size
+            if self.is_sufficient(total_input, total_size):
+                return strip_unneeded(buckets[:n + 1], sufficient_funds)
         else:
             raise NotEnoughFunds()
 
@@ -381,10 +380,8 @@ class CoinChooserQtum(CoinChooserBase):
         # Unconfirmed coins are young, not old
         adj_height = lambda height: 99999999 if height <= 0 else height#高度小于0
         # 对bucket里面的所有数据排序,?按照区块高度排列
-        print('debug::before_sort',buckets)
         buckets.sort(key=lambda b: max(adj_height(coin['height'])
                                        for coin in b.coins))#排序后,高度越低,排序越靠前
-        print('debug::after_sort',buckets)
         selected = []
         if sender: #当sender != None时,选一个
             for bucket in buckets:
@@ -403,8 +400,113 @@ class CoinChooserQtum(CoinChooserBase):
             raise NotEnoughFunds()
 
 
+def branch_and_bound(values, target, upper, max_tries):
+    '''Depth first search for a subset of values, sorted in descending
+    order, whose sum is in [target, upper]. Returns the indices of the
+    subset with the smallest sum found within max_tries steps, or None.'''
+    # remaining[i] is the sum of values[i:]
+    remaining = list(accumulate(reversed(values)))[::-1] + [0]
+    if remaining[0] < target:
+        return None
+    best, best_value = None, None
+    selection = []  # for each value looked at, whether it is included
+    value = 0
+    for tries in range(max_tries):
+        depth = len(selection)
+        if value > upper or value + remaining[depth] < target:
+            backtrack = True
+        elif value >= target:
+            backtrack = True
+            if best is None or value < best_value:
+                best = [i for i, included in enumerate(selection) if included]
+                best_value = value
+                if value == target:
+                    break
+        else:
+            backtrack = False
+        if backtrack:
+            # exclude the last included value, and try the values after it
+            while selection and not selection[-1]:
+                selection.pop()
+            if not selection:
+                break
+            selection[-1] = False
+            value -= values[len(selection) - 1]
+        elif selection and not selection[-1] and values[depth - 1] == values[depth]:
+            # including this one instead of an equal excluded one would
+            # give the same sums again
+            selection.append(False)
+        else:
+            selection.append(True)
+            value += values[depth]
+    return best
+
+
+class CoinChooserBranchAndBound(CoinChooserBase):
+    '''Avoid change. Look for a set of coins that pays for the
+    outputs and the fee with a remainder too small to be worth a change
+    output. Each coin counts for its value minus the fee of spending
+    it. If there is no such set, spend the largest coins.
+    '''
+
+    max_tries = 100000
+
+    def keys(self, coins):
+        return [coin['prevout_hash'] + ':' + str(coin['prevout_n'])
+                for coin in coins]
+
+    def bucketize_coins(self, coins):
+        # the weight estimate serializes the input; it is the same for
+        # inputs of the same type and keys
+        weights = {}
+        buckets = []
+        for key, coin in zip(self.keys(coins), coins):
+            k = (coin['type'], coin.get('num_sig'), tuple(map(len, coin.get('x_pubkeys', []))),
+                 coin.get('scriptSig') is not None or coin.get('witness') is not None)
+            weight = weights.get(k)
+            if weight is None:
+                weight = weights[k] = Transaction.estimated_input_weight(coin)
+            size = Transaction.virtual_size_from_weight(weight)
+            buckets.append(Bucket(key, size, coin['value'], [coin]))
+        return buckets
+
+    def choose_buckets(self, buckets, sufficient_funds, penalty_func, sender=None):
+        base_fee = self.fee_estimator(self.base_size)
+        fee_per_byte = (self.fee_estimator(self.base_size + 1000) - base_fee) / 1000
+        effective = [(b.value - int(round(fee_per_byte * b.size)), b) for b in buckets]
+        # coins that cost more than they are worth are never spent
+        effective = [(v, b) for v, b in effective if v > 0]
+        effective.sort(key=lambda x: x[0], reverse=True)
+        values = [v for v, b in effective]
+        buckets = [b for v, b in effective]
+        # a change output is only added above this remainder
+        target = self.spent_amount + base_fee
+        upper = target + int(fee_per_byte * 34) + self.dust_threshold
+        indices = branch_and_bound(values, target, upper, self.max_tries)
+        if indices is not None:
+            selected = [buckets[i] for i in indices]
+            # the effective values are rounded
+            if sufficient_funds(selected):
+                self.print_error("changeless selection of", len(selected))
+                return selected
+        # the smallest number of the largest coins
+        total_inputs = list(accumulate(b.value for b in buckets))
+        total_sizes = list(accumulate(b.size for b in buckets))
+        lo, hi = 0, len(buckets)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.is_sufficient(total_inputs[mid], total_sizes[mid]):
+                hi = mid
+            else:
+                lo = mid + 1
+        if lo == len(buckets):
+            raise NotEnoughFunds()
+        return buckets[:lo + 1]
+
+
 COIN_CHOOSERS = {'Priority': CoinChooserOldestFirst,
-                 'Privacy': CoinChooserPrivacy}
+                 'Privacy': CoinChooserPrivacy,
+                 'Changeless': CoinChooserBranchAndBound}
 
 
 def get_name(config):
@@ -31,6 +31,7 @@ import argparse
 import json
 import ast
 import base64
+import csv
 from functools import wraps
 from decimal import Decimal
 
@@ -38,6 +39,7 @@ from .import util, ecc
 from .util import bfh, bh2u, format_satoshis, json_decode, print_error
 from .import bitcoin
 from .bitcoin import is_address,  hash_160, COIN, TYPE_ADDRESS
+from .qtum import hash160_to_p2pkh
 from .transaction import Transaction, multisig_script
 from .import paymentrequest
 from .paymentrequest import PR_PAID, PR_UNPAID, PR_UNKNOWN, PR_EXPIRED
@@ -59,6 +61,8 @@ class Command:
         self.requires_network = 'n' in s
         self.requires_wallet = 'w' in s
         self.requires_password = 'p' in s
+        # does not change the wallet, may run along other such commands
+        self.read_only = 'r' in s
         self.description = func.__doc__
         self.help = self.description.split('.')[0] if self.description else None
         varnames = func.__code__.co_varnames[1:func.__code__.co_argcount]
@@ -94,11 +98,16 @@ def command(s):
 
 class Commands:
 
-    def __init__(self, config, wallet, network, callback = None):
+    def __init__(self, config, wallet, network, callback = None, network_cache = None, fx = None,
+                 notifier = None):
         self.config = config
         self.wallet = wallet
         self.network = network
         self._callback = callback
+        # the daemon cache of the walletless server queries, if any
+        self.network_cache = network_cache
+        self.fx = fx
+        self.notifier = notifier
 
     def _run(self, method, args, password_getter):
         # this wrapper is called from the python console
@@ -181,9 +190,9 @@ class Commands:
         walletless server query, results are not checked by SPV.
         """
         sh = bitcoin.address_to_scripthash(address)
-        return self.network.get_history_for_scripthash(sh)
+        return (self.network_cache or self.network).get_history_for_scripthash(sh)
 
-    @command('w')
+    @command('wr')
     def listunspent(self):
         """List unspent outputs. Returns the list of unspent transaction
         outputs in your wallet."""
@@ -199,7 +208,7 @@ class Commands:
         is a walletless server query, results are not checked by SPV.
         """
         sh = bitcoin.address_to_scripthash(address)
-        return self.network.listunspent_for_scripthash(sh)
+        return (self.network_cache or self.network).listunspent_for_scripthash(sh)
 
     @command('')
     def serialize(self, jsontx):
@@ -232,7 +241,7 @@ class Commands:
         tx.sign(keypairs)
         return tx.as_dict()
 
-    @command('wp')
+    @command('wpr')
     def signtransaction(self, tx, privkey=None, password=None):
         """Sign a transaction. The wallet keys will be used unless a private key is provided."""
         tx = Transaction(tx)
@@ -277,7 +286,7 @@ class Commands:
         """Unfreeze address. Unfreeze the funds at one of your wallet\'s address"""
         return self.wallet.set_frozen_state([address], False)
 
-    @command('wp')
+    @command('wpr')
     def getprivatekeys(self, address, password=None):
         """Get private keys of addresses. You may pass a single wallet address, or a list of wallet addresses."""
         if isinstance(address, str):
@@ -287,7 +296,7 @@ class Commands:
         domain = address
         return [self.wallet.export_private_key(address, password)[0] for address in domain]
 
-    @command('w')
+    @command('wr')
     def ismine(self, address):
         """Check if address is in wallet. Return true if and only address is in wallet"""
         return self.wallet.is_mine(address)
@@ -302,12 +311,12 @@ class Commands:
         """Check that an address is valid. """
         return is_address(address)
 
-    @command('w')
+    @command('wr')
     def getpubkeys(self, address):
         """Return the public keys for a wallet address. """
         return self.wallet.get_public_keys(address)
 
-    @command('w')
+    @command('wr')
     def getbalance(self):
         """Return the balance of your wallet. """
         c, u, x = self.wallet.get_balance()
@@ -324,7 +333,7 @@ class Commands:
         server query, results are not checked by SPV.
         """
         sh = bitcoin.address_to_scripthash(address)
-        out = self.network.get_balance_for_scripthash(sh)
+        out = (self.network_cache or self.network).get_balance_for_scripthash(sh)
         out["confirmed"] =  str(Decimal(out["confirmed"])/COIN)
         out["unconfirmed"] =  str(Decimal(out["unconfirmed"])/COIN)
         return out
@@ -333,7 +342,15 @@ class Commands:
     def getmerkle(self, txid, height):
         """Get Merkle branch of a transaction included in a block. Electrum
         uses this to verify transactions (Simple Payment Verification)."""
-        return self.network.get_merkle_for_transaction(txid, int(height))
+        return (self.network_cache or self.network).get_merkle_for_transaction(txid, int(height))
+
+    @command('n')
+    def getcachestats(self):
+        """Return the number of entries, hits, misses and hit rate of the
+        daemon cache of walletless server queries, per kind of query."""
+        if not self.network_cache:
+            raise Exception('No cache: the command must be sent to a daemon')
+        return self.network_cache.get_stats()
 
     @command('n')
     def getservers(self):
@@ -346,17 +363,17 @@ class Commands:
         from .version import ELECTRUM_VERSION
         return ELECTRUM_VERSION
 
-    @command('w')
+    @command('wr')
     def getmpk(self):
         """Get master public key. Return your wallet\'s master public key"""
         return self.wallet.get_master_public_key()
 
-    @command('wp')
+    @command('wpr')
     def getmasterprivate(self, password=None):
         """Get master private key. Return your wallet\'s master private key"""
         return str(self.wallet.keystore.get_master_private_key(password))
 
-    @command('wp')
+    @command('wpr')
     def getseed(self, password=None):
         """Get seed phrase. Print the generation seed of your wallet."""
         s = self.wallet.get_seed(password)
@@ -394,7 +411,7 @@ class Commands:
         tx = sweep(privkeys, self.network, self.config, destination, tx_fee, imax)
         return tx.as_dict() if tx else None
 
-    @command('wp')
+    @command('wpr')
     def signmessage(self, address, message, password=None):
         """Sign a message with a key. Use quotes if your message contains
         whitespaces"""
@@ -449,12 +466,64 @@ class Commands:
         tx = self._mktx(outputs, tx_fee, change_addr, domain, nocheck, unsigned, rbf, password, locktime)
         return tx.as_dict()
 
-    @command('w')
-    def history(self):
+    @command('wr')
+    def history(self, from_height=None, to_height=None, from_timestamp=None, to_timestamp=None,
+                show_fiat=False):
         """Wallet history. Returns the transaction history of your wallet."""
-        balance = 0
-        out = []
-        for item in self.wallet.get_history():
+        return list(self._history_items(show_fiat, from_height=from_height, to_height=to_height,
+                                        from_timestamp=from_timestamp, to_timestamp=to_timestamp))
+
+    @command('wr')
+    def historypage(self, cursor=None, limit=100, from_height=None, to_height=None,
+                    from_timestamp=None, to_timestamp=None, show_fiat=False):
+        """Page of the wallet history. Returns up to limit transactions, oldest
+        first, and the cursor of the next page, to be passed with --cursor."""
+        after = None
+        if cursor:
+            height, pos, txid = cursor.split(':')
+            after = ((int(height), int(pos)), txid)
+        out = list(self._history_items(show_fiat, from_height=from_height, to_height=to_height,
+                                       from_timestamp=from_timestamp, to_timestamp=to_timestamp,
+                                       limit=limit, after=after))
+        next_cursor = None
+        if out and len(out) == limit:
+            txid = out[-1]['txid']
+            height, pos = self.wallet.get_txpos(txid)
+            next_cursor = '%d:%d:%s' % (height, pos, txid)
+        return {'transactions': out, 'cursor': next_cursor}
+
+    @command('wr')
+    def exporthistory(self, filename, format='csv', from_height=None, to_height=None,
+                      from_timestamp=None, to_timestamp=None, show_fiat=False):
+        """Export the wallet history to a file, as CSV or as JSON lines
+        (format jsonl). Transactions are written one at a time."""
+        if format not in ('csv', 'jsonl'):
+            raise Exception('Unknown format: ' + format)
+        path = os.path.join(self.config.get('cwd') or '', os.path.expanduser(filename))
+        columns = ['txid', 'height', 'confirmations', 'timestamp', 'date', 'label', 'value',
+                   'input_addresses', 'output_addresses']
+        if show_fiat:
+            columns.append('fiat_value')
+        count = 0
+        with open(path, 'w', newline='') as f:
+            if format == 'csv':
+                writer = csv.writer(f, lineterminator='\n')
+                writer.writerow(columns)
+            for item in self._history_items(show_fiat, from_height=from_height, to_height=to_height,
+                                            from_timestamp=from_timestamp, to_timestamp=to_timestamp):
+                if format == 'csv':
+                    item['input_addresses'] = ' '.join(item['input_addresses'])
+                    item['output_addresses'] = ' '.join(item['output_addresses'])
+                    writer.writerow([item[k] for k in columns])
+                else:
+                    f.write(json.dumps(item) + '\n')
+                count += 1
+        return {'path': path, 'transactions': count}
+
+    def _history_items(self, show_fiat, **kwargs):
+        """ Items of history, made one at a time from iter_history """
+        fiat_value = self._fiat_value_function() if show_fiat else None
+        for item in self.wallet.iter_history(**kwargs):
             tx_hash, height, conf, timestamp, value, balance = item
             if timestamp:
                 date = datetime.datetime.fromtimestamp(timestamp).isoformat(' ')[:-3]
@@ -478,7 +547,7 @@ class Commands:
                 input_addresses.append(addr)
             for addr, v in tx.get_outputs():
                 output_addresses.append(addr)
-            out.append({
+            out = {
                 'txid': tx_hash,
                 'timestamp': timestamp,
                 'date': date,
@@ -488,6 +557,52 @@ class Commands:
                 'value': str(Decimal(value) / COIN) if value is not None else None,
                 'height': height,
                 'confirmations': conf
+            }
+            if fiat_value:
+                out['fiat_value'] = fiat_value(value, timestamp)
+            yield out
+
+    def _fiat_value_function(self):
+        """ Function of (satoshis, timestamp) giving the value in the fiat
+        currency on that day, with the rate of each day looked up once """
+        if not self.fx or not self.fx.is_enabled():
+            raise Exception('Exchange rates are disabled')
+        rates = {}
+
+        def fiat_value(satoshis, timestamp):
+            d_t = datetime.datetime.fromtimestamp(timestamp or time.time())
+            day = d_t.date()
+            if day not in rates:
+                rates[day] = self.fx.history_rate(d_t)
+            rate = rates[day]
+            if satoshis is None or rate is None:
+                return None
+            return self.fx.ccy_amount_str(Decimal(satoshis) / COIN * Decimal(rate), False)
+        return fiat_value
+
+    @command('wr')
+    def tokenhistory(self, contract_addr=None, bind_addr=None, offset=0, limit=None):
+        """Token history. Returns the QRC20 transfers of the tokens of your
+        wallet, newest first."""
+        out = []
+        for item in self.wallet.get_token_history(contract_addr, bind_addr, offset=offset, limit=limit):
+            _from, to, amount, token, txid, height, conf, timestamp, call_index, log_index = item
+            if timestamp:
+                date = datetime.datetime.fromtimestamp(timestamp).isoformat(' ')[:-3]
+            else:
+                date = "----"
+            out.append({
+                'txid': txid,
+                'contract_addr': token.contract_addr,
+                'bind_addr': token.bind_addr,
+                'symbol': token.symbol,
+                'from': hash160_to_p2pkh(bfh(_from)),
+                'to': hash160_to_p2pkh(bfh(to)),
+                'amount': str(Decimal(amount) / 10 ** token.decimals),
+                'timestamp': timestamp,
+                'date': date,
+                'height': height,
+                'confirmations': conf,
             })
         return out
 
@@ -497,17 +612,17 @@ class Commands:
         transaction ID"""
         self.wallet.set_label(key, label)
 
-    @command('w')
+    @command('wr')
     def listcontacts(self):
         """Show your list of contacts"""
         return self.wallet.contacts
 
-    @command('w')
+    @command('wr')
     def getalias(self, key):
         """Retrieve alias. Lookup in your list of contacts, and for an OpenAlias DNS record."""
         return self.wallet.contacts.resolve(key)
 
-    @command('w')
+    @command('wr')
     def searchcontacts(self, query):
         """Search through contacts, return matching entries. """
         results = {}
@@ -516,7 +631,7 @@ class Commands:
                 results[key] = value
         return results
 
-    @command('w')
+    @command('wr')
     def listaddresses(self, receiving=False, change=False, labels=False, frozen=False, unused=False, funded=False,
                       balance=False):
         """List wallet addresses. Returns the list of all addresses in your wallet. Use optional arguments to filter the results."""
@@ -548,7 +663,7 @@ class Commands:
         if self.wallet and txid in self.wallet.transactions:
             tx = self.wallet.transactions[txid]
         else:
-            raw = self.network.get_transaction(txid)
+            raw = (self.network_cache or self.network).get_transaction(txid)
             if raw:
                 tx = Transaction(raw)
             else:
@@ -563,7 +678,7 @@ class Commands:
         return encrypted
 
 
-    @command('wp')
+    @command('wpr')
     def decrypt(self, pubkey, encrypted, password=None):
         """Decrypt a message encrypted with a public key."""
         return self.wallet.decrypt_message(pubkey, encrypted, password)
@@ -579,7 +694,7 @@ class Commands:
         out['status'] = pr_str[out.get('status', PR_UNKNOWN)]
         return out
 
-    @command('w')
+    @command('wr')
     def getrequest(self, key):
         """Return a payment request"""
         r = self.wallet.get_payment_request(key, self.config)
@@ -592,7 +707,7 @@ class Commands:
     #    """<Not implemented>"""
     #    pass
 
-    @command('w')
+    @command('wr')
     def listrequests(self, pending=False, expired=False, paid=False):
         """List the payment requests you made."""
         out = self.wallet.get_sorted_requests(self.config)
@@ -669,22 +784,27 @@ class Commands:
     @command('n')
     def notify(self, address, URL):
         """Watch an address. Everytime the address changes, a http POST is sent to the URL."""
-        def callback(x):
-            import urllib.request
-            headers = {'content-type':'application/json'}
-            data = {'address':address, 'status':x.get('result')}
-            serialized_data = util.to_bytes(json.dumps(data))
-            try:
-                req = urllib.request.Request(URL, serialized_data, headers)
-                response_stream = urllib.request.urlopen(req, timeout=5)
-                util.print_error('Got Response for %s' % address)
-            except BaseException as e:
-                util.print_error(str(e))
-
-        self.network.subscribe_to_addresses([address], callback)
+        if not self.notifier:
+            raise Exception('Notifications are sent by the daemon')
+        self.notifier.watch([address], URL)
         return True
 
-    @command('wn')
+    @command('n')
+    def notifyaddresses(self, addresses, URL):
+        """Watch a list of addresses. Everytime one of them changes, a http POST
+        is sent to the URL. Returns the number of addresses newly watched."""
+        if not self.notifier:
+            raise Exception('Notifications are sent by the daemon')
+        return self.notifier.watch(addresses, URL)
+
+    @command('n')
+    def unnotify(self, address, URL):
+        """Stop watching an address for the URL."""
+        if not self.notifier:
+            raise Exception('Notifications are sent by the daemon')
+        return self.notifier.unwatch([address], URL) > 0
+
+    @command('wnr')
     def is_synchronized(self):
         """ return wallet synchronization status """
         return self.wallet.is_up_to_date()
@@ -711,6 +831,8 @@ param_descriptions = {
     'requested_amount': 'Requested amount (in QTUM).',
     'outputs': 'list of ["address", amount]',
     'redeem_script': 'redeem script (hexadecimal)',
+    'filename': 'Path of the file to write',
+    'addresses': 'list of addresses',
 }
 
 command_options = {
@@ -744,6 +866,17 @@ command_options = {
     'pending': (None, "Show only pending requests."),
     'expired': (None, "Show only expired requests."),
     'paid': (None, "Show only paid requests."),
+    'contract_addr': (None, "Show only the token with this contract address"),
+    'bind_addr': (None, "Show only tokens bound to this address"),
+    'offset': (None, "Number of items to skip"),
+    'limit': (None, "Maximum number of items to show"),
+    'cursor': (None, "Cursor returned with the previous page"),
+    'from_height': (None, "Show only transactions from this block height"),
+    'to_height': (None, "Show only transactions before this block height"),
+    'from_timestamp': (None, "Show only transactions from this time (unix timestamp)"),
+    'to_timestamp': (None, "Show only transactions before this time (unix timestamp)"),
+    'show_fiat': (None, "Show the historical value in the fiat currency"),
+    'format': (None, "File format: csv or jsonl"),
 }
 
 
@@ -759,9 +892,16 @@ arg_types = {
     'jsontx': json_loads,
     'inputs': json_loads,
     'outputs': json_loads,
+    'addresses': json_loads,
     'fee': lambda x: str(Decimal(x)) if x is not None else None,
     'amount': lambda x: str(Decimal(x)) if x != '!' else '!',
     'locktime': int,
+    'offset': int,
+    'limit': int,
+    'from_height': int,
+    'to_height': int,
+    'from_timestamp': int,
+    'to_timestamp': int,
 }
 
 config_variables = {
@@ -837,6 +977,7 @@ def add_network_options(parser):
 def add_global_options(parser):
     group = parser.add_argument_group('global options')
     group.add_argument("-v", "--verbose", action="store_true", dest="verbose", default=False, help="Show debugging information")
+    group.add_argument("--trace", action="store_true", dest="trace", default=None, help="Write signing traces to trace_file (default: trace.log in the qtum_electrum directory)")
     group.add_argument("-D", "--dir", dest="electrum_path", help="qtum_electrum directory")
     group.add_argument("-P", "--portable", action="store_true", dest="portable", default=False, help="Use local 'electrum_data' directory")
     group.add_argument("-w", "--wallet", dest="wallet_path", help="wallet path")
@@ -23,8 +23,10 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import ast
+import copy
 import os
 import sys
+import threading
 import time
 import traceback
 
@@ -33,7 +35,9 @@ from .jsonrpc import VerifyingJSONRPCServer
 
 from .version import ELECTRUM_VERSION
 from .network import Network
-from .util import json_decode, DaemonThread
+from .netcache import NetworkCache
+from .notifier import Notifier
+from .util import json_decode, DaemonThread, RWLock
 from .util import print_error, to_string
 from .wallet import Wallet
 from .storage import WalletStorage
@@ -124,14 +128,24 @@ class Daemon(DaemonThread):
         if config.get('offline'):
             self.network = None
             self.fx = None
+            self.notifier = None
         else:
             self.network = Network(config)
             self.network.start()
             self.fx = FxThread(config, self.network)
             self.network.add_jobs([self.fx])
+            self.notifier = Notifier(self.network, os.path.join(config.path, 'notify_db'),
+                                     config.get('notifyworkers', 4))
+            self.notifier.start()
+        self.network_cache = NetworkCache(self.network, config.get('rpccachesize', 10000),
+                                          config.get('rpccachettl', 10)) if self.network else None
 
         self.gui = None
         self.wallets = {}
+        # wallet path -> RWLock, read-only commands of a wallet run
+        # concurrently, other commands run alone
+        self.wallet_locks = {}
+        self.wallets_lock = threading.RLock()
 
         # Setup JSONRPC server
         self.init_server(config, fd, is_gui)
@@ -143,7 +157,10 @@ class Daemon(DaemonThread):
         rpc_user, rpc_password = get_rpc_credentials(config)
         try:
             server = VerifyingJSONRPCServer((host, port), logRequests=False,
-                                            rpc_user=rpc_user, rpc_password=rpc_password)
+                                            rpc_user=rpc_user, rpc_password=rpc_password,
+                                            num_workers=config.get('rpcworkers', 8),
+                                            max_queued=config.get('rpcqueue', 32),
+                                            keepalive=config.get('rpckeepalive', 10))
         except Exception as e:
             self.print_error('Warning: cannot initialize RPC server on host', host, e)
             self.server = None
@@ -158,14 +175,42 @@ class Daemon(DaemonThread):
             server.register_function(self.run_gui, 'gui')
         else:
             server.register_function(self.run_daemon, 'daemon')
-            self.cmd_runner = Commands(self.config, None, self.network)
+            self.cmd_runner = Commands(self.config, None, self.network, network_cache=self.network_cache,
+                                       fx=self.fx, notifier=self.notifier)
             for cmdname in known_commands:
-                server.register_function(getattr(self.cmd_runner, cmdname), cmdname)
+                server.register_function(self.rpc_command(cmdname), cmdname)
             server.register_function(self.run_cmdline, 'run_cmdline')
 
     def ping(self):
         return True
 
+    def rpc_command(self, cmdname):
+        cmd = known_commands[cmdname]
+
+        def run(*args, **kwargs):
+            cmd_runner = self.cmd_runner
+            return self.run_command(cmd, cmd_runner.wallet, getattr(cmd_runner, cmdname), args, kwargs)
+        return run
+
+    def run_command(self, cmd, wallet, func, args, kwargs):
+        if wallet is None or not cmd.requires_wallet:
+            return func(*args, **kwargs)
+        lock = self.get_wallet_lock(wallet.storage.path)
+        with (lock.read() if cmd.read_only else lock.write()):
+            return func(*args, **kwargs)
+
+    def get_wallet_lock(self, path):
+        with self.wallets_lock:
+            return self.wallet_locks.setdefault(path, RWLock())
+
+    def get_command_config(self, config_options):
+        '''The daemon config with the options of a command line. Unlike a
+        new SimpleConfig, it does not read the config file again.'''
+        config = copy.copy(self.config)
+        config.cmdline_options = dict(config_options)
+        config.cmdline_options.pop('config_version', None)
+        return config
+
     def run_daemon(self, config_options):
         config = SimpleConfig(config_options)
         sub = config.get('subcommand')
@@ -227,6 +272,10 @@ class Daemon(DaemonThread):
         return response
 
     def load_wallet(self, path, password):
+        with self.wallets_lock:
+            return self._load_wallet(path, password)
+
+    def _load_wallet(self, path, password):
         # wizard will be launched if we return
         if path in self.wallets:
             wallet = self.wallets[path]
@@ -258,14 +307,14 @@ class Daemon(DaemonThread):
         return self.wallets.get(path)
 
     def stop_wallet(self, path):
-        wallet = self.wallets.pop(path)
-        wallet.stop_threads()
+        with self.wallets_lock:
+            wallet = self.wallets.pop(path)
+        # let the commands running on it finish
+        with self.get_wallet_lock(path).write():
+            wallet.stop_threads()
 
     def run_cmdline(self, config_options):
-        password = config_options.get('password')
-        new_password = config_options.get('new_password')
-        config = SimpleConfig(config_options)
-        config.fee_estimates = self.network.config.fee_estimates.copy()
+        config = self.get_command_config(config_options)
         cmdname = config.get('cmd')
         cmd = known_commands[cmdname]
         if cmd.requires_wallet:
@@ -286,16 +335,29 @@ class Daemon(DaemonThread):
         for x in cmd.options:
             kwargs[x] = (config_options.get(x) if x in ['password', 'new_password'] else config.get(x))
 
-        cmd_runner = Commands(config, wallet, self.network)
+        cmd_runner = Commands(config, wallet, self.network, network_cache=self.network_cache,
+                              fx=self.fx, notifier=self.notifier)
         func = getattr(cmd_runner, cmd.name)
-        result = func(*args, **kwargs)
-        return result
+        return self.run_command(cmd, wallet, func, args, kwargs)
 
     def run(self):
-        while self.is_running():
-            self.server.handle_request() if self.server else time.sleep(0.1)
-        for k, wallet in self.wallets.items():
-            wallet.stop_threads()
+        try:
+            while self.is_running():
+                self.server.handle_request() if self.server else time.sleep(0.1)
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        if self.server:
+            self.server.server_close()
+            # stop the RPC workers once their running commands are done,
+            # then write the wallets
+            self.server.join_workers()
+        for path in list(self.wallets):
+            self.stop_wallet(path)
+        if self.notifier:
+            self.notifier.stop()
+            self.notifier.join()
         if self.network:
             self.print_error("shutting down network")
             self.network.stop()
@@ -39,6 +39,15 @@ from . import x509
 from . import pem
 
 
+# bounds of the number of unanswered requests per interface. The window
+# grows while responses come back faster than LATENCY_TARGET seconds and
+# is halved when they get slower.
+MIN_WINDOW = 10
+MAX_WINDOW = 1000
+INITIAL_WINDOW = 100
+LATENCY_TARGET = 1.0
+
+
 def Connection(server, queue, config_path):
     """Makes asynchronous connections to a remote qtum_electrum server.
     Returns the running thread that is making the connection.
@@ -272,6 +281,13 @@ class Interface(util.PrintError):
         self.debug = False
         self.unsent_requests = []
         self.unanswered_requests = {}
+        # wire id -> time the request was sent
+        self.send_times = {}
+        # send the requests of a tick as one JSON-RPC batch array
+        self.use_batches = True
+        self.window = INITIAL_WINDOW
+        self.max_window = MAX_WINDOW
+        self.latency = None
         self.last_send = time.time()
         self.closed_remotely = False
         self.server_version = []
@@ -299,9 +315,9 @@ class Interface(util.PrintError):
         self.unsent_requests.append(args)
 
     def num_requests(self):
-        '''Keep unanswered requests below 100'''
-        n = 100 - len(self.unanswered_requests)
-        return min(n, len(self.unsent_requests))
+        '''Keep unanswered requests below the current window'''
+        n = self.window - len(self.unanswered_requests)
+        return max(0, min(n, len(self.unsent_requests)))
 
     def send_requests(self):
         '''Sends queued requests.  Returns False on failure.'''
@@ -309,8 +325,12 @@ class Interface(util.PrintError):
         make_dict = lambda m, p, i: {'method': m, 'params': p, 'id': i}
         n = self.num_requests()
         wire_requests = self.unsent_requests[0:n]
+        messages = [make_dict(*r) for r in wire_requests]
+        # server.version has to be answered before anything else is sent
+        if self.use_batches and self.server_version and len(messages) > 1:
+            messages = [messages]
         try:
-            self.pipe.send_all([make_dict(*r) for r in wire_requests])
+            self.pipe.send_all(messages)
         except BaseException as e:
             self.print_error("pipe send error:", e)
             return False
@@ -319,8 +339,25 @@ class Interface(util.PrintError):
             if self.debug:
                 self.print_error("-->", request)
             self.unanswered_requests[request[2]] = request
+            self.send_times[request[2]] = self.last_send
         return True
 
+    def on_latency(self, latency):
+        '''Adjust the window to the latency of an answered request'''
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = 0.8 * self.latency + 0.2 * latency
+        if self.latency > LATENCY_TARGET:
+            if self.window > MIN_WINDOW:
+                self.window = max(MIN_WINDOW, self.window // 2)
+                # start over from the new window
+                self.latency = None
+        elif self.unsent_requests:
+            # requests are waiting for room in the window. Growing it by
+            # one per answer doubles it every round-trip.
+            self.window = min(self.max_window, self.window + 1)
+
     def ping_required(self):
         '''Returns True if a ping should be sent.'''
         return time.time() - self.last_send > 300
@@ -350,25 +387,30 @@ class Interface(util.PrintError):
                 response = self.pipe.get()
             except util.timeout:
                 break
-            if not type(response) is dict:
+            # the answer to a batch is an array of responses
+            batch = response if type(response) is list and response else [response]
+            if not all(type(r) is dict for r in batch):
                 responses.append((None, None))
                 if response is None:
                     self.closed_remotely = True
                     self.print_error("connection closed remotely")
                 break
-            if self.debug:
-                self.print_error("<--", response)
-            wire_id = response.get('id', None)
-            if wire_id is None:  # Notification
-                responses.append((None, response))
-            else:
-                request = self.unanswered_requests.pop(wire_id, None)
-                if request:
-                    responses.append((request, response))
+            now = time.time()
+            for response in batch:
+                if self.debug:
+                    self.print_error("<--", response)
+                wire_id = response.get('id', None)
+                if wire_id is None:  # Notification
+                    responses.append((None, response))
                 else:
-                    self.print_error("unknown wire ID", wire_id)
-                    responses.append((None, None)) # Signal
-                    break
+                    request = self.unanswered_requests.pop(wire_id, None)
+                    if request:
+                        responses.append((request, response))
+                        self.on_latency(now - self.send_times.pop(wire_id, now))
+                    else:
+                        self.print_error("unknown wire ID", wire_id)
+                        responses.append((None, None)) # Signal
+                        return responses
 
         return responses
 
@@ -24,7 +24,12 @@
 # SOFTWARE.
 
 from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCServer, SimpleJSONRPCRequestHandler
-from base64 import b64decode
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+import queue
+import selectors
+import socket
+import threading
 import time
 
 from . import util
@@ -47,13 +52,62 @@ class RPCAuthUnsupportedType(Exception):
 
 # based on http://acooke.org/cute/BasicHTTPA0.html by andrew cooke
 class VerifyingJSONRPCServer(SimpleJSONRPCServer):
-
-    def __init__(self, *args, rpc_user, rpc_password, **kargs):
+    """
+    With num_workers, requests are handled by a pool of that many
+    threads. Up to max_queued accepted requests wait for a worker;
+    beyond that, handle_request() waits for one to be free, and new
+    connections wait in the listen backlog. The workers are not daemon
+    threads, since WalletStorage does not write from daemon threads:
+    server_close() stops them, and join_workers() waits for the running
+    requests.
+
+    Connections are kept alive (HTTP/1.1) when there are workers, for up
+    to keepalive seconds between requests. A worker serves one request
+    at a time: between requests, the connection is watched by a selector
+    thread, which queues it again once the next request arrives, so that
+    idle clients do not hold workers. Requests pipelined before the
+    response of the previous one are not supported. Batches of calls
+    (JSON-RPC 2.0 arrays) are handled by the dispatcher.
+    """
+
+    # listen backlog; with the default of 5, connections beyond it are
+    # retried by the client after a second
+    request_queue_size = 128
+
+    def __init__(self, *args, rpc_user, rpc_password, num_workers=0, max_queued=0, keepalive=10, **kargs):
 
         self.rpc_user = rpc_user
         self.rpc_password = rpc_password
+        # the Authorization header of the valid credentials, so that the
+        # requests of a client are not decoded one by one
+        credentials = util.to_bytes('%s:%s' % (rpc_user, rpc_password), 'utf8')
+        self.auth_header = 'Basic ' + util.to_string(b64encode(credentials), 'ascii')
+        self.workers = []
+        self.requests = queue.Queue(max(max_queued, 1))
+        self.keepalive = keepalive
+        self.idle = OrderedDict()  # request -> (client_address, deadline), by deadline
+        self.idle_added = []  # from the workers, registered by the selector thread
+        self.idle_lock = threading.Lock()
+        self.selector = None
 
         class VerifyingRequestHandler(SimpleJSONRPCRequestHandler):
+            # without workers, a kept alive connection would hold the
+            # server loop
+            protocol_version = 'HTTP/1.1' if num_workers else 'HTTP/1.0'
+            timeout = keepalive if num_workers else None
+
+            def handle(myself):
+                if not num_workers:
+                    return SimpleJSONRPCRequestHandler.handle(myself)
+                # one request; the worker hands the connection back to
+                # the selector if it is kept alive
+                myself.close_connection = True
+                myself.handle_one_request()
+
+            def log_error(myself, format, *args):
+                # idle connections time out routinely
+                util.print_error('[jsonrpc]', format % args)
+
             def parse_request(myself):
                 # first, call the original implementation which returns
                 # True if all OK so far
@@ -76,6 +130,21 @@ class VerifyingJSONRPCServer(SimpleJSONRPCServer):
         SimpleJSONRPCServer.__init__(
             self, requestHandler=VerifyingRequestHandler, *args, **kargs)
 
+        # started once the socket is bound
+        if num_workers:
+            self.selector = selectors.DefaultSelector()
+            self.wakeup_r, self.wakeup_w = socket.socketpair()
+            self.wakeup_r.setblocking(False)
+            self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+            self.idle_thread = threading.Thread(target=self.watch_idle, name='rpc keepalive')
+            self.idle_thread.daemon = True
+            self.idle_thread.start()
+        for i in range(num_workers):
+            t = threading.Thread(target=self.work, name='rpc worker %d' % i)
+            t.daemon = False
+            t.start()
+            self.workers.append(t)
+
     def authenticate(self, headers):
         if self.rpc_password == '':
             # RPC authentication is disabled
@@ -84,6 +153,8 @@ class VerifyingJSONRPCServer(SimpleJSONRPCServer):
         auth_string = headers.get('Authorization', None)
         if auth_string is None:
             raise RPCAuthCredentialsMissing()
+        if util.constant_time_compare(auth_string, self.auth_header):
+            return
 
         (basic, _, encoded) = auth_string.partition(' ')
         if basic != 'Basic':
@@ -96,3 +167,89 @@ class VerifyingJSONRPCServer(SimpleJSONRPCServer):
                 and util.constant_time_compare(password, self.rpc_password)):
             time.sleep(0.050)
             raise RPCAuthCredentialsInvalid()
+
+    def process_request(self, request, client_address):
+        if not self.workers:
+            return SimpleJSONRPCServer.process_request(self, request, client_address)
+        self.requests.put((request, client_address))
+
+    def work(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            keep = False
+            try:
+                handler = self.RequestHandlerClass(request, client_address, self)
+                keep = not handler.close_connection
+            except BaseException:
+                self.handle_error(request, client_address)
+            if keep:
+                with self.idle_lock:
+                    # None once the server is closed
+                    keep = self.idle_added is not None
+                    if keep:
+                        self.idle_added.append((request, client_address))
+                        self.wakeup_w.send(b'\0')
+            if not keep:
+                self.shutdown_request(request)
+
+    def watch_idle(self):
+        """ Selector thread: queues the kept alive connections that have
+        a new request, and closes the ones idle for keepalive seconds """
+        while True:
+            timeout = None
+            if self.idle:
+                deadline = next(iter(self.idle.values()))[1]
+                timeout = max(deadline - time.time(), 0)
+            events = self.selector.select(timeout)
+            for key, mask in events:
+                if key.fileobj is self.wakeup_r:
+                    try:
+                        self.wakeup_r.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                self.selector.unregister(key.fileobj)
+                client_address, deadline = self.idle.pop(key.fileobj)
+                self.requests.put((key.fileobj, client_address))
+            with self.idle_lock:
+                added, self.idle_added = self.idle_added, []
+            if added is None:
+                break
+            deadline = time.time() + self.keepalive
+            for request, client_address in added:
+                self.idle[request] = (client_address, deadline)
+                self.selector.register(request, selectors.EVENT_READ)
+            now = time.time()
+            while self.idle:
+                request, (client_address, deadline) = next(iter(self.idle.items()))
+                if deadline > now:
+                    break
+                del self.idle[request]
+                self.selector.unregister(request)
+                self.shutdown_request(request)
+        for request in self.idle:
+            self.shutdown_request(request)
+        self.idle.clear()
+        self.selector.close()
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+
+    def server_close(self):
+        SimpleJSONRPCServer.server_close(self)
+        if self.selector:
+            with self.idle_lock:
+                added, self.idle_added = self.idle_added, None
+            for request, client_address in added:
+                self.shutdown_request(request)
+            self.wakeup_w.send(b'\0')
+            self.idle_thread.join()
+        for t in self.workers:
+            self.requests.put(None)
+
+    def join_workers(self, timeout=None):
+        """ Waits up to timeout seconds for each worker, once closed """
+        for t in self.workers:
+            t.join(timeout)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import copy
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from .transaction import Transaction
+from .util import PrintError
+from .verifier import SPV, InnerNodeOfSpvProofIsValidTx
+
+
+class NetworkCache(PrintError):
+    """ Cache of the walletless server queries of the daemon commands.
+
+    Raw transactions are kept by txid once their hash matches, and merkle
+    branches once they match the merkle root of a local header; both are
+    kept until evicted. Scripthash history, balance and unspent outputs
+    are kept for ttl seconds, and dropped as soon as the server notifies
+    a new status of the scripthash. Each store keeps its max_size most
+    recently used entries. So do the scripthash subscriptions: the
+    entries of an unsubscribed scripthash are dropped with it.
+    """
+
+    def __init__(self, network, max_size=10000, ttl=10):
+        self.network = network
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.transactions = OrderedDict()  # txid -> raw tx
+        self.merkle = OrderedDict()  # (txid, height) -> (merkle, merkle root)
+        self.scripthashes = OrderedDict()  # (kind, scripthash) -> (expiry, result)
+        self.subscribed = OrderedDict()  # scripthash -> None, least recently used first
+        self.statuses = {}  # scripthash -> last status notified
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+
+    def _get(self, store, kind, key, is_valid=None):
+        with self.lock:
+            value = store.get(key)
+            if value is not None and is_valid and not is_valid(value):
+                del store[key]
+                value = None
+            if value is None:
+                self.misses[kind] += 1
+                return None
+            store.move_to_end(key)
+            self.hits[kind] += 1
+            return value
+
+    def _put(self, store, key, value):
+        with self.lock:
+            store[key] = value
+            store.move_to_end(key)
+            while len(store) > self.max_size:
+                store.popitem(last=False)
+
+    def get_transaction(self, txid):
+        raw = self._get(self.transactions, 'transaction', txid)
+        if raw is not None:
+            return raw
+        raw = self.network.get_transaction(txid)
+        if raw and Transaction(raw).txid() == txid:
+            self._put(self.transactions, txid, raw)
+        return raw
+
+    def get_merkle_for_transaction(self, txid, height):
+        key = (txid, height)
+        # the block may have been reorganized away since
+        item = self._get(self.merkle, 'merkle', key,
+                         lambda item: self.get_merkle_root(item[0]['block_height']) == item[1])
+        if item is not None:
+            return copy.deepcopy(item[0])
+        merkle = self.network.get_merkle_for_transaction(txid, height)
+        try:
+            merkle_root = SPV.hash_merkle_root(merkle['merkle'], txid, merkle['pos'])
+        except InnerNodeOfSpvProofIsValidTx:
+            return merkle
+        if self.get_merkle_root(merkle['block_height']) == merkle_root:
+            self._put(self.merkle, key, (copy.deepcopy(merkle), merkle_root))
+        return merkle
+
+    def get_merkle_root(self, height):
+        header = self.network.blockchain().read_header(height)
+        return header.get('merkle_root') if header else None
+
+    def get_history_for_scripthash(self, scripthash):
+        return self._get_scripthash('history', scripthash, self.network.get_history_for_scripthash)
+
+    def listunspent_for_scripthash(self, scripthash):
+        return self._get_scripthash('unspent', scripthash, self.network.listunspent_for_scripthash)
+
+    def get_balance_for_scripthash(self, scripthash):
+        return self._get_scripthash('balance', scripthash, self.network.get_balance_for_scripthash)
+
+    def _get_scripthash(self, kind, scripthash, request):
+        key = (kind, scripthash)
+        item = self._get(self.scripthashes, kind, key, lambda item: item[0] > time.time())
+        evicted = []
+        with self.lock:
+            subscribe = scripthash not in self.subscribed
+            if subscribe:
+                self.subscribed[scripthash] = None
+                while len(self.subscribed) > self.max_size:
+                    h = self.subscribed.popitem(last=False)[0]
+                    self.statuses.pop(h, None)
+                    for k in ('history', 'unspent', 'balance'):
+                        self.scripthashes.pop((k, h), None)
+                    evicted.append(h)
+            else:
+                self.subscribed.move_to_end(scripthash)
+        for h in evicted:
+            self.network.unsubscribe_from_scripthash(h, self.on_status)
+        if item is not None and not subscribe:
+            return copy.deepcopy(item[1])
+        if subscribe:
+            self.network.subscribe_to_scripthash(scripthash, self.on_status)
+        result = request(scripthash)
+        self._put(self.scripthashes, key, (time.time() + self.ttl, copy.deepcopy(result)))
+        return result
+
+    def on_status(self, response):
+        if response.get('error'):
+            return
+        scripthash = response['params'][0]
+        status = response.get('result')
+        with self.lock:
+            if scripthash not in self.subscribed:
+                return
+            # the first status of a subscription can be older than the
+            # cached results; keep them, the ttl bounds the error
+            changed = scripthash in self.statuses and self.statuses[scripthash] != status
+            self.statuses[scripthash] = status
+            if changed:
+                for kind in ('history', 'unspent', 'balance'):
+                    self.scripthashes.pop((kind, scripthash), None)
+
+    def get_stats(self):
+        with self.lock:
+            sizes = defaultdict(int)
+            sizes['transaction'] = len(self.transactions)
+            sizes['merkle'] = len(self.merkle)
+            for kind, scripthash in self.scripthashes:
+                sizes[kind] += 1
+            stats = {}
+            for kind in ('transaction', 'merkle', 'history', 'unspent', 'balance'):
+                hits, misses = self.hits[kind], self.misses[kind]
+                stats[kind] = {
+                    'entries': sizes[kind],
+                    'hits': hits,
+                    'misses': misses,
+                    'hit_rate': hits / (hits + misses) if hits + misses else None,
+                }
+            return stats
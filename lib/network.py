@@ -47,6 +47,8 @@ from .version import ELECTRUM_VERSION, PROTOCOL_VERSION
 
 NODES_RETRY_INTERVAL = 60
 SERVER_RETRY_INTERVAL = 10
+# number of header chunks requested ahead during catch up
+CHUNK_WINDOW = 8
 
 
 def parse_servers(result):
@@ -190,7 +192,7 @@ class Network(util.DaemonThread):
         self.recent_servers_lock = threading.RLock()       # <- re-entrant
         self.subscribed_addresses_lock = threading.Lock()
         self.subscribed_tokens_lock = threading.Lock()
-        self.blockchains_lock = threading.Lock()
+        self.blockchains_lock = blockchain.blockchains_lock
 
         self.pending_sends = []
         self.message_id = 0
@@ -229,7 +231,14 @@ class Network(util.DaemonThread):
         self.interfaces = {}               # note: needs self.interface_lock
         self.auto_connect = self.config.get('auto_connect', True)
         self.connecting = set()
-        self.requested_chunks = set()
+        # header chunks: requested ones (index -> (interface, blockchain)), then
+        # received ones waiting to be verified in order by the chunk thread
+        self.chunk_window = self.config.get('chunk_window', CHUNK_WINDOW)
+        self.requested_chunks = {}
+        self.chunks_cond = threading.Condition()
+        self.received_chunks = {}               # note: needs self.chunks_cond
+        self.verifying_chunks = set()           # note: needs self.chunks_cond
+        self.connected_chunks = queue.Queue()
         self.socket_queue = queue.Queue()
         self.start_network(deserialize_server(self.default_server)[2],
                            deserialize_proxy(self.config.get('proxy')))
@@ -304,7 +313,8 @@ class Network(util.DaemonThread):
                         interface = self.interfaces[server]
                         if interface.blockchain and interface.blockchain is self.blockchains[k]:
                             self.close_interface(interface)
-                    del self.blockchains[k]
+                    with self.blockchains_lock:
+                        del self.blockchains[k]
         return result
 
     def set_status(self, status):
@@ -588,6 +598,9 @@ class Network(util.DaemonThread):
                 self.interfaces.pop(interface.server)
             if interface.server == self.default_server:
                 self.interface = None
+            for index, (i, b) in list(self.requested_chunks.items()):
+                if i == interface:
+                    self.requested_chunks.pop(index)
             interface.close()
 
     @with_recent_servers_lock
@@ -783,6 +796,8 @@ class Network(util.DaemonThread):
         interface.tip = 0
         interface.mode = 'default'
         interface.request = None
+        interface.chunk_catch_up = False
+        interface.use_batches = self.config.get('batch_requests', True)
         with self.interface_lock:
             self.interfaces[server] = interface
         # server.version should be the first message
@@ -842,42 +857,111 @@ class Network(util.DaemonThread):
         if index in self.requested_chunks:
             return
         interface.print_error("requesting chunk %d" % index)
-        height = index * 2016
-        self.queue_request('blockchain.block.headers', [height, 2016],
+        height = index * CHUNK_SIZE
+        self.queue_request('blockchain.block.headers', [height, CHUNK_SIZE],
                            interface)
-        self.requested_chunks.add(index)
+        self.requested_chunks[index] = interface, interface.blockchain
+
+    def request_chunks(self, interface):
+        '''Catch up interface.blockchain with interface.tip by keeping
+        chunk_window chunks in flight. Full chunks are spread over the
+        interfaces following the same chain; they are verified and saved
+        in order by the chunk thread.'''
+        interface.chunk_catch_up = True
+        chain = interface.blockchain
+        next_index = (chain.height() + 1) // CHUNK_SIZE
+        last_index = min(interface.tip // CHUNK_SIZE, next_index + self.chunk_window - 1)
+        with self.interface_lock:
+            peers = [i for i in self.interfaces.values()
+                     if i != interface and i.blockchain == chain]
+        with self.chunks_cond:
+            pending = set(self.received_chunks) | self.verifying_chunks
+        for index in range(next_index, last_index + 1):
+            if index in self.requested_chunks or index in pending:
+                continue
+            # a peer behind interface.tip could only serve part of the chunk
+            servers = [interface] + [i for i in peers if i.tip >= (index + 1) * CHUNK_SIZE - 1]
+            self.request_chunk(servers[index % len(servers)], index)
 
     def on_block_headers(self, interface, response):
         '''Handle receiving a chunk of block headers'''
         error = response.get('error')
         result = response.get('result')
         params = response.get('params')
-        blockchain = interface.blockchain
         if result is None or params is None or error is not None:
             print_error('on get chunk error', error, result, params)
             return
 
         height = params[0]
-        index = height // 2016
-        if index * 2016 != height or index not in self.requested_chunks:
+        index = height // CHUNK_SIZE
+        request = self.requested_chunks.get(index)
+        if index * CHUNK_SIZE != height or request is None or request[0] != interface:
             interface.print_error("received chunk %d (unsolicited)" % index)
             return
         else:
             interface.print_error("received chunk %d" % index)
-        self.requested_chunks.remove(index)
-        hexdata = result['hex']
-        connect = blockchain.connect_chunk(index, hexdata)
-        if not connect:
-            self.connection_down(interface.server)
-            return
-        # If not finished, get the next chunk
-        if blockchain.height() < interface.tip:
-            self.request_chunk(interface, index+1)
-        else:
-            interface.mode = 'default'
-            interface.print_error('catch up done', blockchain.height())
-            blockchain.catch_up = None
-        self.notify('updated')
+        self.requested_chunks.pop(index)
+        with self.chunks_cond:
+            self.received_chunks[index] = interface, request[1], result['hex']
+            self.chunks_cond.notify()
+
+    def next_received_chunk(self):
+        # lowest received chunk whose previous headers are already saved
+        for index in sorted(self.received_chunks):
+            interface, chain, hexdata = self.received_chunks[index]
+            if index == 0 or chain.height() >= index * CHUNK_SIZE - 1:
+                return index
+
+    def verify_chunks(self):
+        '''Chunk thread: verification is CPU heavy and must not
+        block the network thread.'''
+        while self.is_running():
+            with self.chunks_cond:
+                index = self.next_received_chunk()
+                if index is None:
+                    self.chunks_cond.wait(0.5)
+                    continue
+                interface, chain, hexdata = self.received_chunks.pop(index)
+                self.verifying_chunks.add(index)
+            connect = chain.connect_chunk(index, hexdata)
+            with self.chunks_cond:
+                self.verifying_chunks.discard(index)
+            self.connected_chunks.put((interface, index, connect))
+
+    def maintain_chunks(self):
+        '''Handle chunks connected by the chunk thread, and keep the
+        windows of interfaces catching up with chunks full.'''
+        updated = False
+        while True:
+            try:
+                interface, index, connect = self.connected_chunks.get_nowait()
+            except queue.Empty:
+                break
+            if not connect:
+                interface.print_error("chunk %d does not connect" % index)
+                self.connection_down(interface.server)
+                # the chunks after it cannot be verified before it is
+                # requested again: request them again too
+                with self.chunks_cond:
+                    for i in [i for i in self.received_chunks if i > index]:
+                        del self.received_chunks[i]
+            updated = True
+        with self.interface_lock:
+            interfaces = [i for i in self.interfaces.values() if i.chunk_catch_up]
+        for interface in interfaces:
+            chain = interface.blockchain
+            if interface.mode != 'catch_up' or chain.catch_up != interface.server:
+                interface.chunk_catch_up = False
+            elif chain.height() < interface.tip:
+                self.request_chunks(interface)
+            elif not any(b == chain for i, b in self.requested_chunks.values()):
+                interface.chunk_catch_up = False
+                interface.mode = 'default'
+                interface.print_error('catch up done', chain.height())
+                chain.catch_up = None
+                updated = True
+        if updated:
+            self.notify('updated')
 
     def on_get_header(self, interface, response):
         '''Handle receiving a single block header'''
@@ -997,7 +1081,8 @@ class Network(util.DaemonThread):
         # If not finished, get the next header
         if next_height is not None:
             if interface.mode == 'catch_up' and interface.tip > next_height + 50:
-                self.request_chunk(interface, next_height // CHUNK_SIZE)
+                interface.request = None
+                self.request_chunks(interface)
             else:
                 self.request_header(interface, next_height)
         else:
@@ -1070,15 +1155,29 @@ class Network(util.DaemonThread):
         #
         # while self.is_running() and self.downloading_headers:
         #     time.sleep(1)
+        chunk_thread = threading.Thread(target=self.verify_chunks)
+        chunk_thread.daemon = True
+        chunk_thread.start()
         while self.is_running():
             self.maintain_sockets()
             self.wait_on_sockets()
             self.maintain_requests()
+            self.maintain_chunks()
             self.run_jobs()    # Synchronizer and Verifier
             self.process_pending_sends()
+            self.flush_headers()
+        self.flush_headers()
         self.stop_network()
+        blockchain.close_header_dbs()
         self.on_stop()
 
+    def flush_headers(self):
+        # header writes of one poll cycle are committed together
+        with self.blockchains_lock:
+            chains = list(self.blockchains.values())
+        for b in chains:
+            b.flush()
+
     def on_notify_header(self, interface, header_dict):
         try:
             header_hex, height = header_dict['hex'], header_dict['height']
@@ -1120,14 +1219,14 @@ class Network(util.DaemonThread):
         else:
             chain = self.blockchains[0]
             if chain.catch_up is None:
-                chain.catch_up = interface
+                chain.catch_up = interface.server
                 interface.mode = 'catch_up'
                 interface.blockchain = chain
                 with self.blockchains_lock:
                     self.print_error("switching to catchup mode", tip, self.blockchains)
                 self.request_header(interface, 0)
             else:
-                self.print_error("chain already catching up with", chain.catch_up.server)
+                self.print_error("chain already catching up with", chain.catch_up)
 
     @with_interface_lock
     def blockchain(self):
@@ -1168,7 +1267,6 @@ class Network(util.DaemonThread):
                 self.set_parameters(host, port, protocol, proxy, auto_connect)
 
     def get_local_height(self):
-        self.blockchain().update_size()
         return self.blockchain().height()
 
     @staticmethod
@@ -1220,9 +1318,17 @@ class Network(util.DaemonThread):
         self.send(msgs, self.map_scripthash_to_address(callback))
 
     def request_address_history(self, address, callback):
-        h = bitcoin.address_to_scripthash(address)
-        self.h2addr.update({h: address})
-        self.send([('blockchain.scripthash.get_history', [h])], self.map_scripthash_to_address(callback))
+        self.request_address_histories([address], callback)
+
+    def request_address_histories(self, addresses, callback):
+        hash2address = {
+            bitcoin.address_to_scripthash(address): address
+            for address in addresses}
+        self.h2addr.update(hash2address)
+        msgs = [
+            ('blockchain.scripthash.get_history', [x])
+            for x in hash2address.keys()]
+        self.send(msgs, self.map_scripthash_to_address(callback))
 
     # NOTE this method handles exceptions and a special edge case, counter to
     # what the other ElectrumX methods do. This is unexpected.
@@ -1275,6 +1381,24 @@ class Network(util.DaemonThread):
 
         return Network.__with_default_synchronous_callback(invocation, callback)
 
+    def unsubscribe_from_scripthash(self, scripthash, callback):
+        '''Drop callback from the subscription of scripthash. Once no
+        callback is left, the scripthash is no longer subscribed on
+        reconnection, and the server is asked to unsubscribe; servers
+        older than protocol 1.4.2 answer with an error, which is ignored.'''
+        k = self.get_index('blockchain.scripthash.subscribe', [scripthash])
+        with self.callback_lock:
+            l = [c for c in self.subscriptions.get(k, []) if c != callback]
+            if l:
+                self.subscriptions[k] = l
+                return
+            self.subscriptions.pop(k, None)
+        with self.subscribed_addresses_lock:
+            self.subscribed_addresses.discard(scripthash)
+        with self.interface_lock:
+            self.sub_cache.pop(k, None)
+        self.send([('blockchain.scripthash.unsubscribe', [scripthash])], lambda response: None)
+
     def get_transaction(self, transaction_hash, callback=None):
         command = 'blockchain.transaction.get'
         invocation = lambda c: self.send([(command, [transaction_hash])], c)
@@ -1329,11 +1453,16 @@ class Network(util.DaemonThread):
         :param callback:
         :return:
         """
-        __, hash160 = b58_address_to_hash160(token.bind_addr)
-        hash160 = bh2u(hash160)
-        datahex = '70a08231{}'.format(hash160.zfill(64))
-        self.send([('blockchain.contract.call', [token.contract_addr, datahex, '', 'int'])],
-                  callback)
+        self.request_token_balances([token], callback)
+
+    def request_token_balances(self, tokens, callback):
+        """ one balanceOf call per token, sent together """
+        messages = []
+        for token in tokens:
+            __, hash160 = b58_address_to_hash160(token.bind_addr)
+            datahex = '70a08231{}'.format(bh2u(hash160).zfill(64))
+            messages.append(('blockchain.contract.call', [token.contract_addr, datahex, '', 'int']))
+        self.send(messages, callback)
 
     def request_token_history(self, token, callback):
         __, hash160 = b58_address_to_hash160(token.bind_addr)
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import http.client
+import json
+import queue
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+from .bitcoin import is_address
+from .util import DaemonThread
+
+
+class Notifier(DaemonThread):
+    """
+    Posts the status changes of watched addresses to their URLs, as
+    {"address": ..., "status": ...}.
+
+    The watch list, the last status of each address and the
+    notifications not delivered yet are kept in an sqlite file, so that
+    they survive a restart. The network thread only queues the status
+    changes; this thread writes them to the outbox, and hands the due
+    notifications to num_workers delivery threads, each keeping one
+    connection per server alive. A failed delivery is retried after
+    backoff seconds, doubled at each attempt up to max_backoff, and
+    dropped after max_attempts.
+    """
+
+    def __init__(self, network, path, num_workers=4, timeout=5, backoff=2, max_backoff=600, max_attempts=10):
+        DaemonThread.__init__(self)
+        self.network = network
+        self.num_workers = num_workers
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA synchronous=FULL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS watch (address TEXT NOT NULL, url TEXT NOT NULL, '
+                        'PRIMARY KEY (address, url))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS status (address TEXT PRIMARY KEY NOT NULL, value TEXT)')
+        # next_try is NULL while a delivery is in progress
+        self.db.execute('CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                        'url TEXT NOT NULL, body TEXT NOT NULL, attempts INTEGER NOT NULL, next_try REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS outbox_next_try ON outbox (next_try)')
+        # deliveries interrupted by a stop
+        self.db.execute('UPDATE outbox SET next_try=0 WHERE next_try IS NULL')
+        self.db.commit()
+        self.db_lock = threading.Lock()
+        self.watched = {}  # address -> set of urls
+        for address, url in self.db.execute('SELECT address, url FROM watch'):
+            self.watched.setdefault(address, set()).add(url)
+        self.statuses = dict(self.db.execute('SELECT address, value FROM status'))
+        self.cond = threading.Condition()
+        self.incoming = []  # (address, status) from the network thread
+        self.results = []   # (outbox id, attempts, delivered) from the workers
+        self.deliveries = queue.Queue()
+        self.workers = []
+
+    def start(self):
+        for i in range(self.num_workers):
+            t = threading.Thread(target=self.deliver_loop, name='notify worker %d' % i)
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+        addresses = []
+        for address in self.watched:
+            if is_address(address):
+                addresses.append(address)
+            else:
+                self.print_error('not watching invalid address', address)
+        if addresses:
+            self.network.subscribe_to_addresses(addresses, self.on_status)
+        return DaemonThread.start(self)
+
+    def watch(self, addresses, url):
+        """ Returns the number of addresses newly watched for url """
+        if urllib.parse.urlsplit(url).scheme not in ('http', 'https'):
+            raise Exception('Only http and https URLs are supported')
+        invalid = [a for a in addresses if not is_address(a)]
+        if invalid:
+            raise Exception('Invalid address: ' + ', '.join(map(str, invalid)))
+        with self.db_lock:
+            new = [a for a in set(addresses) if url not in self.watched.get(a, ())]
+            self.db.executemany('INSERT OR IGNORE INTO watch VALUES (?,?)', [(a, url) for a in new])
+            self.db.commit()
+            for address in new:
+                self.watched.setdefault(address, set()).add(url)
+        if new:
+            self.network.subscribe_to_addresses(new, self.on_status)
+        return len(new)
+
+    def unwatch(self, addresses, url):
+        """ Returns the number of addresses no longer watched for url. The
+        server subscriptions remain until the daemon is restarted. """
+        with self.db_lock:
+            removed = [a for a in set(addresses) if url in self.watched.get(a, ())]
+            self.db.executemany('DELETE FROM watch WHERE address=? AND url=?', [(a, url) for a in removed])
+            for address in removed:
+                self.watched[address].discard(url)
+                if not self.watched[address]:
+                    del self.watched[address]
+                    self.statuses.pop(address, None)
+                    self.db.execute('DELETE FROM status WHERE address=?', (address,))
+            self.db.commit()
+        return len(removed)
+
+    def on_status(self, response):
+        # called by the network thread: only queue it
+        if response.get('error'):
+            return
+        with self.cond:
+            self.incoming.append((response['params'][0], response.get('result')))
+            self.cond.notify()
+
+    def get_pending(self):
+        with self.db_lock:
+            return self.db.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+
+    def stop(self):
+        DaemonThread.stop(self)
+        with self.cond:
+            self.cond.notify()
+
+    def run(self):
+        while self.is_running():
+            with self.cond:
+                if not self.incoming and not self.results:
+                    self.cond.wait(self.get_wait_time())
+                incoming, self.incoming = self.incoming, []
+                results, self.results = self.results, []
+            with self.db_lock:
+                self.add_notifications(incoming)
+                self.add_results(results)
+                self.db.commit()
+                due = self.take_due()
+            for item in due:
+                self.deliveries.put(item)
+        # the deliveries not started yet are taken again after a restart
+        while not self.deliveries.empty():
+            self.deliveries.get_nowait()
+        for t in self.workers:
+            self.deliveries.put(None)
+        for t in self.workers:
+            t.join(self.timeout)
+        with self.db_lock:
+            self.db.close()
+        self.on_stop()
+
+    def get_wait_time(self):
+        with self.db_lock:
+            next_try = self.db.execute('SELECT MIN(next_try) FROM outbox').fetchone()[0]
+        if next_try is None:
+            return 1.0
+        return min(max(next_try - time.time(), 0), 1.0)
+
+    def add_notifications(self, incoming):
+        """ Callers hold db_lock """
+        now = time.time()
+        for address, status in incoming:
+            urls = self.watched.get(address)
+            if not urls or address in self.statuses and self.statuses[address] == status:
+                continue
+            self.statuses[address] = status
+            self.db.execute('INSERT OR REPLACE INTO status VALUES (?,?)', (address, status))
+            body = json.dumps({'address': address, 'status': status})
+            self.db.executemany('INSERT INTO outbox (url, body, attempts, next_try) VALUES (?,?,0,?)',
+                                [(url, body, now) for url in sorted(urls)])
+
+    def add_results(self, results):
+        """ Callers hold db_lock """
+        now = time.time()
+        for row_id, attempts, delivered in results:
+            if delivered:
+                self.db.execute('DELETE FROM outbox WHERE id=?', (row_id,))
+            elif attempts + 1 >= self.max_attempts:
+                self.print_error('dropping notification', row_id, 'after', attempts + 1, 'attempts')
+                self.db.execute('DELETE FROM outbox WHERE id=?', (row_id,))
+            else:
+                delay = min(self.backoff * 2 ** attempts, self.max_backoff)
+                self.db.execute('UPDATE outbox SET attempts=?, next_try=? WHERE id=?',
+                                (attempts + 1, now + delay, row_id))
+
+    def take_due(self):
+        """ Callers hold db_lock """
+        due = self.db.execute('SELECT id, url, body, attempts FROM outbox WHERE next_try<=? ORDER BY id',
+                              (time.time(),)).fetchall()
+        if due:
+            self.db.executemany('UPDATE outbox SET next_try=NULL WHERE id=?', [(row[0],) for row in due])
+            self.db.commit()
+        return due
+
+    def deliver_loop(self):
+        connections = {}  # (scheme, netloc) -> HTTPConnection
+        while True:
+            item = self.deliveries.get()
+            if item is None:
+                break
+            row_id, url, body, attempts = item
+            delivered = self.post(connections, url, body)
+            with self.cond:
+                self.results.append((row_id, attempts, delivered))
+                self.cond.notify()
+        for conn in connections.values():
+            conn.close()
+
+    def post(self, connections, url, body):
+        u = urllib.parse.urlsplit(url)
+        key = (u.scheme, u.netloc)
+        path = (u.path or '/') + ('?' + u.query if u.query else '')
+        headers = {'Content-Type': 'application/json'}
+        while True:
+            conn = connections.get(key)
+            reused = conn is not None
+            if conn is None:
+                cls = http.client.HTTPSConnection if u.scheme == 'https' else http.client.HTTPConnection
+                conn = connections[key] = cls(u.netloc, timeout=self.timeout)
+            try:
+                conn.request('POST', path, body, headers)
+                response = conn.getresponse()
+                response.read()
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                del connections[key]
+                if reused:
+                    # the server may have closed the idle connection
+                    continue
+                self.print_error('cannot notify', url, e)
+                return False
+            if response.will_close:
+                conn.close()
+                del connections[key]
+            return 200 <= response.status < 300
@@ -9,7 +9,6 @@ from eth_utils import function_abi_to_4byte_selector
 
 from .util import bfh, bh2u, assert_bytes, to_bytes, inv_dict, print_error, QtumException
 from .util import unpack_uint16_from, unpack_uint32_from, unpack_uint64_from, unpack_int32_from, unpack_int64_from
-from .util import Print
 from . import version
 from . import constants
 from . import segwit_addr
@@ -75,16 +74,17 @@ def rev_hex(s): #-> 16进制字符串,逆序
         """
 
 
+def int_to_bytes(i: int, length: int=1) -> bytes:
+    """little endian, negative values in two's complement"""
+    range_size = 1 << (8 * length)#范围大小256^length
+    if i < -range_size // 2 or i >= range_size:
+        raise OverflowError('cannot convert int {} to hex ({} bytes)'.format(i, length))
+    return (i % range_size).to_bytes(length, 'little')
+
+
 def int_to_hex(i: int, length: int=1) -> str:
     assert isinstance(i, int)
-    range_size = pow(256, length)#??范围大小256^length??
-    if i < -range_size / 2 or i >= range_size:
-        raise OverflowError('cannot convert int {} to hex ({} bytes)'.format(i, length))
-    if i < 0:
-        i = range_size + i
-    s = hex(i)[2:].rstrip('L')#[2:]去除0x前缀,rstrip('L'):
-    s = "0"*(2*length - len(s)) + s
-    return rev_hex(s)
+    return bh2u(int_to_bytes(i, length))
 
 
 def script_num_to_hex(i: int) -> str:
@@ -111,16 +111,20 @@ def script_num_to_hex(i: int) -> str:
     return bh2u(result)
 
 
-def var_int(i: int) -> str:
+def var_int_bytes(i: int) -> bytes:
     # https://en.bitcoin.it/wiki/Protocol_specification#Variable_length_integer
     if i<0xfd:
-        return int_to_hex(i)
+        return int_to_bytes(i)
     elif i<=0xffff:
-        return "fd"+int_to_hex(i,2)
+        return b'\xfd' + int_to_bytes(i, 2)
     elif i<=0xffffffff:
-        return "fe"+int_to_hex(i,4)
+        return b'\xfe' + int_to_bytes(i, 4)
     else:
-        return "ff"+int_to_hex(i,8)
+        return b'\xff' + int_to_bytes(i, 8)
+
+
+def var_int(i: int) -> str:
+    return bh2u(var_int_bytes(i))
 
 
 def witness_push(item: str) -> str:
@@ -130,39 +134,46 @@ def witness_push(item: str) -> str:
     return var_int(len(item) // 2) + item
 
 
-def op_push(i: int) -> str:
+def op_push_bytes(i: int) -> bytes:
     if i < 0xa0:  # OP_PUSHDATA1
-        return int_to_hex(i)
+        return int_to_bytes(i)
     elif i <= 0xff:
-        return '4c' + int_to_hex(i)
+        return b'\x4c' + int_to_bytes(i)
     elif i <= 0xffff:
-        return '4d' + int_to_hex(i,2)
+        return b'\x4d' + int_to_bytes(i, 2)
     else:
-        return '4e' + int_to_hex(i,4)
+        return b'\x4e' + int_to_bytes(i, 4)
 
 
-def push_script(data: str) -> str:
+def op_push(i: int) -> str:
+    return bh2u(op_push_bytes(i))
+
+
+def push_script_bytes(data: bytes) -> bytes:
     """Returns pushed data to the script, automatically
     choosing canonical opcodes depending on the length of the data.
-    hex -> hex
+    bytes -> bytes
 
     ported from https://github.com/btcsuite/btcd/blob/fdc2bc867bda6b351191b5872d2da8270df00d13/txscript/scriptbuilder.go#L128
     """
-
-    data = bfh(data)
     from .transaction import opcodes
 
     data_len = len(data)
 
     # "small integer" opcodes
     if data_len == 0 or data_len == 1 and data[0] == 0:
-        return bh2u(bytes([opcodes.OP_0]))
+        return bytes([opcodes.OP_0])
     elif data_len == 1 and data[0] <= 16:
-        return bh2u(bytes([opcodes.OP_1 - 1 + data[0]]))
+        return bytes([opcodes.OP_1 - 1 + data[0]])
     elif data_len == 1 and data[0] == 0x81:
-        return bh2u(bytes([opcodes.OP_1NEGATE]))
+        return bytes([opcodes.OP_1NEGATE])
+
+    return op_push_bytes(data_len) + data
 
-    return op_push(data_len) + bh2u(data)
+
+def push_script(data: str) -> str:
+    """push_script_bytes, hex -> hex"""
+    return bh2u(push_script_bytes(bfh(data)))
 
 def add_number_to_script(i: int) -> bytes:
     return bfh(push_script(script_num_to_hex(i)))
@@ -372,12 +383,8 @@ def base_decode(v, length, base):
     if base == 43:
         chars = __b43chars
     long_value = 0
-
-    #base_encode_file = Print("Base_encode")
-
     for (i, c) in enumerate(v[::-1]):
         digit = chars.find(bytes([c]))
-        #base_encode_file.add_var(c = c,bytes_c = bytes(c),digit = digit)
         if digit == -1:
             raise ValueError('Forbidden character {} for base {}'.format(c, base))
         long_value += digit * (base ** i)
@@ -397,9 +404,6 @@ def base_decode(v, length, base):
     if length is not None and len(result) != length:
         return None
     result.reverse()
-
-    #base_encode_file.add_var(c=c, bytes_c=bytes(c), digit=digit)
-
     return bytes(result)
 
 
@@ -898,12 +902,16 @@ class Deserializer(object):
 def hash_header(header):
     if header is None:
         return '0' * 64
+    if isinstance(header, Header):
+        return header.get_hash()
     if header.get('prev_block_hash') is None:
         header['prev_block_hash'] = '00' * 32
     return hash_encode(Hash(bfh(serialize_header(header))))
 
 
 def serialize_header(res):
+    if isinstance(res, Header):
+        return bh2u(res.raw)
     sig_length = len(res.get('sig'))//2
     s = int_to_hex(res.get('version'), 4) \
         + rev_hex(res.get('prev_block_hash')) \
@@ -921,25 +929,101 @@ def serialize_header(res):
     return s
 
 
+HEADER_KEYS = ('block_height', 'version', 'prev_block_hash', 'merkle_root', 'timestamp', 'bits', 'nonce',
+               'hash_state_root', 'hash_utxo_root', 'hash_prevout_stake', 'hash_prevout_n', 'sig')
+HEADER_UINT32_OFFSETS = {'version': 0, 'timestamp': 68, 'bits': 72, 'nonce': 76, 'hash_prevout_n': 176}
+HEADER_HASH_OFFSETS = {'prev_block_hash': 4, 'merkle_root': 36, 'hash_state_root': 80,
+                       'hash_utxo_root': 112, 'hash_prevout_stake': 144}
+
+
+class Header(object):
+    """
+    A block header backed by its raw serialization (bytes or memoryview).
+    Fields are parsed from the raw bytes when they are accessed, and the
+    block hash is computed from the raw bytes once.
+
+    Supports the read-only dict interface of deserialized headers,
+    e.g. header['bits'] or header.get('timestamp').
+    """
+    __slots__ = ('raw', 'block_height', '_hash')
+
+    def __init__(self, raw, height):
+        self.raw = raw
+        self.block_height = height
+        self._hash = None
+
+    def hash_bytes(self):
+        """ double sha256 of the raw header, in internal byte order """
+        if self._hash is None:
+            self._hash = hashlib.sha256(hashlib.sha256(self.raw).digest()).digest()
+        return self._hash
+
+    def get_hash(self):
+        return hash_encode(self.hash_bytes())
+
+    def prev_hash_bytes(self):
+        return bytes(self.raw[4:36])
+
+    def __getitem__(self, key):
+        offset = HEADER_UINT32_OFFSETS.get(key)
+        if offset is not None:
+            return unpack_uint32_from(self.raw, offset)[0]
+        offset = HEADER_HASH_OFFSETS.get(key)
+        if offset is not None:
+            return hash_encode(bytes(self.raw[offset:offset + 32]))
+        if key == 'block_height':
+            return self.block_height
+        if key == 'sig':
+            sig_length = Deserializer(bytes(self.raw), start=BASIC_HEADER_SIZE).read_varint()
+            return bh2u(self.raw[len(self.raw) - sig_length:]) if sig_length else ''
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in HEADER_KEYS
+
+    def __iter__(self):
+        return iter(HEADER_KEYS)
+
+    def __len__(self):
+        return len(HEADER_KEYS)
+
+    def keys(self):
+        return list(HEADER_KEYS)
+
+    def values(self):
+        return [self[k] for k in HEADER_KEYS]
+
+    def items(self):
+        return [(k, self[k]) for k in HEADER_KEYS]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, Header):
+            return self.block_height == other.block_height and bytes(self.raw) == bytes(other.raw)
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        r = self.__eq__(other)
+        return r if r is NotImplemented else not r
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Header(%d, %s)' % (self.block_height, self.get_hash())
+
+
 def deserialize_header(s, height):
-    hex_to_int = lambda s: int('0x' + bh2u(s[::-1]), 16)
-    deserializer = Deserializer(s, start=BASIC_HEADER_SIZE)
-    sig_length = deserializer.read_varint()
-    h = {
-        'block_height': height,
-        'version': hex_to_int(s[0:4]),
-        'prev_block_hash': hash_encode(s[4:36]),
-        'merkle_root': hash_encode(s[36:68]),
-        'timestamp': hex_to_int(s[68:72]),
-        'bits': hex_to_int(s[72:76]),
-        'nonce': hex_to_int(s[76:80]),
-        'hash_state_root': hash_encode(s[80:112]),
-        'hash_utxo_root': hash_encode(s[112:144]),
-        'hash_prevout_stake': hash_encode(s[144:176]),
-        'hash_prevout_n': hex_to_int(s[176:180]),
-        'sig': hash_encode(s[:-sig_length - 1:-1]),
-    }
-    return h
+    return Header(s, height)
 
 
 def read_a_raw_header_from_chunk(data, start):
@@ -966,10 +1050,8 @@ def uint256_from_compact(bits):
 
 # target to nbits
 def compact_from_uint256(target):
-    c = ("%064x" % target)[2:]
-    while c[:2] == '00' and len(c) > 6:
-        c = c[2:]
-    bitsN, bitsBase = len(c) // 2, int('0x' + c[:6], 16)
+    bitsN = max(3, (target.bit_length() + 7) // 8)
+    bitsBase = target >> (8 * (bitsN - 3))
     if bitsBase >= 0x800000:
         bitsN += 1
         bitsBase >>= 8
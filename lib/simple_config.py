@@ -199,6 +199,12 @@ class SimpleConfig(PrintError):
             if os.path.exists(self.path):  # or maybe not?
                 raise
 
+    def get_trace_path(self):
+        """Path of the trace file, or None if tracing is disabled."""
+        if not self.get('trace'):
+            return None
+        return self.get('trace_file') or os.path.join(self.path, 'trace.log')
+
     def get_wallet_path(self):
         """Set the path of the wallet."""
 
@@ -31,6 +31,7 @@ import re
 import stat
 import pbkdf2, hmac, hashlib
 import base64
+import sqlite3
 import zlib
 from collections import defaultdict
 
@@ -38,6 +39,7 @@ from .util import PrintError, profiler, InvalidPassword, \
     export_meta, import_meta, print_error, bfh, WalletFileException
 from .plugins import run_hook, plugin_loaders
 from .keystore import bip44_derivation
+from .crypto import aes_encrypt_with_iv, aes_decrypt_with_iv
 from . import ecc
 from . import util
 
@@ -70,6 +72,153 @@ def get_derivation_used_for_hw_device_encryption():
 # storage encryption version
 STO_EV_PLAINTEXT, STO_EV_USER_PW, STO_EV_XPUB_PW = range(0, 3)
 
+SQLITE_MAGIC = b'SQLite format 3\x00'
+WALLET_DB_VERSION = 1
+
+
+class StorageEncoder(util.MyEncoder):
+    """ MyEncoder with sorted sets, so an unchanged value always has the same serialization """
+
+    def default(self, obj):
+        if isinstance(obj, set):
+            try:
+                return sorted(obj)
+            except TypeError:
+                return list(obj)
+        return super(StorageEncoder, self).default(obj)
+
+
+def dump_value(value):
+    try:
+        return json.dumps(value, sort_keys=True, cls=StorageEncoder)
+    except TypeError:
+        # dict keys of mixed types cannot be sorted
+        return json.dumps(value, cls=StorageEncoder)
+
+
+def freeze(value):
+    """ The json of a value as written: a list of (item, json) for dicts """
+    if isinstance(value, dict):
+        # list() copies the items atomically
+        return [(item_name(k), dump_value(v)) for k, v in list(value.items())]
+    return dump_value(value)
+
+
+def item_name(key):
+    # dict keys as json turns them into strings
+    return key if isinstance(key, str) else json.dumps(key)
+
+
+def digest(text):
+    return hashlib.blake2b(text.encode('utf8'), digest_size=16).digest()
+
+
+class PlainRows(object):
+    """ row encoding of plaintext wallet dbs: names and json values as they are """
+
+    def encode(self, name, text):
+        return name, text
+
+    def decode(self, row_id, value):
+        return row_id, value
+
+    def row_id(self, name):
+        return name
+
+
+class EncryptedRows(object):
+    """
+    Row encoding of encrypted wallet dbs. Every value is compressed and
+    encrypted with AES-256-CBC and authenticated with HMAC-SHA256, under
+    keys derived from the random data key of the db. Rows are looked up
+    by an HMAC of their name, so the names are not visible either.
+    """
+
+    def __init__(self, data_key):
+        h = hashlib.sha512(data_key).digest()
+        self.key_e, self.key_m = h[:32], h[32:]
+
+    def row_id(self, name):
+        return hmac.new(self.key_m, b'id:' + name.encode('utf8'), hashlib.sha256).hexdigest()
+
+    def encode(self, name, text):
+        iv = os.urandom(16)
+        plaintext = zlib.compress((json.dumps(name) + '\n' + text).encode('utf8'))
+        ciphertext = iv + aes_encrypt_with_iv(self.key_e, iv, plaintext)
+        mac = hmac.new(self.key_m, ciphertext, hashlib.sha256).digest()
+        return self.row_id(name), base64.b64encode(ciphertext + mac).decode('ascii')
+
+    def decode(self, row_id, value):
+        b = base64.b64decode(value)
+        ciphertext, mac = b[:-32], b[-32:]
+        if not hmac.compare_digest(mac, hmac.new(self.key_m, ciphertext, hashlib.sha256).digest()):
+            raise WalletFileException('Wallet file is corrupted: invalid mac')
+        s = zlib.decompress(aes_decrypt_with_iv(self.key_e, ciphertext[:16], ciphertext[16:])).decode('utf8')
+        name, text = s.split('\n', 1)
+        return json.loads(name), text
+
+
+class WalletDB(object):
+    """
+    sqlite file holding the top level keys of a wallet. Dict values are
+    split into one row per item in item_data, so that a change to one
+    transaction or one address rewrites that row only. data holds the
+    other values, and '{}' for dicts. Commits are atomic; there is no
+    WAL, so the wallet stays a single file between writes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA synchronous=FULL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY NOT NULL, value TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS data (key TEXT PRIMARY KEY NOT NULL, value TEXT NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS item_data (key TEXT NOT NULL, item TEXT NOT NULL, '
+                          'value TEXT NOT NULL, PRIMARY KEY (key, item))')
+        self.conn.commit()
+
+    @staticmethod
+    def is_db_file(path):
+        with open(path, 'rb') as f:
+            return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+    def get_meta(self, key, default=None):
+        row = self.conn.execute('SELECT value FROM meta WHERE key=?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?,?)', (key, value))
+
+    def read_rows(self):
+        """ (data rows, item rows by key) """
+        rows = self.conn.execute('SELECT key, value FROM data').fetchall()
+        items = defaultdict(list)
+        for key, item, value in self.conn.execute('SELECT key, item, value FROM item_data'):
+            items[key].append((item, value))
+        return rows, items
+
+    def read_items(self, row_id):
+        return self.conn.execute('SELECT item, value FROM item_data WHERE key=?', (row_id,)).fetchall()
+
+    def put(self, row_id, value):
+        self.conn.execute('INSERT OR REPLACE INTO data VALUES (?,?)', (row_id, value))
+
+    def delete(self, row_id):
+        self.conn.execute('DELETE FROM data WHERE key=?', (row_id,))
+        self.conn.execute('DELETE FROM item_data WHERE key=?', (row_id,))
+
+    def put_item(self, row_id, item_id, value):
+        self.conn.execute('INSERT OR REPLACE INTO item_data VALUES (?,?,?)', (row_id, item_id, value))
+
+    def delete_item(self, row_id, item_id):
+        self.conn.execute('DELETE FROM item_data WHERE key=? AND item=?', (row_id, item_id))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
 
 class WalletStorage(PrintError):
 
@@ -80,18 +229,67 @@ class WalletStorage(PrintError):
         self.path = path
         self.modified = False
         self.pubkey = None
+        self.db = None
+        self.rows = PlainRows()
+        self.raw = None
+        # key -> json of the value put since the last write (see freeze),
+        # None if it was removed
+        self._dirty = {}
+        # key -> {item: json, None if it was removed} of the dict values
+        # of which only some items were put since the last write
+        self._dirty_items = {}
+        # key -> {item: digest} of the dict values in the db, None until
+        # the digests are needed (see _item_digests)
+        self._written = {}
+        # write every key to a new file: the file is missing, still in the
+        # json format of older versions, or gets a new password
+        self._rewrite = True
+        # called before every write, to put changes that were deferred
+        self._write_hooks = []
         if self.file_exists():
-            with open(self.path, "r", encoding='utf-8') as f:
-                self.raw = f.read()
-            self._encryption_version = self._init_encryption_version()
-            if not self.is_encrypted():
-                self.load_data(self.raw)
+            if WalletDB.is_db_file(self.path):
+                self.db = WalletDB(self.path)
+                self._rewrite = False
+                self._encryption_version = int(self.db.get_meta('encryption_version', STO_EV_PLAINTEXT))
+                if not self.is_encrypted():
+                    self.load_rows()
+            else:
+                with open(self.path, "r", encoding='utf-8') as f:
+                    self.raw = f.read()
+                self._encryption_version = self._init_encryption_version()
+                if not self.is_encrypted():
+                    self.load_data(self.raw)
         else:
             self._encryption_version = STO_EV_PLAINTEXT
             # avoid new wallets getting 'upgraded'
             self.put('seed_version', FINAL_SEED_VERSION)
 
+    def load_rows(self):
+        rows, items = self.db.read_rows()
+        data = {}
+        written = {}
+        for row_id, value in rows:
+            key, text = self.rows.decode(row_id, value)
+            value = json.loads(text)
+            if isinstance(value, dict):
+                decoded = [self.rows.decode(item_id, item_value) for item_id, item_value in items.get(row_id, [])]
+                # one parse for all items of the key, not one per item
+                texts = [text for item, text in decoded]
+                value.update(zip([item for item, text in decoded], json.loads('[' + ','.join(texts) + ']')))
+                written[key] = None
+            data[key] = value
+        self.data = data
+        self._written = written
+        self._on_data_loaded()
+
     def load_data(self, s):
+        self._load_data(s)
+        # the json file is not written again: the values are rewritten
+        # from their json as loaded, in case they are mutated until then
+        self._dirty = {key: freeze(value) for key, value in self.data.items()}
+        self._on_data_loaded()
+
+    def _load_data(self, s):
         try:
             self.data = json.loads(s)
         except:
@@ -110,6 +308,7 @@ class WalletStorage(PrintError):
                     continue
                 self.data[key] = value
 
+    def _on_data_loaded(self):
         # check here if I need to load a plugin
         t = self.get('wallet_type')
         l = plugin_loaders.get(t)
@@ -178,6 +377,14 @@ class WalletStorage(PrintError):
 
     def decrypt(self, password):
         ec_key = self.get_eckey_from_password(password)
+        if self.db:
+            enc_magic = self._get_encryption_magic()
+            data_key = ec_key.decrypt_message(self.db.get_meta('data_key'), enc_magic)
+            self.pubkey = ec_key.get_public_key_hex()
+            self.rows = EncryptedRows(data_key)
+            self._data_key = data_key
+            self.load_rows()
+            return
         if self.raw:
             enc_magic = self._get_encryption_magic()
             s = zlib.decompress(ec_key.decrypt_message(self.raw, enc_magic))
@@ -208,37 +415,76 @@ class WalletStorage(PrintError):
         else:
             self.pubkey = None
             self._encryption_version = STO_EV_PLAINTEXT
-        # make sure next storage.write() saves changes
+        # make sure next storage.write() saves changes, re-encrypted
+        # with a new data key
         with self.lock:
             self.modified = True
+            self._rewrite = True
 
     def get(self, key, default=None):
+        """
+        Values are not copied: get returns the stored object, and put
+        stores the object it is given. put takes the json of the value to
+        be written, while the caller holds the locks of its owner: a value
+        mutated in place is written once it is put again.
+        """
         with self.lock:
             v = self.data.get(key)
             if v is None:
                 v = default
-            else:
-                v = copy.deepcopy(v)
         return v
 
     def put(self, key, value):
-        try:
-            json.dumps(key, cls=util.MyEncoder)#key是MyEncoder的实例就序列化
-            json.dumps(value, cls=util.MyEncoder)
-        except:
-            self.print_error("json error: cannot save", key)
-            return
         with self.lock:
             if value is not None:#值不为空
-                if self.data.get(key) != value:#value 与 key 对应的value不一致
-                    self.modified = True
-                    self.data[key] = copy.deepcopy(value)
+                try:
+                    frozen = freeze(value)
+                except (TypeError, ValueError) as e:
+                    self.print_error("json error: cannot save", key, e)
+                    return
+                # no comparison with the stored value: objects returned by
+                # get are shared, so it may be the same object, or contain
+                # the same containers, mutated in place. _write_key skips
+                # the items that did not change.
+                self.modified = True
+                self._dirty[key] = frozen
+                self._dirty_items.pop(key, None)
+                self.data[key] = value
             elif key in self.data:#?为什么要弹出key
                 self.modified = True
+                self._dirty[key] = None
+                self._dirty_items.pop(key, None)
                 self.data.pop(key)
 
+    def put_items(self, key, value, items):
+        """
+        Like put for a dict value of which only the given items changed
+        since it was last put: the json of those items is taken, not of
+        the whole value. Items missing from value were removed.
+        """
+        with self.lock:
+            if key in self._dirty or key not in self._written:
+                # not in the db as a dict, or put as a whole already
+                self.put(key, value)
+                return
+            try:
+                frozen = {item_name(k): (dump_value(value[k]) if k in value else None) for k in items}
+            except (TypeError, ValueError) as e:
+                self.print_error("json error: cannot save", key, e)
+                return
+            self.modified = True
+            self._dirty_items.setdefault(key, {}).update(frozen)
+            self.data[key] = value
+
+    def add_write_hook(self, hook):
+        self._write_hooks.append(hook)
+
     @profiler
     def write(self):
+        # hooks take the locks of their owners, which may hold them while
+        # calling put(): run them before taking self.lock
+        for hook in self._write_hooks:
+            hook()
         with self.lock:
             self._write()
 
@@ -248,22 +494,124 @@ class WalletStorage(PrintError):
             return
         if not self.modified:
             return
-        s = json.dumps(self.data, indent=4, sort_keys=True, cls=util.MyEncoder)
-        if self.pubkey:
-            s = bytes(s, 'utf8')
-            c = zlib.compress(s)
-            enc_magic = self._get_encryption_magic()
-            public_key = ecc.ECPubkey(bfh(self.pubkey))
-            s = public_key.encrypt_message(c, enc_magic)
-            s = s.decode('utf8')
+        if self._rewrite or self.db is None:
+            self._write_all()
+        else:
+            for key, frozen in self._dirty.items():
+                self._write_key(self.db, key, frozen)
+            for key, frozen in self._dirty_items.items():
+                self._write_items(self.db, key, frozen)
+            self.db.commit()
+        self.print_error("saved", self.path)
+        self._dirty.clear()
+        self._dirty_items.clear()
+        self.modified = False
 
+    def _write_key(self, db, key, frozen):
+        """ frozen is the json of the value, as returned by freeze """
+        row_id = self.rows.row_id(key)
+        if frozen is None:
+            db.delete(row_id)
+            self._written.pop(key, None)
+            return
+        if not isinstance(frozen, list):
+            if key in self._written:
+                del self._written[key]
+                db.delete(row_id)
+            db.put(*self.rows.encode(key, frozen))
+            return
+        texts = frozen
+        if key in self._written:
+            old = self._item_digests(key)
+        else:
+            db.delete(row_id)
+            db.put(*self.rows.encode(key, '{}'))
+            old = {}
+        new = {}
+        for item, text in texts:
+            new[item] = d = digest(text)
+            if old.get(item) != d:
+                db.put_item(row_id, *self.rows.encode(item, text))
+        for item in set(old) - set(new):
+            db.delete_item(row_id, self.rows.row_id(item))
+        self._written[key] = new
+
+    def _write_items(self, db, key, frozen):
+        """ frozen is the json of the changed items, as put by put_items """
+        row_id = self.rows.row_id(key)
+        written = self._item_digests(key)
+        for item, text in frozen.items():
+            if text is None:
+                if written.pop(item, None) is not None:
+                    db.delete_item(row_id, self.rows.row_id(item))
+                continue
+            d = digest(text)
+            if written.get(item) != d:
+                db.put_item(row_id, *self.rows.encode(item, text))
+                written[item] = d
+
+    def _item_digests(self, key):
+        """ {item: digest} of the items of key in the db, read back from
+        the db on first use, so that opening a wallet does not hash every
+        item """
+        written = self._written[key]
+        if written is None:
+            items = self.db.read_items(self.rows.row_id(key))
+            written = {item: digest(text) for item, text in
+                       (self.rows.decode(item_id, value) for item_id, value in items)}
+            self._written[key] = written
+        return written
+
+    def _read_frozen(self):
+        """ The json of the values not put since the last write, read
+        back from the db, or made from the values of a new storage """
+        frozen = {}
+        if self.db:
+            rows, items = self.db.read_rows()
+            for row_id, value in rows:
+                key, text = self.rows.decode(row_id, value)
+                if key in self.data and key not in self._dirty:
+                    if key in self._written:
+                        text = [self.rows.decode(item_id, item_value)
+                                for item_id, item_value in items.get(row_id, [])]
+                    frozen[key] = text
+        for key, value in self.data.items():
+            if key not in self._dirty and key not in frozen:
+                frozen[key] = freeze(value)
+        frozen.update((key, value) for key, value in self._dirty.items() if value is not None)
+        for key, changes in self._dirty_items.items():
+            texts = dict(frozen.get(key, []))
+            texts.update(changes)
+            frozen[key] = [(item, text) for item, text in texts.items() if text is not None]
+        return frozen
+
+    def _write_all(self):
+        frozen = self._read_frozen()
         temp_path = "%s.tmp.%s" % (self.path, os.getpid())
-        with open(temp_path, "w", encoding='utf-8') as f:
-            f.write(s)
-            f.flush()
-            os.fsync(f.fileno())
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        db = WalletDB(temp_path)
+        db.set_meta('version', str(WALLET_DB_VERSION))
+        db.set_meta('encryption_version', str(self._encryption_version))
+        if self.pubkey:
+            # a new data key for every new password
+            self._data_key = os.urandom(32)
+            public_key = ecc.ECPubkey(bfh(self.pubkey))
+            enc_magic = self._get_encryption_magic()
+            db.set_meta('data_key', public_key.encrypt_message(self._data_key, enc_magic).decode('ascii'))
+            self.rows = EncryptedRows(self._data_key)
+        else:
+            self.rows = PlainRows()
+        self._written = {}
+        for key, value in frozen.items():
+            self._write_key(db, key, value)
+        db.commit()
+        db.close()
 
         mode = os.stat(self.path).st_mode if os.path.exists(self.path) else stat.S_IREAD | stat.S_IWRITE
+        if self.db:
+            self.db.close()
+            self.db = None
         # perform atomic write on POSIX systems
         try:
             os.rename(temp_path, self.path)
@@ -271,8 +619,9 @@ class WalletStorage(PrintError):
             os.remove(self.path)
             os.rename(temp_path, self.path)
         os.chmod(self.path, mode)
-        self.print_error("saved", self.path)
-        self.modified = False
+        self.db = WalletDB(self.path)
+        self.raw = None
+        self._rewrite = False
 
     def requires_split(self):
         d = self.get('accounts', {})
@@ -536,15 +885,20 @@ class ModelStorage(dict):
 
     def __setitem__(self, key, value):
         dict.__setitem__(self, key, value)
-        self.save()
+        self.save([key])
 
-    def save(self):
-        self.storage.put(self.name, dict(self))
+    def save(self, keys=None):
+        # the storage keeps a reference to self; put marks it for writing,
+        # put_items only the keys that changed
+        if keys is None:
+            self.storage.put(self.name, self)
+        else:
+            self.storage.put_items(self.name, self, keys)
 
     def pop(self, key):
         if key in self.keys():
             dict.pop(self, key)
-            self.save()
+            self.save([key])
 
     def load_meta(self, data):
         self.update(data)
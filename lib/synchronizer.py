@@ -55,6 +55,16 @@ class Synchronizer(ThreadJob):
         self.requested_token_txs = {}
 
         self.requested_addrs = set()
+        # requests coalesced until the next run(), then sent together
+        self.histories_to_request = []
+        self.txs_to_request = []
+        self.receipts_to_request = []
+        # token key -> Token, balances to request on the next run()
+        self.balances_to_request = {}
+        # token key -> local height when the balance was requested, for
+        # the balances on their way and for those the wallet has
+        self.requested_balances = {}
+        self.balance_heights = {}
         self.lock = Lock()
         self.initialized = False
         self.initialize()
@@ -104,7 +114,7 @@ class Synchronizer(ThreadJob):
             # there is no history
             if addr not in self.requested_histories:
                 self.requested_histories[addr] = result
-                self.network.request_address_history(addr, self.on_address_history)
+                self.histories_to_request.append(addr)
         # remove addr from list only after it is added to requested_histories
         if addr in self.requested_addrs:  # Notifications won't be in
             self.requested_addrs.remove(addr)
@@ -149,6 +159,8 @@ class Synchronizer(ThreadJob):
         self.requested_histories.pop(addr)
 
     def on_tx_response(self, response):
+        # answers both requests of request_missing_txs and of
+        # request_missing_token_txs, a txid is only fetched once
         if self.wallet.synchronizer is None and self.initialized:
             return # we have been killed, this was just an orphan callback
         params, result = self.parse_response(response)
@@ -165,26 +177,55 @@ class Synchronizer(ThreadJob):
             self.print_error("received tx does not match expected txid ({} != {})"
                              .format(tx_hash, tx.txid()))
             return
-        tx_height = self.requested_tx.pop(tx_hash)
-        self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
-        self.print_error("received tx %s height: %d bytes: %d" %
-                         (tx_hash, tx_height, len(tx.raw)))
-        # callbacks
-        self.network.trigger_callback('new_transaction', tx)
-        if not self.requested_tx:
-            self.network.trigger_callback('updated')
+        if tx_hash in self.requested_tx:
+            tx_height = self.requested_tx.pop(tx_hash)
+            self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
+            self.print_error("received tx %s height: %d bytes: %d" %
+                             (tx_hash, tx_height, len(tx.raw)))
+            # callbacks
+            self.network.trigger_callback('new_transaction', tx)
+            if not self.requested_tx:
+                self.network.trigger_callback('updated')
+        if tx_hash in self.requested_token_txs:
+            tx_height = self.requested_token_txs.pop(tx_hash)
+            self.wallet.receive_token_tx_callback(tx_hash, tx, tx_height)
+            self.print_error("received token tx %s height: %d bytes: %d" %
+                             (tx_hash, tx_height, len(tx.raw)))
+            # callbacks
+            self.network.trigger_callback('new_token_transaction', tx)
+            if not self.requested_token_txs and not self.requested_tx_receipt:
+                self.network.trigger_callback('on_token')
 
     def request_missing_txs(self, hist):
         # "hist" is a list of [tx_hash, tx_height] lists
-        transaction_hashes = []
         for tx_hash, tx_height in hist:
             if tx_hash in self.requested_tx:
                 continue
             if tx_hash in self.wallet.transactions:
                 continue
-            transaction_hashes.append(tx_hash)
+            # already on its way if requested as a token tx
+            if tx_hash not in self.requested_token_txs:
+                self.txs_to_request.append(tx_hash)
             self.requested_tx[tx_hash] = tx_height
-        self.network.get_transactions(transaction_hashes, self.on_tx_response)
+
+    def send_requests(self):
+        '''Send the requests coalesced since the last call, the network
+        sends the requests of a tick together.'''
+        if self.histories_to_request:
+            self.network.request_address_histories(self.histories_to_request, self.on_address_history)
+            self.histories_to_request = []
+        if self.txs_to_request:
+            self.network.get_transactions(self.txs_to_request, self.on_tx_response)
+            self.txs_to_request = []
+        if self.receipts_to_request:
+            self.network.get_transactions_receipt(self.receipts_to_request, self.on_tx_receipt_response)
+            self.receipts_to_request = []
+        if self.balances_to_request:
+            height = self.network.get_local_height()
+            for key in self.balances_to_request:
+                self.requested_balances[key] = height
+            self.network.request_token_balances(self.balances_to_request.values(), self.on_token_balance_response)
+            self.balances_to_request = {}
 
     def add_token(self, token):
         with self.lock:
@@ -221,9 +262,14 @@ class Synchronizer(ThreadJob):
                 if self.get_token_status(token_history) != result:
                     self.requested_token_histories[key] = result
                     self.network.request_token_history(token, self.on_token_history)
-                    self.get_token_balance(token)
+                    # the balance changed with the history; an answer
+                    # on its way may predate the change
+                    self.balance_heights.pop(key, None)
+                    if key in self.requested_balances:
+                        self.requested_balances[key] = None
                 else:
                     self.print_error('token status matched')
+                self.get_token_balance(token)
         except (BaseException,) as e:
             print('on_token_status err', e)
 
@@ -271,17 +317,14 @@ class Synchronizer(ThreadJob):
 
     def request_missing_tx_receipts(self, hist):
         # "hist" is a list of [tx_hash, tx_height, log_index] lists
-        tx_hashs = []
         for tx_hash, tx_height, log_index in hist:
             if tx_hash in self.requested_tx_receipt:
                 continue
             if tx_hash in self.wallet.tx_receipt:
                 continue
-            tx_hashs.append(tx_hash)
+            self.receipts_to_request.append(tx_hash)
             self.requested_tx_receipt[tx_hash] = tx_height
 
-        self.network.get_transactions_receipt(tx_hashs, self.on_tx_receipt_response)
-
     def on_tx_receipt_response(self, response):
         if self.wallet.synchronizer is None and self.initialized:
             return  # we have been killed, this was just an orphan callback
@@ -304,57 +347,49 @@ class Synchronizer(ThreadJob):
 
     def request_missing_token_txs(self, hist):
         # "hist" is a list of [tx_hash, tx_height, log_index] lists
-        tx_hashs = []
         for tx_hash, tx_height, log_index in hist:
             if tx_hash in self.requested_token_txs:
                 continue
             if tx_hash in self.wallet.token_txs:
                 continue
-            tx_hashs.append(tx_hash)
+            if tx_hash not in self.requested_tx:
+                self.txs_to_request.append(tx_hash)
             self.requested_token_txs[tx_hash] = tx_height
-        self.network.get_transactions(tx_hashs, self.on_token_tx_response)
-
-    def on_token_tx_response(self, response):
-        if self.wallet.synchronizer is None and self.initialized:
-            return  # we have been killed, this was just an orphan callback
-        params, result = self.parse_response(response)
-        if not params:
-            return
-        tx_hash = params[0]
-        tx = Transaction(result)
-        try:
-            tx.deserialize()
-        except Exception:
-            self.print_msg("cannot deserialize transaction, skipping", tx_hash)
-            return
-        tx_height = self.requested_token_txs.pop(tx_hash)
-        self.wallet.receive_token_tx_callback(tx_hash, tx, tx_height)
-        self.print_error("received tx %s height: %d bytes: %d" %
-                         (tx_hash, tx_height, len(tx.raw)))
-        # callbacks
-        self.network.trigger_callback('new_token_transaction', tx)
-        if not self.requested_token_txs and not self.requested_tx_receipt:
-            self.network.trigger_callback('on_token')
 
     def get_token_balance(self, token):
         """
+        Request the balance of token with the next requests, unless it
+        is on its way or the wallet has it for the current height.
         :type token: Token
         """
-        self.network.request_token_balance(token, self.on_token_balance_response)
+        key = '{}_{}'.format(token.contract_addr, token.bind_addr)
+        if key in self.requested_balances:
+            return
+        if self.balance_heights.get(key) == self.network.get_local_height():
+            return
+        self.balances_to_request[key] = token
 
     def on_token_balance_response(self, response):
-        params, result = self.parse_response(response)
-        if not params:
-            return
         try:
-            contract_addr = params[0]
-            bind_addr = hash160_to_p2pkh(binascii.a2b_hex(params[1][-40:]))
+            # params come with errors too, the balance can be requested again
+            contract_addr, datahex = response['params'][:2]
+            bind_addr = hash160_to_p2pkh(binascii.a2b_hex(datahex[-40:]))
             key = '{}_{}'.format(contract_addr, bind_addr)
+            stale = key in self.requested_balances and self.requested_balances[key] is None
+            height = self.requested_balances.pop(key, None)
+            params, result = self.parse_response(response)
+            if not params or key not in self.wallet.tokens:
+                return
             token = self.wallet.tokens[key]
-            if token and token.balance != result:
+            if token.balance != result:
+                # only changed tokens are put, and written
                 token = token._replace(balance=result)
                 self.wallet.tokens[key] = token
                 # self.network.trigger_callback('on_token')
+            if height is not None:
+                self.balance_heights[key] = height
+            elif stale:
+                self.get_token_balance(token)
         except (BaseException,) as e:
             print('token_balance_response err', e)
 
@@ -383,12 +418,12 @@ class Synchronizer(ThreadJob):
         if self.requested_token_txs:
             self.print_error("missing token txs", self.requested_token_txs)
 
+        # balances are requested with the token status
         tokens = set()
         for key in self.wallet.tokens.keys():
-            token = self.wallet.tokens[key]
-            tokens.add(token)
-            self.get_token_balance(token)
+            tokens.add(self.wallet.tokens[key])
         self.subscribe_tokens(tokens)
+        self.send_requests()
 
         self.initialized = True
 
@@ -409,7 +444,10 @@ class Synchronizer(ThreadJob):
             self.new_tokens = set()
         self.subscribe_tokens(tokens)
 
-        # 3. Detect if situation has changed
+        # 3. Send the requests of the responses handled since the last run
+        self.send_requests()
+
+        # 4. Detect if situation has changed
         up_to_date = self.is_up_to_date()
         if up_to_date != self.wallet.is_up_to_date():
             self.wallet.set_up_to_date(up_to_date)
@@ -0,0 +1,257 @@
+import os
+import shutil
+import sqlite3
+import struct
+import tempfile
+
+from lib import blockchain, constants
+from lib.qtum import (serialize_header, hash_header, deserialize_header, Header, CHUNK_SIZE,
+                      compact_from_uint256, uint256_from_compact, POW_LIMIT, POS_LIMIT)
+from lib.simple_config import SimpleConfig
+from lib.util import bfh
+
+from . import SequentialTestCase, TestCaseForTestnet
+
+
+def make_headers(count, start_height=0, prev_hash='00' * 32):
+    headers = []
+    for height in range(start_height, start_height + count):
+        header = {
+            'block_height': height,
+            'version': 536870912,
+            'prev_block_hash': prev_hash,
+            'merkle_root': '%064x' % height,
+            'timestamp': 1504695029 + height * 128,
+            'bits': 0x1f00ffff,
+            'nonce': height,
+            'hash_state_root': '00' * 32,
+            'hash_utxo_root': '00' * 32,
+            'hash_prevout_stake': '00' * 32,
+            'hash_prevout_n': 0xffffffff,
+            'sig': '',
+        }
+        headers.append(header)
+        prev_hash = hash_header(header)
+    return headers
+
+
+class TestBlockchain(TestCaseForTestnet):
+
+    def setUp(self):
+        super().setUp()
+        self.electrum_dir = tempfile.mkdtemp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_dir})
+        blockchain.header_cache.clear()
+        self.chain = blockchain.Blockchain(self.config, 0, None)
+        blockchain.blockchains = {0: self.chain}
+
+    def tearDown(self):
+        blockchain.close_header_dbs()
+        blockchain.blockchains = {}
+        shutil.rmtree(self.electrum_dir)
+        super().tearDown()
+
+    def test_read_header_is_cached(self):
+        headers = make_headers(10)
+        for header in headers:
+            self.chain.write(bfh(serialize_header(header)), header['block_height'])
+        stats = self.chain.get_cache_stats()
+        self.assertEqual(self.chain.read_header(5), self.chain.read_header(5))
+        self.assertEqual(hash_header(headers[5]), hash_header(self.chain.read_header(5)))
+        new_stats = self.chain.get_cache_stats()
+        self.assertEqual(stats['misses'] + 1, new_stats['misses'])
+        self.assertEqual(stats['hits'] + 2, new_stats['hits'])
+
+    def test_write_invalidates_cached_header(self):
+        headers = make_headers(3)
+        for header in headers:
+            self.chain.write(bfh(serialize_header(header)), header['block_height'])
+        self.assertEqual(1, self.chain.read_header(1)['nonce'])
+        replacement = dict(headers[1], nonce=42)
+        self.chain.write(bfh(serialize_header(replacement)), 1)
+        self.assertEqual(42, self.chain.read_header(1)['nonce'])
+
+    def test_cache_is_bounded(self):
+        cache = blockchain.HeaderCache(max_size=2)
+        cache.put(0, 1, 'a')
+        cache.put(0, 2, 'b')
+        cache.get(0, 1)
+        cache.put(0, 3, 'c')
+        self.assertEqual('a', cache.get(0, 1))
+        self.assertIsNone(cache.get(0, 2))
+        self.assertEqual(2, cache.get_stats()['size'])
+
+    def test_size_is_tracked_incrementally(self):
+        headers = make_headers(5)
+        for header in headers:
+            self.chain.save_header(header)
+        self.assertEqual(4, self.chain.height())
+        # rewriting an existing height does not change the size
+        self.chain.write(bfh(serialize_header(headers[2])), 2)
+        self.assertEqual(4, self.chain.height())
+        self.chain.delete(4)
+        self.assertEqual(3, self.chain.height())
+        self.chain.update_size()
+        self.assertEqual(3, self.chain.height())
+        self.chain.save_chunk(0, [bfh(serialize_header(h)) for h in make_headers(10)])
+        self.assertEqual(9, self.chain.height())
+        self.chain.delete_all()
+        self.assertEqual(-1, self.chain.height())
+
+    def test_swap_with_longer_fork(self):
+        main_headers = make_headers(10)
+        for header in main_headers:
+            self.chain.save_header(header)
+        fork_headers = make_headers(8, 5, hash_header(main_headers[4]))
+        for header in fork_headers:
+            header['nonce'] += 1000
+        fork = blockchain.Blockchain(self.config, 5, 0)
+        blockchain.blockchains[5] = fork
+        for header in fork_headers[:5]:
+            fork.save_header(header)
+        self.assertEqual(9, self.chain.height())
+        self.assertEqual(9, fork.height())
+        self.assertEqual(hash_header(main_headers[7]), self.chain.get_hash(7))
+        fork.save_header(fork_headers[5])
+        # the longer fork is now the main chain, the old main branch the fork
+        self.assertEqual(10, self.chain.height())
+        self.assertEqual(9, fork.height())
+        for header in fork_headers[:6]:
+            self.assertEqual(hash_header(header), self.chain.get_hash(header['block_height']))
+        for header in main_headers[5:]:
+            self.assertEqual(hash_header(header), fork.get_hash(header['block_height']))
+        self.assertEqual(hash_header(main_headers[4]), fork.get_hash(4))
+        self.assertTrue(self.chain.is_valid())
+        self.assertTrue(fork.is_valid())
+        # writes to the fork after the swap land on the new branch
+        self.chain.save_header(fork_headers[6])
+        self.assertEqual(11, self.chain.height())
+        self.chain.flush()
+        self.assertEqual([(5, 0)], self.chain.db.get_branches())
+
+    def test_swap_moves_forks_of_moved_rows(self):
+        for header in make_headers(10):
+            self.chain.save_header(header)
+        fork = blockchain.Blockchain(self.config, 5, 0)
+        sub_fork = blockchain.Blockchain(self.config, 8, 0)
+        blockchain.blockchains.update({5: fork, 8: sub_fork})
+        for header in make_headers(6, 5):
+            header['nonce'] += 1000
+            fork.write(bfh(serialize_header(header)), header['block_height'])
+        fork.swap_with_parent()
+        self.assertEqual(10, self.chain.height())
+        # sub_fork branched off the rows that now belong to fork
+        self.assertEqual(5, sub_fork.parent_id)
+        self.assertIn((8, 5), self.chain.db.get_branches())
+
+    def test_migrate_single_table_db(self):
+        electrum_dir = tempfile.mkdtemp()
+        try:
+            config = SimpleConfig({'electrum_path': electrum_dir})
+            path = os.path.join(electrum_dir, 'blockchain_headers')
+            headers = make_headers(3)
+            conn = sqlite3.connect(path)
+            conn.execute('CREATE TABLE header (height INT PRIMARY KEY NOT NULL, data BLOB NOT NULL)')
+            conn.executemany('INSERT INTO header VALUES (?,?)',
+                             [(h['block_height'], bfh(serialize_header(h))) for h in headers])
+            conn.commit()
+            conn.close()
+            chain = blockchain.Blockchain(config, 0, None)
+            self.assertEqual(path, chain.path())
+            self.assertEqual(2, chain.height())
+            self.assertEqual(hash_header(headers[2]), hash_header(chain.read_header(2)))
+            blockchain.close_header_dbs()
+        finally:
+            shutil.rmtree(electrum_dir)
+
+
+class TestHeader(TestCaseForTestnet):
+
+    def test_header_is_dict_compatible(self):
+        header = make_headers(2)[1]
+        header['sig'] = 'ab' * 72
+        raw = bfh(serialize_header(header))
+        h = deserialize_header(raw, 1)
+        self.assertIsInstance(h, Header)
+        self.assertEqual(header, h.to_dict())
+        self.assertEqual(header['bits'], h['bits'])
+        self.assertEqual(header['prev_block_hash'], h.get('prev_block_hash'))
+        self.assertIsNone(h.get('unknown'))
+        self.assertEqual(set(header), set(h))
+        self.assertEqual(h, header)
+
+    def test_header_hash_uses_raw_bytes(self):
+        header = make_headers(1)[0]
+        raw = bfh(serialize_header(header))
+        h = deserialize_header(memoryview(raw), 0)
+        self.assertEqual(hash_header(header), hash_header(h))
+        self.assertEqual(serialize_header(header), serialize_header(h))
+
+
+def mine_headers(count):
+    """ headers with valid proof of work for bits 0x1f00ffff """
+    raws = []
+    prev_hash = '00' * 32
+    for header in make_headers(count):
+        header['prev_block_hash'] = prev_hash
+        raw = bytearray(bfh(serialize_header(header)))
+        nonce = 0
+        while True:
+            struct.pack_into('<I', raw, 76, nonce)
+            h = Header(bytes(raw), header['block_height'])
+            if int.from_bytes(h.hash_bytes(), 'little') <= POW_LIMIT:
+                break
+            nonce += 1
+        raws.append(h.raw)
+        prev_hash = h.get_hash()
+    return raws
+
+
+class TestVerifyChunk(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.electrum_dir = tempfile.mkdtemp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_dir})
+        blockchain.header_cache.clear()
+        self.chain = blockchain.Blockchain(self.config, 0, None)
+        blockchain.blockchains = {0: self.chain}
+
+    def tearDown(self):
+        blockchain.close_header_dbs()
+        blockchain.blockchains = {}
+        shutil.rmtree(self.electrum_dir)
+        super().tearDown()
+
+    def test_compact_targets(self):
+        self.assertEqual(constants.net.GENESIS_BITS, compact_from_uint256(POW_LIMIT))
+        self.assertEqual(0x1d00ffff, compact_from_uint256(POS_LIMIT))
+        for target in (0, 1, 0x7fffff, 0x800000, POS_LIMIT // 3, POW_LIMIT - 1):
+            bits = compact_from_uint256(target)
+            self.assertEqual(bits, compact_from_uint256(uint256_from_compact(bits)))
+
+    def test_synthetic_genesis_does_not_match_checkpoint(self):
+        raws = mine_headers(3)
+        self.assertIn('0', self.chain.checkpoints)
+        self.assertFalse(self.chain.connect_chunk(0, ''.join(r.hex() for r in raws)))
+        self.assertEqual(-1, self.chain.height())
+
+    def test_verify_chunk_with_proof_of_work(self):
+        raws = mine_headers(3)
+        self.chain.checkpoints = {'2': Header(raws[2], 2).get_hash()}
+        self.assertTrue(self.chain.connect_chunk(0, ''.join(r.hex() for r in raws)))
+        self.assertEqual(2, self.chain.height())
+        self.assertEqual(self.chain.checkpoints['2'], self.chain.get_hash(2))
+
+    def test_verify_chunk_rejects_bad_links(self):
+        raws = mine_headers(3)
+        self.chain.checkpoints = {}
+        with self.assertRaises(Exception):
+            self.chain.verify_chunk(0, [raws[0], raws[2]])
+        with self.assertRaises(Exception):
+            self.chain.verify_chunk(0, [raws[0], raws[1], raws[1]])
+        bad_bits = bytearray(raws[1])
+        struct.pack_into('<I', bad_bits, 72, 0x1d00ffff)
+        with self.assertRaises(Exception):
+            self.chain.verify_chunk(0, [raws[0], bytes(bad_bits)])
+        self.chain.verify_chunk(0, raws)
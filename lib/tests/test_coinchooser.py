@@ -0,0 +1,70 @@
+from lib import keystore
+from lib.coinchooser import CoinChooserBranchAndBound, CoinChooserOldestFirst, branch_and_bound
+from lib.qtum import pubkey_to_address, TYPE_ADDRESS
+from lib.util import NotEnoughFunds
+
+from . import SequentialTestCase
+
+
+SEED_WORDS = 'treat dwarf wealth gasp brass outside high rent blood crowd make initial'
+FEE_PER_BYTE = 10
+DUST = 546
+
+
+class TestCoinChooser(SequentialTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.ks = keystore.from_bip39_seed(SEED_WORDS, '', "m/44'/88'/0'")
+        cls.address = pubkey_to_address('p2pkh', cls.ks.derive_pubkey(0, 0))
+
+    def make_coins(self, values):
+        return [{
+            'type': 'p2pkh',
+            'address': self.address,
+            'prevout_hash': '%064x' % (i + 1),
+            'prevout_n': 0,
+            'value': value,
+            'height': 1000 + i,
+            'x_pubkeys': [self.ks.get_xpubkey(0, 0)],
+            'signatures': [None],
+            'num_sig': 1,
+        } for i, value in enumerate(values)]
+
+    def make_tx(self, chooser, values, amount):
+        outputs = [(TYPE_ADDRESS, self.address, amount)]
+        return chooser.make_tx(self.make_coins(values), outputs, [self.address],
+                               lambda size: size * FEE_PER_BYTE, DUST)
+
+    def test_branch_and_bound(self):
+        self.assertEqual([0, 2], branch_and_bound([50, 40, 30, 20], 80, 80, 1000))
+        self.assertEqual([0, 3], branch_and_bound([50, 40, 30, 20], 70, 75, 1000))
+        self.assertEqual([1, 3], branch_and_bound([50, 40, 30, 20], 60, 60, 1000))
+        self.assertEqual(None, branch_and_bound([50, 40, 30, 20], 111, 115, 1000))
+        self.assertEqual(None, branch_and_bound([50, 40], 100, 100, 1000))
+        self.assertEqual([0, 1, 2], branch_and_bound([10] * 20, 30, 30, 1000))
+
+    def test_changeless_selection(self):
+        chooser = CoinChooserBranchAndBound()
+        amount = 3000000
+        # 44 bytes without inputs, 148 bytes per p2pkh input: two coins
+        # pay exactly for the output and the fee
+        fee = (44 + 2 * 148) * FEE_PER_BYTE
+        tx = self.make_tx(chooser, [10000000, 7000000, 2000000, 1000000 + fee, 400000], amount)
+        self.assertEqual(1, len(tx.outputs()))
+        self.assertEqual({2000000, 1000000 + fee}, {txin['value'] for txin in tx.inputs()})
+        self.assertEqual(fee, tx.get_fee())
+        self.assertEqual(fee, tx.estimated_size() * FEE_PER_BYTE)
+        # no exact match: the largest coins, with change
+        tx = self.make_tx(chooser, [1000000, 2500000, 700000, 400000], amount)
+        self.assertEqual([2500000, 1000000], [txin['value'] for txin in tx.inputs()])
+        self.assertEqual(2, len(tx.outputs()))
+        self.assertGreaterEqual(tx.get_fee(), tx.estimated_size() * FEE_PER_BYTE)
+        with self.assertRaises(NotEnoughFunds):
+            self.make_tx(chooser, [1000000, 1000000], amount)
+
+    def test_oldest_first(self):
+        chooser = CoinChooserOldestFirst()
+        tx = self.make_tx(chooser, [1000000, 2500000, 700000, 400000], 3000000)
+        self.assertEqual({1000000, 2500000}, {txin['value'] for txin in tx.inputs()})
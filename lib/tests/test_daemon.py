@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+
+from lib import daemon, keystore
+from lib.simple_config import SimpleConfig
+from lib.storage import WalletStorage
+from lib.wallet import Standard_Wallet
+
+from . import SequentialTestCase
+
+
+XPRV = 'xprv9y98MwME91QdYt3QofTXqSfMfB4iGHYJzb1TDnGSsaiNKdMdbPFB5pMrWzpAkqfPw4dLsECc4rWSttmXxBUNHAfMaRzYreN4tkqYy5HudnG'
+
+
+class TestDaemonRPC(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.wallet_path = os.path.join(self.tmp_dir, 'wallet')
+        storage = WalletStorage(self.wallet_path)
+        storage.put('keystore', keystore.from_xprv(XPRV).dump())
+        Standard_Wallet(storage).storage.write()
+        self.config = SimpleConfig({'electrum_path': self.tmp_dir, 'offline': True, 'verbose': False,
+                                    'rpcworkers': 2, 'rpcuser': 'user', 'rpcpassword': 'pass'})
+        fd, server = daemon.get_fd_or_server(self.config)
+        self.daemon = daemon.Daemon(self.config, fd, False)
+        self.daemon.start()
+        self.server = daemon.get_server(self.config)
+
+    def tearDown(self):
+        if self.daemon.is_running():
+            self.daemon.stop()
+        self.daemon.join()
+        shutil.rmtree(self.tmp_dir)
+        super().tearDown()
+
+    def options(self, **kwargs):
+        options = {'wallet_path': self.wallet_path, 'cwd': self.tmp_dir, 'verbose': False}
+        options.update(kwargs)
+        return options
+
+    def test_wallet_writes_reach_disk(self):
+        self.assertTrue(self.server.daemon(self.options(subcommand='load_wallet')))
+        result = self.server.run_cmdline(self.options(cmd='password', password=None, new_password='pw'))
+        self.assertEqual({'password': True}, result)
+        storage = WalletStorage(self.wallet_path)
+        self.assertTrue(storage.get('use_encryption'))
+        self.assertNotEqual(XPRV, storage.get('keystore')['xprv'])
+        # changes that are only written when the wallet is closed reach disk too
+        txid = '00' * 32
+        self.server.run_cmdline(self.options(cmd='setlabel', key=txid, label='rent'))
+        self.assertNotIn(txid, WalletStorage(self.wallet_path).get('labels', {}))
+        self.assertTrue(self.server.daemon(self.options(subcommand='close_wallet')))
+        self.assertEqual('rent', WalletStorage(self.wallet_path).get('labels', {}).get(txid))
@@ -1,3 +1,5 @@
+import json
+import socket
 import unittest
 
 from lib import interface
@@ -23,3 +25,61 @@ class TestInterface(SequentialTestCase):
         self.assertTrue(i.check_host_name(
             peercert={'subject': [('commonName', 'foo.bar.com')]},
             name='foo.bar.com'))
+
+
+class TestInterfaceRequests(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.sock, self.server_sock = socket.socketpair()
+        self.interface = interface.Interface('localhost:50001:t', self.sock)
+        self.server_sock.settimeout(1)
+
+    def tearDown(self):
+        self.interface.close()
+        self.server_sock.close()
+        super().tearDown()
+
+    def read_lines(self):
+        data = b''
+        while not data.endswith(b'\n'):
+            data += self.server_sock.recv(65536)
+        return [json.loads(line) for line in data.decode('utf8').splitlines()]
+
+    def reply(self, message):
+        self.server_sock.sendall((json.dumps(message) + '\n').encode('utf8'))
+
+    def test_requests_are_sent_as_batch(self):
+        # nothing is batched before the server version is known
+        self.interface.queue_request('server.version', ['x', '1.2'], 0)
+        self.interface.queue_request('blockchain.headers.subscribe', [True], 1)
+        self.interface.send_requests()
+        self.assertEqual(2, len(self.read_lines()))
+        self.interface.server_version = ['MockX 1.0', '1.2']
+        for i in range(2, 5):
+            self.interface.queue_request('blockchain.transaction.get', ['%064x' % i], i)
+        self.interface.send_requests()
+        lines = self.read_lines()
+        self.assertEqual(1, len(lines))
+        self.assertEqual([2, 3, 4], [r['id'] for r in lines[0]])
+        self.reply([{'id': i, 'result': 'ab'} for i in (4, 2, 3)])
+        responses = []
+        while len(responses) < 3:
+            responses += self.interface.get_responses()
+        self.assertEqual([4, 2, 3], [request[2] for request, response in responses])
+        self.assertEqual({0, 1}, set(self.interface.unanswered_requests))
+
+    def test_window_follows_latency(self):
+        self.interface.unsent_requests = [('blockchain.transaction.get', ['00'], 0)] * 1000
+        self.assertEqual(interface.INITIAL_WINDOW, self.interface.num_requests())
+        for i in range(50):
+            self.interface.on_latency(0.01)
+        self.assertEqual(interface.INITIAL_WINDOW + 50, self.interface.window)
+        self.interface.on_latency(10)
+        self.assertEqual((interface.INITIAL_WINDOW + 50) // 2, self.interface.window)
+        for i in range(10):
+            self.interface.on_latency(10)
+        self.assertEqual(interface.MIN_WINDOW, self.interface.window)
+        self.interface.unsent_requests = []
+        self.interface.on_latency(0.01)
+        self.assertEqual(interface.MIN_WINDOW, self.interface.window)
@@ -0,0 +1,81 @@
+import base64
+import http.client
+import json
+import threading
+import time
+
+from lib.jsonrpc import VerifyingJSONRPCServer
+
+from . import SequentialTestCase
+
+
+class TestVerifyingJSONRPCServer(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server = VerifyingJSONRPCServer(('127.0.0.1', 0), logRequests=False,
+                                             rpc_user='user', rpc_password='pass', num_workers=2)
+        self.server.register_function(lambda x: x * 2, 'double')
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.start()
+        host, port = self.server.server_address
+        self.conn = http.client.HTTPConnection(host, port, timeout=5)
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        for t in self.server.workers:
+            t.join()
+        super().tearDown()
+
+    def post(self, data, credentials='user:pass', conn=None):
+        conn = conn or self.conn
+        auth = 'Basic ' + base64.b64encode(credentials.encode()).decode()
+        conn.request('POST', '/', json.dumps(data), {'Authorization': auth,
+                                                          'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        body = response.read()
+        return response.status, json.loads(body.decode()) if response.status == 200 else None
+
+    def test_batch_on_kept_alive_connection(self):
+        batch = [{'jsonrpc': '2.0', 'id': i, 'method': 'double', 'params': [i]} for i in range(5)]
+        for i in range(3):
+            status, result = self.post(batch)
+            self.assertEqual(200, status)
+            self.assertEqual([i * 2 for i in range(5)],
+                             [r['result'] for r in sorted(result, key=lambda r: r['id'])])
+        sock = self.conn.sock
+        status, result = self.post({'jsonrpc': '2.0', 'id': 7, 'method': 'double', 'params': [21]})
+        self.assertEqual(42, result['result'])
+        # the same connection served all the requests
+        self.assertIs(sock, self.conn.sock)
+
+    def test_idle_connections_do_not_hold_workers(self):
+        host, port = self.server.server_address
+        conns = [http.client.HTTPConnection(host, port, timeout=5) for i in range(3)]
+        for conn in conns:
+            self.addCleanup(conn.close)
+        call = {'jsonrpc': '2.0', 'id': 1, 'method': 'double', 'params': [1]}
+        # as many idle kept alive connections as workers
+        for conn in conns[:2]:
+            self.assertEqual(2, self.post(call, conn=conn)[1]['result'])
+        t0 = time.time()
+        self.assertEqual(2, self.post(call, conn=conns[2])[1]['result'])
+        self.assertLess(time.time() - t0, 1)
+        for conn in conns:
+            sock = conn.sock
+            self.assertEqual(2, self.post(call, conn=conn)[1]['result'])
+            self.assertIs(sock, conn.sock)
+
+    def test_idle_connection_closed_after_keepalive(self):
+        self.server.keepalive = 0.1
+        self.post({'jsonrpc': '2.0', 'id': 1, 'method': 'double', 'params': [1]})
+        # closed by the server, well before the client timeout
+        self.assertEqual(b'', self.conn.sock.recv(1))
+
+    def test_bad_credentials(self):
+        status, result = self.post({'jsonrpc': '2.0', 'id': 1, 'method': 'double', 'params': [1]},
+                                   credentials='user:wrong')
+        self.assertEqual(401, status)
@@ -0,0 +1,125 @@
+from lib.netcache import NetworkCache
+from lib.transaction import Transaction
+
+from . import SequentialTestCase
+
+
+RAW_TX = ('0100000001d04069de4a1e5c166e3fd30bb3a76b4606010ff447dce4d1989301b97f96a242000000006a47304402204f193d69a06ee58a1894b'
+          '42168c3fc11d36d578645e47f117a0f1936d6aff5ed022026505b6ea4b344a533d97fbd9ab28fa844d5ab777979088c6267efe71262df9e0121'
+          '031ed1acd7c54f1c8efd3f038819da1e300ac0fdc499fb8bdf743e52f243141cf1feffffff0210270000000000001976a9140a154c00d8a50b7c2'
+          '336dafe42700e614f46b71488acec1f9400000000001976a9148f72f5aa0234ecc8a0d629845969c89319f3a78588ac00000000')
+TXID = Transaction(RAW_TX).txid()
+
+
+class FakeBlockchain(object):
+
+    def __init__(self):
+        self.headers = {}
+
+    def read_header(self, height):
+        return self.headers.get(height)
+
+
+class FakeNetwork(object):
+
+    def __init__(self):
+        self.requests = []
+        self.subscriptions = {}
+        self.chain = FakeBlockchain()
+        self.balance = {'confirmed': 100, 'unconfirmed': 0}
+
+    def blockchain(self):
+        return self.chain
+
+    def get_transaction(self, txid):
+        self.requests.append(('transaction', txid))
+        return RAW_TX
+
+    def get_merkle_for_transaction(self, txid, height):
+        self.requests.append(('merkle', txid))
+        return {'block_height': height, 'merkle': [], 'pos': 0}
+
+    def get_balance_for_scripthash(self, scripthash):
+        self.requests.append(('balance', scripthash))
+        return dict(self.balance)
+
+    def subscribe_to_scripthash(self, scripthash, callback):
+        self.subscriptions[scripthash] = callback
+
+    def unsubscribe_from_scripthash(self, scripthash, callback):
+        del self.subscriptions[scripthash]
+
+    def notify(self, scripthash, status):
+        self.subscriptions[scripthash]({'params': [scripthash], 'result': status})
+
+
+class TestNetworkCache(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.network = FakeNetwork()
+        self.cache = NetworkCache(self.network, max_size=2, ttl=60)
+
+    def test_transactions(self):
+        self.assertEqual(RAW_TX, self.cache.get_transaction(TXID))
+        self.assertEqual(RAW_TX, self.cache.get_transaction(TXID))
+        self.assertEqual([('transaction', TXID)], self.network.requests)
+        # the raw tx does not hash to the txid
+        self.cache.get_transaction('00' * 32)
+        self.cache.get_transaction('00' * 32)
+        self.assertEqual(3, len(self.network.requests))
+        stats = self.cache.get_stats()['transaction']
+        self.assertEqual((1, 1, 3), (stats['entries'], stats['hits'], stats['misses']))
+
+    def test_merkle(self):
+        # the header is not known yet
+        self.cache.get_merkle_for_transaction(TXID, 10)
+        self.network.chain.headers[10] = {'merkle_root': TXID}
+        self.cache.get_merkle_for_transaction(TXID, 10)
+        self.assertEqual(0, self.cache.get_merkle_for_transaction(TXID, 10)['pos'])
+        self.assertEqual(2, len(self.network.requests))
+        # reorganized
+        self.network.chain.headers[10] = {'merkle_root': '00' * 32}
+        self.cache.get_merkle_for_transaction(TXID, 10)
+        self.assertEqual(3, len(self.network.requests))
+        self.assertEqual(0, self.cache.get_stats()['merkle']['entries'])
+
+    def test_scripthash_invalidated_by_status(self):
+        self.cache.get_balance_for_scripthash('a')
+        self.network.notify('a', 'status1')
+        self.assertEqual({'confirmed': 100, 'unconfirmed': 0}, self.cache.get_balance_for_scripthash('a'))
+        self.assertEqual(1, len(self.network.requests))
+        self.network.balance['confirmed'] = 200
+        self.network.notify('a', 'status2')
+        self.assertEqual(200, self.cache.get_balance_for_scripthash('a')['confirmed'])
+        self.assertEqual(2, len(self.network.requests))
+
+    def test_scripthash_ttl_and_eviction(self):
+        self.cache.get_balance_for_scripthash('a')
+        self.cache.get_balance_for_scripthash('b')
+        self.cache.get_balance_for_scripthash('a')
+        # 'b' is the least recently used
+        self.cache.get_balance_for_scripthash('c')
+        self.cache.get_balance_for_scripthash('a')
+        self.assertEqual(3, len(self.network.requests))
+        self.cache.get_balance_for_scripthash('b')
+        self.assertEqual(4, len(self.network.requests))
+        self.cache.ttl = 0
+        self.cache.get_balance_for_scripthash('x')
+        self.cache.get_balance_for_scripthash('x')
+        self.assertEqual(6, len(self.network.requests))
+        stats = self.cache.get_stats()['balance']
+        self.assertEqual((2, 6), (stats['hits'], stats['misses']))
+
+    def test_subscriptions_are_bounded(self):
+        for scripthash in 'abcd':
+            self.cache.get_balance_for_scripthash(scripthash)
+        self.assertEqual({'c', 'd'}, set(self.network.subscriptions))
+        self.assertEqual(['c', 'd'], list(self.cache.subscribed))
+        # a status of an unsubscribed scripthash is ignored
+        self.cache.on_status({'params': ['a'], 'result': 'status1'})
+        self.assertNotIn('a', self.cache.statuses)
+        # 'a' is subscribed again, and its result requested again
+        self.cache.get_balance_for_scripthash('a')
+        self.assertEqual({'d', 'a'}, set(self.network.subscriptions))
+        self.assertEqual(5, len(self.network.requests))
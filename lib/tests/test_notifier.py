@@ -0,0 +1,173 @@
+import http.server
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+from lib.bitcoin import address_to_scripthash, hash160_to_p2pkh
+from lib.notifier import Notifier
+
+from . import SequentialTestCase
+
+
+ADDRESSES = [hash160_to_p2pkh(bytes([i]) * 20) for i in range(101)]
+OTHER = ADDRESSES.pop()
+
+
+class FakeNetwork(object):
+
+    def __init__(self):
+        self.subscribed = []
+        self.callback = None
+
+    def subscribe_to_addresses(self, addresses, callback):
+        for address in addresses:
+            address_to_scripthash(address)
+        self.subscribed.extend(addresses)
+        self.callback = callback
+
+    def notify(self, address, status):
+        self.callback({'params': [address], 'result': status})
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    """ Records the bodies posted to it, failing the first failures
+    requests with a 500 """
+
+    def __init__(self, failures=0, port=0):
+        self.received = []
+        self.failures = failures
+        self.connections = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(myself):
+                with server.lock:
+                    server.connections += 1
+                super().setup()
+
+            def do_POST(myself):
+                body = myself.rfile.read(int(myself.headers['Content-Length']))
+                with server.lock:
+                    failed = server.failures > 0
+                    if failed:
+                        server.failures -= 1
+                    else:
+                        server.received.append(json.loads(body.decode()))
+                myself.send_response(500 if failed else 200)
+                myself.send_header('Content-Length', '0')
+                myself.end_headers()
+
+            def log_message(myself, *args):
+                pass
+
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.url = 'http://127.0.0.1:%d/hook' % self.server_address[1]
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+class TestNotifier(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'notify_db')
+        self.network = FakeNetwork()
+        self.notifier = None
+
+    def tearDown(self):
+        self.stop_notifier()
+        shutil.rmtree(self.tmp_dir)
+        super().tearDown()
+
+    def start_notifier(self):
+        self.notifier = Notifier(self.network, self.path, num_workers=2, timeout=1, backoff=0.05)
+        self.notifier.start()
+
+    def stop_notifier(self):
+        if self.notifier:
+            self.notifier.stop()
+            self.notifier.join()
+            self.notifier = None
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertTrue(condition())
+
+    def test_delivery_with_retries(self):
+        stub = StubServer(failures=2)
+        self.addCleanup(stub.close)
+        self.start_notifier()
+        addresses = ADDRESSES
+        self.assertEqual(100, self.notifier.watch(addresses, stub.url))
+        self.assertEqual(0, self.notifier.watch(addresses[:10], stub.url))
+        self.assertEqual(set(addresses), set(self.network.subscribed))
+        for address in addresses:
+            self.network.notify(address, 'status1')
+        # unchanged status, unwatched address
+        self.network.notify(addresses[0], 'status1')
+        self.network.notify(OTHER, 'status1')
+        self.wait_for(lambda: len(stub.received) == 100)
+        self.wait_for(lambda: self.notifier.get_pending() == 0)
+        self.assertEqual({(a, 'status1') for a in addresses},
+                         {(r['address'], r['status']) for r in stub.received})
+        self.assertEqual(100, len(stub.received))
+        # one connection per worker
+        self.assertLessEqual(stub.connections, 2)
+        self.assertEqual(1, self.notifier.unwatch([addresses[1]], stub.url))
+        self.network.notify(addresses[1], 'status2')
+        self.network.notify(addresses[2], 'status2')
+        self.wait_for(lambda: len(stub.received) == 101)
+        self.assertEqual({'address': addresses[2], 'status': 'status2'}, stub.received[-1])
+
+    def test_outbox_survives_restart(self):
+        stub = StubServer()
+        port, url = stub.server_address[1], stub.url
+        stub.close()
+        self.start_notifier()
+        addr0, addr1 = ADDRESSES[:2]
+        self.notifier.watch([addr0, addr1], url)
+        self.network.notify(addr0, 'status1')
+        self.wait_for(lambda: self.notifier.get_pending() == 1)
+        self.stop_notifier()
+        # the watch list and the last statuses are kept too
+        self.network = FakeNetwork()
+        self.start_notifier()
+        self.assertEqual({addr0, addr1}, set(self.network.subscribed))
+        self.network.notify(addr0, 'status1')
+        stub = StubServer(port=port)
+        self.addCleanup(stub.close)
+        self.wait_for(lambda: len(stub.received) == 1)
+        self.wait_for(lambda: self.notifier.get_pending() == 0)
+        self.assertEqual([{'address': addr0, 'status': 'status1'}], stub.received)
+
+    def test_invalid_address(self):
+        self.start_notifier()
+        url = 'http://127.0.0.1:1/hook'
+        with self.assertRaises(Exception):
+            self.notifier.watch([ADDRESSES[0], 'notanaddress'], url)
+        self.assertEqual([], self.network.subscribed)
+        self.stop_notifier()
+        # rows written before addresses were validated
+        db = sqlite3.connect(self.path)
+        db.execute('INSERT INTO watch VALUES (?,?)', ('notanaddress', url))
+        db.commit()
+        db.close()
+        self.start_notifier()
+        self.assertEqual([], self.network.subscribed)
+        self.assertEqual(1, self.notifier.watch([ADDRESSES[0]], url))
+        self.assertEqual([ADDRESSES[0]], self.network.subscribed)
@@ -110,6 +110,17 @@ class Test_SimpleConfig(SequentialTestCase):
         result.pop('config_version', None)
         self.assertEqual({"something": "a"}, result)
 
+    def test_trace_path(self):
+        read_user_dir = lambda : self.user_dir
+        config = SimpleConfig(options=self.options,
+                              read_user_config_function=lambda _: {},
+                              read_user_dir_function=read_user_dir)
+        self.assertIsNone(config.get_trace_path())
+        config.set_key("trace", True)
+        self.assertEqual(os.path.join(self.electrum_dir, "trace.log"), config.get_trace_path())
+        config.set_key("trace_file", "/tmp/qtum_trace.log")
+        self.assertEqual("/tmp/qtum_trace.log", config.get_trace_path())
+
 
 class TestUserConfig(SequentialTestCase):
 
@@ -0,0 +1,142 @@
+from lib.qtum import hash160_to_p2pkh
+from lib.synchronizer import Synchronizer
+from lib.tokens import Token
+from lib.transaction import Transaction
+
+from . import SequentialTestCase
+
+
+RAW_TX = ('0100000001d04069de4a1e5c166e3fd30bb3a76b4606010ff447dce4d1989301b97f96a242000000006a47304402204f193d69a06ee58a1894b'
+          '42168c3fc11d36d578645e47f117a0f1936d6aff5ed022026505b6ea4b344a533d97fbd9ab28fa844d5ab777979088c6267efe71262df9e0121'
+          '031ed1acd7c54f1c8efd3f038819da1e300ac0fdc499fb8bdf743e52f243141cf1feffffff0210270000000000001976a9140a154c00d8a50b7c2'
+          '336dafe42700e614f46b71488acec1f9400000000001976a9148f72f5aa0234ecc8a0d629845969c89319f3a78588ac00000000')
+TXID = Transaction(RAW_TX).txid()
+
+
+class FakeNetwork(object):
+
+    def __init__(self):
+        self.sent = []
+        self.callbacks = []
+        self.height = 100
+
+    def send(self, messages, callback):
+        self.sent.append(list(messages))
+
+    def request_address_histories(self, addresses, callback):
+        self.send([('blockchain.scripthash.get_history', [a]) for a in addresses], callback)
+
+    def get_transactions(self, transaction_hashes, callback):
+        self.send([('blockchain.transaction.get', [h]) for h in transaction_hashes], callback)
+
+    def get_transactions_receipt(self, tx_hashs, callback):
+        self.send([('blochchain.transaction.get_receipt', [h]) for h in tx_hashs], callback)
+
+    def subscribe_to_addresses(self, addresses, callback):
+        pass
+
+    def subscribe_tokens(self, tokens, callback):
+        pass
+
+    def request_token_history(self, token, callback):
+        self.send([('blockchain.contract.event.get_history', [token.bind_addr, token.contract_addr])], callback)
+
+    def request_token_balances(self, tokens, callback):
+        self.send([('blockchain.contract.call', [t.contract_addr, '70a08231' + t.bind_addr]) for t in tokens], callback)
+
+    def get_local_height(self):
+        return self.height
+
+    def trigger_callback(self, event, *args):
+        self.callbacks.append(event)
+
+
+class FakeWallet(object):
+
+    def __init__(self, history, token_history):
+        self.history = history
+        self.token_history = token_history
+        self.transactions = {}
+        self.token_txs = {}
+        self.tx_receipt = {}
+        self.tokens = {}
+        self.synchronizer = None
+        self.received = []
+
+    def get_addresses(self):
+        return list(self.history)
+
+    def receive_tx_callback(self, tx_hash, tx, tx_height):
+        self.received.append(('tx', tx_hash, tx_height))
+
+    def receive_token_tx_callback(self, tx_hash, tx, tx_height):
+        self.received.append(('token_tx', tx_hash, tx_height))
+
+
+class TestSynchronizer(SequentialTestCase):
+
+    def test_missing_txs_are_requested_once(self):
+        other = '%064x' % 1
+        wallet = FakeWallet({'a1': [(TXID, 10), (other, 11)], 'a2': [(TXID, 10)]},
+                            {'c_a1': [(TXID, 10, 0)]})
+        network = FakeNetwork()
+        s = Synchronizer(wallet, network)
+        wallet.synchronizer = s
+        requested = [params[0] for messages in network.sent for method, params in messages
+                     if method == 'blockchain.transaction.get']
+        self.assertEqual(sorted([TXID, other]), sorted(requested))
+        self.assertEqual({TXID: 10}, s.requested_token_txs)
+        s.on_tx_response({'params': [TXID], 'result': RAW_TX})
+        self.assertEqual([('tx', TXID, 10), ('token_tx', TXID, 10)], wallet.received)
+        self.assertEqual({other: 11}, s.requested_tx)
+        self.assertEqual({}, s.requested_token_txs)
+
+    def test_histories_are_requested_on_run(self):
+        wallet = FakeWallet({}, {})
+        network = FakeNetwork()
+        s = Synchronizer(wallet, network)
+        wallet.synchronizer = s
+        for addr in ('a1', 'a2', 'a3'):
+            s.on_address_status({'params': [addr], 'result': 'ab' * 32})
+        self.assertEqual([], network.sent)
+        s.send_requests()
+        self.assertEqual([[('blockchain.scripthash.get_history', [a]) for a in ('a1', 'a2', 'a3')]], network.sent)
+
+    def test_token_balances_are_batched_and_cached(self):
+        wallet = FakeWallet({}, {})
+        bind_addr = hash160_to_p2pkh(bytes(20))
+        hash160 = '00' * 20
+        for i in range(3):
+            contract = '%040x' % (i + 1)
+            wallet.tokens['{}_{}'.format(contract, bind_addr)] = Token(contract, bind_addr, 'T', 'T', 8, 0)
+        network = FakeNetwork()
+        s = Synchronizer(wallet, network)
+        wallet.synchronizer = s
+        self.assertEqual([], network.sent)
+
+        def status(i, result=None):
+            s.on_token_status({'params': [hash160, '%040x' % (i + 1)], 'result': result})
+
+        def balances():
+            s.send_requests()
+            sent = network.sent
+            network.sent = []
+            return [params[0] for messages in sent for method, params in messages
+                    if method == 'blockchain.contract.call']
+
+        for i in range(3):
+            status(i)
+        self.assertEqual(['%040x' % (i + 1) for i in range(3)], balances())
+        # in flight
+        status(0)
+        self.assertEqual([], balances())
+        for i in range(3):
+            s.on_token_balance_response({'params': ['%040x' % (i + 1), hash160], 'result': 10 * i})
+        self.assertEqual([0, 10, 20], [t.balance for t in wallet.tokens.values()])
+        # cached for the current height, unless the history changed
+        status(0)
+        status(1, 'ab' * 32)
+        self.assertEqual(['%040x' % 2], balances())
+        network.height += 1
+        status(0)
+        self.assertEqual(['%040x' % 1], balances())
@@ -1,7 +1,7 @@
 import unittest
 
 from lib import transaction
-from lib.qtum import TYPE_ADDRESS
+from lib.qtum import TYPE_ADDRESS, TYPE_SCRIPT, Hash
 from lib.keystore import xpubkey_to_address
 from lib.util import bh2u, bfh
 
@@ -139,6 +139,62 @@ class TestTransaction(SequentialTestCase):
         self.assertEqual(tx.estimated_weight(), 561)
         self.assertEqual(tx.estimated_size(), 141)
 
+    def _bip143_native_p2wpkh_tx(self):
+        # native P2WPKH example of BIP143
+        inputs = [{
+            'type': 'p2pk',
+            'prevout_hash': '9f96ade4b41d5433f4eda31e1738ec2b36f6e7d1420d94a6af99801a88f7f7ff',
+            'prevout_n': 0,
+            'sequence': 0xffffffee,
+        }, {
+            'type': 'p2wpkh',
+            'prevout_hash': '8ac60eb9575db5b2d987e29f301b5b819ea83a5c6579d282d189cc04b8e151ef',
+            'prevout_n': 1,
+            'sequence': 0xffffffff,
+            'value': 600000000,
+            'pubkeys': ['025476c2e83188368da1ff3e292e7acafcdb3566bb0ad253f62fc70f07aeee6357'],
+            'x_pubkeys': ['025476c2e83188368da1ff3e292e7acafcdb3566bb0ad253f62fc70f07aeee6357'],
+            'signatures': [None],
+            'num_sig': 1,
+        }]
+        outputs = [(TYPE_SCRIPT, '76a9148280b37df378db99f66f85c95a783a76ac7a6d5988ac', 112340000),
+                   (TYPE_SCRIPT, '76a9143bde42dbee7e4dbe6a21b2d50ce2f0167faa815988ac', 223450000)]
+        return transaction.Transaction.from_io(inputs, outputs, locktime=17)
+
+    def test_bip143_preimage(self):
+        tx = self._bip143_native_p2wpkh_tx()
+        self.assertEqual('0100000096b827c8483d4e9b96712b6713a7b68d6e8003a781feba36c31143470b4efd3752b0a642eea2fb7ae638c36f6252b6750293dbe574a806984b8e4d8548339a3bef51e1b804cc89d182d279655c3aa89e815b1b309fe287d9b2b55d57b90ec68a010000001976a9141d0f172a0ecb48aee1be1f2687d2963ae33f71a188ac0046c32300000000ffffffff863ef3e1a92afbfdb97f31ad0fc7683ee943e9abcf2501590ff8f6551f47e5e51100000001000000',
+                         tx.serialize_preimage(1))
+        self.assertIs(tx.get_bip143_shared_fields(), tx.get_bip143_shared_fields())
+
+    def test_bip143_shared_fields_are_invalidated(self):
+        tx = self._bip143_native_p2wpkh_tx()
+        preimage = tx.serialize_preimage(1)
+        tx.set_rbf(True)
+        rbf_preimage = tx.serialize_preimage(1)
+        self.assertNotEqual(preimage, rbf_preimage)
+        tx.add_outputs([(TYPE_SCRIPT, '6a', 0)])
+        self.assertNotEqual(rbf_preimage, tx.serialize_preimage(1))
+        # same as computing the preimage after all mutations
+        fresh_tx = self._bip143_native_p2wpkh_tx()
+        fresh_tx.set_rbf(True)
+        fresh_tx.add_outputs([(TYPE_SCRIPT, '6a', 0)])
+        self.assertEqual(fresh_tx.serialize_preimage(1), tx.serialize_preimage(1))
+
+    def test_txid_is_cached_until_mutation(self):
+        tx = transaction.Transaction(signed_blob)
+        txid = tx.txid()
+        self.assertEqual(bh2u(Hash(bfh(signed_blob))[::-1]), txid)
+        self.assertEqual(txid, tx.txid())
+        self.assertEqual(txid, tx.wtxid())
+        tx.set_rbf(True)
+        rbf_txid = tx.txid()
+        self.assertNotEqual(txid, rbf_txid)
+        self.assertEqual(rbf_txid, transaction.Transaction(tx.serialize()).txid())
+        tx.locktime = 1000
+        self.assertNotEqual(rbf_txid, tx.txid())
+        self.assertEqual(tx.txid(), transaction.Transaction(tx.serialize()).txid())
+
     def test_errors(self):
         with self.assertRaises(TypeError):
             transaction.Transaction.pay_script(output_type=None, addr='')
@@ -278,6 +334,15 @@ class TestTransaction(SequentialTestCase):
         txid = 'c659729a7fea5071361c2c1a68551ca2bf77679b27086cc415adeeb03852e369'
         self._run_naive_tests_on_tx(raw_tx, txid)
 
+    def test_version_num_above_int32(self):
+        raw_tx = 'f0b47b9a01ecf5e5c3bbf2cf1f71ecdc7f708b0b222432e914b394e24aad1494a42990ddfc000000008b483045022100852744642305a99ad74354e9495bf43a1f96ded470c256cd32e129290f1fa191022030c11d294af6a61b3da6ed2c0c296251d21d113cfd71ec11126517034b0dcb70014104a0fe6e4a600f859a0932f701d3af8e0ecd4be886d91045f06a5a6b931b95873aea1df61da281ba29cadb560dad4fc047cf47b4f7f2570da4c0b810b3dfa7e500ffffffff0240420f00000000001976a9147eeacb8a9265cd68c92806611f704fc55a21e1f588ac05f00d00000000001976a914eb3bd8ccd3ba6f1570f844b59ba3e0a667024a6a88acff7f0000'
+        tx = transaction.Transaction(raw_tx)
+        tx.deserialize()
+        # the same 4 bytes as an unsigned number
+        tx.version = 0x9a7bb4f0
+        self.assertEqual(raw_tx, tx.serialize())
+        self.assertEqual('c659729a7fea5071361c2c1a68551ca2bf77679b27086cc415adeeb03852e369', tx.txid())
+
     def test_txid_regression_issue_4333(self):
         raw_tx = '0100000001a300499298b3f03200c05d1a15aa111a33c769aff6fb355c6bf52ebdb58ca37100000000171600756161616161616161616161616161616161616151fdffffff01c40900000000000017a914001975d5f07f3391674416c1fcd67fd511d257ff871bc71300'
         txid = '9b9f39e314662a7433aadaa5c94a2f1e24c7e7bf55fc9e1f83abd72be933eb95'
@@ -1,5 +1,10 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
 import unittest
-from lib.util import format_satoshis, parse_URI
+from lib.util import format_satoshis, parse_URI, set_tracing, trace, tracer, RWLock
 
 from . import SequentialTestCase
 
@@ -106,4 +111,53 @@ class TestUtil(SequentialTestCase):
         self.assertRaises(BaseException, parse_URI, 'notqtum:QRhew6SJQkb6inuBz5MAxb4idw81Luwcmd')
 
     def test_parse_URI_parameter_polution(self):
-        self.assertRaises(Exception, parse_URI, 'qtum:QRhew6SJQkb6inuBz5MAxb4idw81Luwcmd?amount=0.0003&label=test&amount=30.0')
\ No newline at end of file
+        self.assertRaises(Exception, parse_URI, 'qtum:QRhew6SJQkb6inuBz5MAxb4idw81Luwcmd?amount=0.0003&label=test&amount=30.0')
+
+    def test_trace_is_disabled_by_default(self):
+        self.assertIsNone(tracer.path)
+        trace('test', value=1)
+        self.assertTrue(tracer.queue.empty())
+
+    def test_trace_writes_json_lines(self):
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'trace.log')
+        try:
+            set_tracing(path)
+            fields = {'txin': {'prevout_n': 0}}
+            trace('test', **fields)
+            # records are serialized when traced, not when written
+            fields['txin']['prevout_n'] = 1
+            trace('test', value=b'\x00', keys={'a': 1}.keys())
+            tracer.flush()
+        finally:
+            set_tracing(None)
+        with open(path) as f:
+            records = [json.loads(line) for line in f]
+        shutil.rmtree(tmp_dir)
+        self.assertEqual(['test', 'test'], [r['event'] for r in records])
+        self.assertEqual({'prevout_n': 0}, records[0]['txin'])
+        # raw values are formatted by the tracer
+        self.assertEqual('00', records[1]['value'])
+        self.assertEqual(['a'], records[1]['keys'])
+
+    def test_rwlock(self):
+        lock = RWLock()
+        events = []
+        with lock.read():
+            # readers share the lock, a writer waits for them
+            with lock.read():
+                pass
+            writer = threading.Thread(target=lambda: lock.acquire_write() or events.append('write'))
+            writer.start()
+            writer.join(0.1)
+            self.assertEqual([], events)
+            # a waiting writer keeps new readers out
+            reader = threading.Thread(target=lambda: lock.acquire_read() or events.append('read'))
+            reader.start()
+            reader.join(0.1)
+            self.assertEqual([], events)
+        writer.join(1)
+        self.assertEqual(['write'], events)
+        lock.release_write()
+        reader.join(1)
+        self.assertEqual(['write', 'read'], events)
@@ -4,9 +4,14 @@ import sys
 import unittest
 import os
 import json
+import zlib
+from unittest import mock
 
 from io import StringIO
-from lib.storage import WalletStorage, FINAL_SEED_VERSION
+from lib import ecc
+from lib.contacts import Contacts
+from lib.storage import WalletStorage, WalletDB, FINAL_SEED_VERSION, SQLITE_MAGIC, STO_EV_USER_PW, dump_value
+from lib.util import InvalidPassword
 
 from . import SequentialTestCase
 
@@ -65,7 +70,152 @@ class TestWalletStorage(WalletTestCase):
             storage.put(key, value)
         storage.write()
 
-        contents = ""
-        with open(self.wallet_path, "r") as f:
-            contents = f.read()
-        self.assertEqual(some_dict, json.loads(contents))
+        with open(self.wallet_path, "rb") as f:
+            self.assertEqual(SQLITE_MAGIC, f.read(len(SQLITE_MAGIC)))
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual(some_dict, storage.data)
+
+    def test_migrate_json_file(self):
+        some_dict = {"a": "b", "txs": {"t1": "00", "t2": "01"}, "seed_version": FINAL_SEED_VERSION}
+        with open(self.wallet_path, "w") as f:
+            f.write(json.dumps(some_dict))
+        storage = WalletStorage(self.wallet_path)
+        storage.put("a", "c")
+        storage.write()
+        self.assertTrue(WalletDB.is_db_file(self.wallet_path))
+        self.assertEqual(dict(some_dict, a="c"), WalletStorage(self.wallet_path).data)
+
+    def test_write_only_changed_items(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("txs", {"t%d" % i: "%02x" % i for i in range(100)})
+        storage.put("spent", {"t1": {0: "t2"}})
+        storage.write()
+        changes = storage.db.conn.total_changes
+        txs = storage.get("txs")
+        txs["t5"] = "ff"
+        txs.pop("t7")
+        storage.put("txs", txs)
+        storage.write()
+        # one item replaced, one deleted
+        self.assertEqual(2, storage.db.conn.total_changes - changes)
+        storage.put("spent", None)
+        storage.write()
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual(txs, storage.get("txs"))
+        self.assertIsNone(storage.get("spent"))
+        # after reopening too, the digests of the items are read back when needed
+        txs["t9"] = "ee"
+        storage.put("txs", txs)
+        changes = storage.db.conn.total_changes
+        storage.write()
+        self.assertEqual(1, storage.db.conn.total_changes - changes)
+
+    def test_get_put_share_values(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("addresses", {"receiving": ["a1"], "change": []})
+        storage.write()
+        receiving = storage.get("addresses")["receiving"]
+        self.assertIs(receiving, storage.get("addresses")["receiving"])
+        receiving.append("a2")
+        # a new dict holding the same, mutated list is still written
+        storage.put("addresses", {"receiving": receiving, "change": []})
+        storage.write()
+        self.assertEqual(["a1", "a2"], WalletStorage(self.wallet_path).get("addresses")["receiving"])
+
+    def test_value_is_written_as_put(self):
+        storage = WalletStorage(self.wallet_path)
+        txi = {"t1": {"addr": {("t0", 0)}}}
+        storage.put("txi", txi)
+        # mutated after put, by another thread, while the wallet is written
+        txi["t1"]["addr"].add(("t0", 1))
+        txi["t2"] = {}
+        storage.write()
+        self.assertEqual({"t1": {"addr": [["t0", 0]]}}, WalletStorage(self.wallet_path).get("txi"))
+        # rewritten with a new password from the db, not from the mutated value
+        storage.set_password("pw", STO_EV_USER_PW)
+        storage.write()
+        storage = WalletStorage(self.wallet_path)
+        storage.decrypt("pw")
+        self.assertEqual({"t1": {"addr": [["t0", 0]]}}, storage.get("txi"))
+
+    def test_model_storage_writes_changed_item(self):
+        storage = WalletStorage(self.wallet_path)
+        contacts = Contacts(storage)
+        for i in range(10):
+            contacts["name%d" % i] = ("address", "addr%d" % i)
+        storage.write()
+        self.assertIs(contacts, storage.get("contacts"))
+        changes = storage.db.conn.total_changes
+        contacts["name3"] = ("address", "other")
+        storage.write()
+        self.assertEqual(1, storage.db.conn.total_changes - changes)
+        self.assertEqual(["address", "other"], WalletStorage(self.wallet_path).get("contacts")["name3"])
+
+    def test_put_items_takes_changed_items(self):
+        storage = WalletStorage(self.wallet_path)
+        txs = {"t%d" % i: "%02x" % i for i in range(100)}
+        storage.put("txs", txs)
+        storage.write()
+        txs["t5"] = "ff"
+        txs.pop("t7")
+        with mock.patch("lib.storage.dump_value", wraps=dump_value) as dumps:
+            storage.put_items("txs", txs, ["t5", "t7"])
+        self.assertEqual(1, dumps.call_count)
+        changes = storage.db.conn.total_changes
+        storage.write()
+        self.assertEqual(2, storage.db.conn.total_changes - changes)
+        self.assertEqual(txs, WalletStorage(self.wallet_path).get("txs"))
+        # kept when the db is rewritten with a new password
+        txs["t8"] = "ee"
+        storage.put_items("txs", txs, ["t8"])
+        storage.set_password("pw", STO_EV_USER_PW)
+        storage.write()
+        storage = WalletStorage(self.wallet_path)
+        storage.decrypt("pw")
+        self.assertEqual(txs, storage.get("txs"))
+
+    def test_unserializable_value_is_not_written(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("a", "b")
+        storage.put("bad", object())
+        # not kept in memory either
+        self.assertIsNone(storage.get("bad"))
+        storage.write()
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual("b", storage.get("a"))
+        self.assertIsNone(storage.get("bad"))
+
+    def test_encrypted_storage(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("txs", {"t1": "00"})
+        storage.put("secret", "xprv")
+        storage.set_password("pw", STO_EV_USER_PW)
+        storage.write()
+        with open(self.wallet_path, "rb") as f:
+            self.assertNotIn(b"xprv", f.read())
+        storage = WalletStorage(self.wallet_path)
+        self.assertTrue(storage.is_encrypted_with_user_pw())
+        with self.assertRaises(InvalidPassword):
+            storage.decrypt("wrong")
+        storage.decrypt("pw")
+        self.assertEqual("xprv", storage.get("secret"))
+        storage.put("txs", {"t1": "00", "t2": "01"})
+        storage.write()
+        storage = WalletStorage(self.wallet_path)
+        storage.decrypt("pw")
+        self.assertEqual({"t1": "00", "t2": "01"}, storage.get("txs"))
+
+    def test_migrate_encrypted_json_file(self):
+        some_dict = {"a": "b", "seed_version": FINAL_SEED_VERSION}
+        ec_key = WalletStorage.get_eckey_from_password("pw")
+        s = zlib.compress(json.dumps(some_dict).encode('utf8'))
+        with open(self.wallet_path, "w") as f:
+            f.write(ecc.ECPubkey(ec_key.get_public_key_bytes()).encrypt_message(s, b'BIE1').decode('utf8'))
+        storage = WalletStorage(self.wallet_path)
+        self.assertTrue(storage.is_encrypted())
+        storage.decrypt("pw")
+        storage.put("c", "d")
+        storage.write()
+        storage = WalletStorage(self.wallet_path)
+        storage.decrypt("pw")
+        self.assertEqual(dict(some_dict, c="d"), storage.data)
@@ -1,11 +1,17 @@
+import csv
+import json
+import os
 import unittest
 from unittest import mock
 import shutil
 import tempfile
+import time
+from collections import defaultdict
 from typing import Sequence
 
 import lib
 from lib import storage, qtum, keystore, constants
+from lib.tokens import Token
 from lib.transaction import Transaction
 from lib.simple_config import SimpleConfig
 from lib.wallet import TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT
@@ -1081,6 +1087,264 @@ class TestWalletHistory_SimpleRandomOrder(TestCaseForTestnet):
             w.receive_tx_callback(tx.txid(), tx, TX_HEIGHT_UNCONFIRMED)
         self.assertEqual(27633300, sum(w.get_balance()))
 
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_addr_index_follows_wallet_changes(self, mock_write):
+        w = self.create_old_wallet()
+
+        def check():
+            cached = w.get_balance(), sorted_utxos(w.get_utxos())
+            w._addr_index.clear()
+            self.assertEqual((w.get_balance(), sorted_utxos(w.get_utxos())), cached)
+            return cached[0]
+
+        def sorted_utxos(coins):
+            return sorted(coins, key=lambda x: (x['prevout_hash'], x['prevout_n']))
+
+        for txid in self.txid_list:
+            tx = Transaction(self.transactions[txid])
+            w.receive_tx_callback(tx.txid(), tx, TX_HEIGHT_UNCONFIRMED)
+            check()
+        self.assertEqual((0, 27633300, 0), check())
+        for height, txid in enumerate(self.txid_list, 1000):
+            w.add_unverified_tx(txid, height)
+            check()
+        self.assertEqual((27633300, 0, 0), check())
+        w.remove_transaction(self.txid_list[3])
+        check()
+        w.add_unverified_tx(self.txid_list[5], TX_HEIGHT_UNCONFIRMED)
+        c, u, x = check()
+        self.assertNotEqual(0, u)
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_history_timeline_is_patched(self, mock_write):
+        w = self.create_old_wallet()
+        w.network = mock.Mock()
+        w.network.get_local_height.return_value = 2000
+
+        def check():
+            history = w.get_history()
+            w._history = lib.wallet.HistoryTimeline()
+            self.assertEqual(w.get_history(), history)
+            return history
+
+        for txid in self.txid_list:
+            tx = Transaction(self.transactions[txid])
+            w.receive_tx_callback(tx.txid(), tx, TX_HEIGHT_UNCONFIRMED)
+        history = check()
+        self.assertEqual(19, len(history))
+        self.assertEqual(27633300, history[-1][5])
+        # verify in reverse order of the current history, one at a time
+        for height, item in enumerate(reversed(history), 1000):
+            w.add_verified_tx(item[0], (height, 1500000000 + height, 0))
+            check()
+        history = check()
+        self.assertEqual([item[0] for item in reversed(history)], [item[0] for item in w.get_history(newest_first=True)])
+        self.assertEqual(history[5:8], w.get_history(offset=5, limit=3))
+        self.assertEqual(history[-3:][::-1], w.get_history(limit=3, newest_first=True))
+        from_ts, to_ts = history[4][3], history[10][3]
+        self.assertEqual(history[4:10], w.get_history(from_timestamp=from_ts, to_timestamp=to_ts))
+        self.assertEqual(history[6:8], w.get_history(from_timestamp=from_ts, to_timestamp=to_ts, offset=2, limit=2))
+        w.remove_transaction(history[-1][0])
+        self.assertEqual([], w.get_history())  # history no longer adds up to the balance
+        # with a time range, balances are counted back from the current balance
+        c, u, x = w.get_balance()
+        partial = w.get_history(to_timestamp=history[2][3])
+        self.assertEqual([item[:5] for item in history[:2]], [item[:5] for item in partial])
+        self.assertEqual(c + u + x - sum(item[4] for item in history[2:-1]), partial[-1][5])
+
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_domain_history(self, mock_write):
+        w = self.create_old_wallet()
+        w.network = mock.Mock()
+        w.network.get_local_height.return_value = 2000
+        for height, txid in enumerate(self.txid_list, 1000):
+            tx = Transaction(self.transactions[txid])
+            w.receive_tx_callback(tx.txid(), tx, height if height % 2 else TX_HEIGHT_UNCONFIRMED)
+        addrs = [addr for addr in w.get_addresses() if w.get_address_history(addr)]
+        # a transaction of the address history that is not in txi/txo yet
+        extra = next(txid for txid in self.txid_list if txid not in w._history_local[addrs[0]])
+        w._history_local[addrs[0]].add(extra)
+        for domain in [addrs[:1], addrs[:2], addrs[3:9]]:
+            deltas = defaultdict(int)
+            for addr in domain:
+                for txid, height in w.get_address_history(addr):
+                    deltas[txid] += w.get_tx_delta(txid, addr)
+            with mock.patch.object(w, 'get_tx_delta', wraps=w.get_tx_delta) as get_tx_delta:
+                history = w.get_history(domain=domain)
+            # only the transactions of the domain are looked at
+            self.assertEqual(sum(len(w.get_address_history(addr)) for addr in domain), get_tx_delta.call_count)
+            self.assertEqual(sorted(deltas.items()), sorted((item[0], item[4]) for item in history))
+            self.assertEqual([w.get_txpos(item[0]) for item in history], sorted(w.get_txpos(txid) for txid in deltas))
+        self.assertIn((extra, 0), [(item[0], item[4]) for item in w.get_history(domain=addrs[:1])])
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_imported_wallet_history_follows_addresses(self, mock_write):
+        old = self.create_old_wallet()
+        for txid in self.txid_list:
+            old.receive_tx_callback(txid, Transaction(self.transactions[txid]), TX_HEIGHT_UNCONFIRMED)
+        addrs = [addr for addr in old.get_addresses() if old.get_address_history(addr)]
+        unused = [addr for addr in old.get_addresses() if not old.get_address_history(addr)]
+        w = WalletIntegrityHelper.create_imported_wallet()
+        for addr in addrs:
+            w.import_address(addr)
+        for txid in self.txid_list:
+            w.receive_tx_callback(txid, Transaction(self.transactions[txid]), TX_HEIGHT_UNCONFIRMED)
+        history = w.get_history()
+        self.assertEqual(sum(w.get_balance()), history[-1][5])
+        # same number of addresses: one that shares transactions with others is replaced
+        w.delete_address('qSC9RTs2sRv3qRGbHtKbyCDNXSAKfRMBiP')
+        w.import_address(unused[0])
+        history = w.get_history()
+        self.assertNotEqual([], history)
+        w._history = lib.wallet.HistoryTimeline()
+        self.assertEqual(w.get_history(), history)
+        self.assertEqual(sum(w.get_balance()), history[-1][5])
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_history_pages_and_export(self, mock_write):
+        from lib.commands import Commands
+        w = self.create_old_wallet()
+        w.network = mock.Mock()
+        w.network.get_local_height.return_value = 2000
+        for height, txid in enumerate(self.txid_list, 1000):
+            tx = Transaction(self.transactions[txid])
+            w.receive_tx_callback(tx.txid(), tx, TX_HEIGHT_UNCONFIRMED)
+            if height < 1015:
+                w.add_verified_tx(txid, (height, 1500000000 + height, 0))
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        cmds = Commands(SimpleConfig({'electrum_path': tmp_dir, 'cwd': tmp_dir}), w, None)
+        history = cmds.history()
+        self.assertEqual(19, len(history))
+        pages, cursor = [], None
+        while True:
+            page = cmds.historypage(cursor=cursor, limit=4)
+            pages.extend(page['transactions'])
+            cursor = page['cursor']
+            if cursor is None:
+                break
+        self.assertEqual(history, pages)
+        self.assertEqual([item for item in history if 1003 <= item['height'] < 1007],
+                         cmds.history(from_height=1003, to_height=1007))
+        # unconfirmed transactions come after any block
+        self.assertEqual([item for item in history if item['height'] <= 0],
+                         cmds.history(from_height=1015))
+        # cursor, height and timestamp filters combined
+        filters = {'from_height': 1006, 'to_height': 1013, 'from_timestamp': 1500001004}
+        expected = [item for item in history if 1006 <= item['height'] < 1013]
+        self.assertEqual(expected, cmds.history(**filters))
+        pages, cursor = [], None
+        while True:
+            page = cmds.historypage(cursor=cursor, limit=3, **filters)
+            pages.extend(page['transactions'])
+            cursor = page['cursor']
+            if cursor is None:
+                break
+        self.assertEqual(expected, pages)
+        result = cmds.exporthistory('history.jsonl', format='jsonl')
+        self.assertEqual(19, result['transactions'])
+        with open(result['path']) as f:
+            self.assertEqual(history, [json.loads(line) for line in f])
+        cmds.exporthistory('history.csv')
+        with open(os.path.join(tmp_dir, 'history.csv')) as f:
+            rows = list(csv.reader(f))
+        self.assertEqual('txid', rows[0][0])
+        self.assertEqual([item['txid'] for item in history], [row[0] for row in rows[1:]])
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_reopened_wallet_matches(self, mock_write):
+        w = self.create_old_wallet()
+        w.network = mock.Mock()
+        w.network.get_local_height.return_value = 2000
+        for height, txid in enumerate(self.txid_list, 1000):
+            tx = Transaction(self.transactions[txid])
+            w.receive_tx_callback(tx.txid(), tx, height if height % 3 else TX_HEIGHT_UNCONFIRMED)
+        w.add_verified_tx(self.txid_list[1], (1001, 1500000000, 0))
+        for addr in w.get_addresses():
+            w.history[addr] = w.get_address_history(addr)
+        w.save_transactions(write=True)
+        w.storage.put('verified_tx3', w.verified_tx)
+        # reopen from a copy, as if read back from the file
+        store = storage.WalletStorage('if_this_exists_mocking_failed_648151893')
+        for key, value in w.storage.data.items():
+            store.put(key, json.loads(storage.dump_value(value)))
+        w2 = type(w)(store)
+        w2.network = w.network
+        # made on first use
+        self.assertIsNone(w2._local_history)
+        self.assertEqual(w._history_local, w2._history_local)
+        self.assertEqual(dict(w.unverified_tx), dict(w2.unverified_tx))
+        self.assertEqual({k: list(v) for k, v in w.verified_tx.items()}, w2.verified_tx)
+        self.assertEqual(set(w.transactions), set(w2.transactions))
+        self.assertEqual(w.get_balance(), w2.get_balance())
+        self.assertEqual(w.get_history(), w2.get_history())
+        # add again a transaction spent by another one, whose inputs in
+        # txi are still as loaded
+        parent = next(txid for txid in w2.spent_outpoints if txid in w2.txo
+                      and any(w2.txi.get(child) for child in w2.spent_outpoints[txid].values()))
+        tx = w2.transactions[parent]
+        w2.remove_transaction(parent)
+        w2.receive_tx_callback(parent, tx, w2.get_tx_height(parent)[0])
+        self.assertEqual(w.get_balance(), w2.get_balance())
+        self.assertEqual(w.get_history(), w2.get_history())
+        self.assertEqual(json.loads(storage.dump_value(w.txi)), json.loads(storage.dump_value(w2.txi)))
+
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_verifications_are_written_once(self, mock_write):
+        w = self.create_old_wallet()
+        w.network = mock.Mock()
+        w.network.get_local_height.return_value = 2000
+        w.writer = lib.wallet.WalletWriter(w)
+        for txid in self.txid_list:
+            tx = Transaction(self.transactions[txid])
+            w.receive_tx_callback(tx.txid(), tx, TX_HEIGHT_UNCONFIRMED)
+        w.save_transactions()
+        w.schedule_write()
+        self.assertIsNone(w.storage.get('transactions'))
+        for height, txid in enumerate(self.txid_list, 1000):
+            w.add_verified_tx(txid, (height, 1500000000 + height, 0))
+            w.save_verified_tx()
+            w.schedule_write()
+            w.writer.run()
+        mock_write.assert_not_called()
+        w._write_due = time.time()
+        w.writer.run()
+        w.writer.run()
+        mock_write.assert_called_once_with()
+        self.assertEqual(w.verified_tx, w.storage.get('verified_tx3'))
+        self.assertEqual(set(self.txid_list), set(w.storage.get('transactions')))
+
+
+    def test_changed_transactions_are_written(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        store = storage.WalletStorage(os.path.join(tmp_dir, 'wallet'))
+        store.put('keystore', keystore.from_old_mpk('e9d4b7866dd1e91c862aebf62a49548c7dbf7bcc6e4b7b8c9da820c7737968df9c09d5a3e271dc814a29981f81b3faaf2737b551ef5dcc6189cf0f8252c442b3').dump())
+        store.put('gap_limit', 20)
+        w = lib.wallet.Standard_Wallet(store)
+        w.synchronize()
+        w.create_new_address(for_change=True)
+        for txid in self.txid_list[:-1]:
+            w.receive_tx_callback(txid, Transaction(self.transactions[txid]), TX_HEIGHT_UNCONFIRMED)
+        w.save_transactions(write=True)
+        with mock.patch.object(storage, 'dump_value', wraps=storage.dump_value) as dump_value:
+            txid = self.txid_list[-1]
+            w.receive_tx_callback(txid, Transaction(self.transactions[txid]), TX_HEIGHT_UNCONFIRMED)
+            addr = w.get_addresses()[0]
+            w.receive_history_callback(addr, [(txid, TX_HEIGHT_UNCONFIRMED)], {txid: 100})
+            w.remove_transaction(self.txid_list[3])
+            w.save_transactions(write=True)
+        # the changed items only, not every transaction
+        self.assertLess(dump_value.call_count, 20)
+        w2 = lib.wallet.Standard_Wallet(storage.WalletStorage(store.path))
+        for key in ['transactions', 'txi', 'txo', 'tx_fees', 'addr_history', 'spent_outpoints']:
+            self.assertEqual(json.loads(storage.dump_value(w.storage.get(key))),
+                             json.loads(storage.dump_value(w2.storage.get(key))))
+        self.assertEqual(set(w.transactions), set(w2.transactions))
+        self.assertEqual(w.get_balance(), w2.get_balance())
+
 
 class TestWalletHistory_EvilGapLimit(TestCaseForTestnet):
     transactions = {
@@ -1131,3 +1395,62 @@ class TestWalletHistory_EvilGapLimit(TestCaseForTestnet):
                                    {})
         w.synchronize()
         self.assertEqual(9999788, sum(w.get_balance()))
+
+
+class TestWalletTokenHistory(TestCaseForTestnet):
+    contract = '49665919e437a4bedb92faa45ed33ebb5a33ee63'
+    other = '0000000000000000000000000000000000000001'
+
+    def create_wallet(self):
+        ks = keystore.from_old_mpk('e9d4b7866dd1e91c862aebf62a49548c7dbf7bcc6e4b7b8c9da820c7737968df9c09d5a3e271dc814a29981f81b3faaf2737b551ef5dcc6189cf0f8252c442b3')
+        w = WalletIntegrityHelper.create_standard_wallet(ks, gap_limit=2)
+        self.bind_addr = w.get_receiving_addresses()[0]
+        self.key = '{}_{}'.format(self.contract, self.bind_addr)
+        w.add_token(Token(self.contract, self.bind_addr, 'Test', 'TST', 8, 0))
+        return w
+
+    def receipt(self, txid, logs):
+        return [{'transactionHash': txid, 'log': logs}]
+
+    def transfer(self, to_me, amount, contract=None):
+        me = bh2u(qtum.b58_address_to_hash160(self.bind_addr)[1]).zfill(64)
+        them = self.other.zfill(64)
+        topics = [qtum.TOKEN_TRANSFER_TOPIC, them, me] if to_me else [qtum.TOKEN_TRANSFER_TOPIC, me, them]
+        return {'address': contract or self.contract, 'topics': topics, 'data': '%064x' % amount}
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_token_history(self, mock_write):
+        w = self.create_wallet()
+        txids = ['%064x' % i for i in range(1, 6)]
+        for i, txid in enumerate(txids):
+            w.add_tx_receipt(txid, self.receipt(txid, [self.transfer(i % 2 == 0, 100 * (i + 1))]))
+            w.verified_tx[txid] = (1000 + i, 1500000000 + i, 0)
+        # a log of another contract is not a transfer of the token
+        w.add_tx_receipt(txids[4], self.receipt(txids[4], [self.transfer(True, 1, self.other)]))
+        w.receive_token_history_callback(self.key, [[txid, 1000 + i, 0] for i, txid in enumerate(txids)])
+
+        h = w.get_token_history()
+        self.assertEqual([txids[3], txids[2], txids[1], txids[0]], [item[4] for item in h])
+        self.assertEqual((self.other, bh2u(qtum.b58_address_to_hash160(self.bind_addr)[1]), 300),
+                         h[1][:3])
+        self.assertEqual(h[1:3], w.get_token_history(offset=1, limit=2))
+        self.assertEqual(h[1:3], w.get_token_history(from_timestamp=1500000001, to_timestamp=1500000003))
+        self.assertEqual(h, w.get_token_history(contract_addr=self.contract))
+        self.assertEqual([], w.get_token_history(contract_addr=self.other))
+
+        # a new receipt or history updates the index in place
+        index = w._token_index[self.key]
+        w.add_tx_receipt(txids[4], self.receipt(txids[4], [self.transfer(True, 500)]))
+        h = w.get_token_history()
+        self.assertEqual(txids[4], h[0][4])
+        self.assertEqual(h[3:], w.get_token_history(offset=3))
+        self.assertEqual(h[4:5], w.get_token_history(offset=4, limit=3))
+        w.receive_token_history_callback(self.key, [[txid, 1000 + i, 0] for i, txid in enumerate(txids[1:], 1)])
+        self.assertEqual(h[:4], w.get_token_history())
+        self.assertIs(index, w._token_index[self.key])
+        w._token_index.clear()
+        self.assertEqual(h[:4], w.get_token_history())
+        w.receive_token_history_callback(self.key, [[txids[0], 1000, 0]])
+        self.assertEqual([txids[0]], [item[4] for item in w.get_token_history()])
+        w.delete_token(self.key)
+        self.assertEqual([], w.get_token_history())
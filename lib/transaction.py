@@ -25,13 +25,14 @@
 
 # Note: The deserialization code originally comes from ABE.
 from typing import Sequence, Union
-from .util import print_error, profiler,Print
+from .util import print_error, trace
 from . import bitcoin
 from . import ecc
 from .qtum import *
 import struct
 import traceback
 import sys
+from collections import namedtuple
 
 #
 # Workalike python implementation of Bitcoin's CDataStream class.
@@ -638,12 +639,7 @@ def contract_script(gas_limit, gas_price, datahex, contract_addr, opcode):
     script += bh2u(contract_encode_number(gas_price))
     script += push_script(datahex)
 
-    with open('./debug_info_var.txt','a') as f:
-        try:
-            f.write('file:transaction.py,func:contract_script'+'\n'+'datahex:'+str(datahex)+'\n')
-            f.write('file:transaction.py,func:contract_script'+'\n'+'push_script(datahex)'+str(push_script(datahex))+'\n')
-        except:
-            pass
+    trace('contract_script', datahex=datahex)
 
     if opcode == opcodes.OP_CALL:
         script += push_script(contract_addr)
@@ -652,6 +648,10 @@ def contract_script(gas_limit, gas_price, datahex, contract_addr, opcode):
     return script
 
 
+# BIP143 digests shared by the preimages of all inputs of a transaction
+BIP143SharedFields = namedtuple('BIP143SharedFields', ['hashPrevouts', 'hashSequence', 'hashOutputs'])
+
+
 class Transaction:
 
     def __str__(self):
@@ -676,6 +676,8 @@ class Transaction:
         # this value will get properly set when deserializing
         self.is_partial_originally = True
         self._segwit_ser = None  # None means "don't know"
+        self._bip143_shared_fields = None
+        self._hashes = {}
 
     def update(self, raw):
         self.raw = raw
@@ -706,13 +708,6 @@ class Transaction:
             # zip(*):对打包解压缩
             txin['pubkeys'] = pubkeys = list(pubkeys)
             txin['x_pubkeys'] = x_pubkeys = list(x_pubkeys)
-        with open('pubkey.txt','a') as f:
-            try:
-                f.write("pubkeys:"+str(pubkeys)+2*'\n')
-                f.write("x_pubkeys:"+str(x_pubkeys)+2*'\n')
-                f.write('tx_in:'+str(txin)+2*'\n')
-            except:
-                pass
         return pubkeys, x_pubkeys
 
     def update_signatures(self, signatures: Sequence[str]):
@@ -722,107 +717,34 @@ class Transaction:
         intended for self._inputs[i].
         This is used by the Trezor and KeepKey plugins.
         """
-        with open('./Qtum_Trezor_step.txt','a') as f:
-            try:
-                f.write('step2 has into :transactions.update_signatures'+'\n')
-            except:
-                pass
-
-        with open('./Qtum_Debug.txt','a') as f:
-            try:
-                f.write('executed file:transactions.py;func:update_signatures'+'\n')
-            except:
-                pass
-        print('****1')
+        trace('update_signatures', signatures=signatures)
         if self.is_complete():
-            print("*********2")
-            print("self.is_complete()")
             return
         if len(self.inputs()) != len(signatures):
-            print('*********3')
-            print('executed error:file:transactions.py;func:update_signatures ')
             raise Exception('expected {} signatures; got {}'.format(len(self.inputs()), len(signatures)))
-        print("*****4")
-        print('executed file:transactions.py;func:update_signatures')
         for i, txin in enumerate(self.inputs()):
-
-            with open('./Qtum_Trezor_var.txt', 'a') as f:
-                try:
-                    f.write('nonsig_txin:' + str(txin) + '\n')
-                    print('nonsig_txin:',txin)
-                except:
-                    pass
-
             pubkeys, x_pubkeys = self.get_sorted_pubkeys(txin)
-
-            with open('./update_sign.txt','a') as f:
-                try:
-                    f.write('pubkeys:'+2*'\n'+str(pubkeys)+2*'\n')
-                except:
-                    f.write('Failed:pubkeys'+2*'\n')
-
             sig = signatures[i]
-            print('******5')
             if sig in txin.get('signatures'):
-                print('******6')
-                print("sig in txin.get('signatures')")
                 continue
-            pre_hash = Hash(bfh(self.serialize_preimage(i)))
-
-            with open('./update_sign.txt','a') as f:
-                try:
-                    f.write('pre_Hash:' + 2*'\n' + str(pre_hash)+2*'\n')
-                except:
-                    f.write('Failed:pre_hash' + 2*'\n')
+            pre_hash = Hash(self.serialize_preimage_bytes(i))
+            trace('update_signatures.input', index=i, txin=txin, pubkeys=pubkeys, pre_hash=pre_hash)
 
             #从此处开始出现不同
             sig_string = ecc.sig_string_from_der_sig(bfh(sig[:-2]))
-            with open('./update_sign.txt','a') as f:
-                try:
-                    f.write('sig_string:'+ 2*'\n' + str(sig_string)+2*'\n')
-                except:
-                    f.write('Failed:sig_string'+'\n')
-
             for recid in range(4):
-                print('******7')
                 try:
                     public_key = ecc.ECPubkey.from_sig_string(sig_string, recid, pre_hash)
-                    with open('./update_sign.txt', 'a') as f:
-                        try:
-                            f.write('recid:'+2*'\n' + str(recid) + 2*'\n')
-                            f.write('public_key:'+ 2*'\n' + str(public_key) + 2*'\n')
-                        except:
-                            f.write('Failed:public_key'+'\n')
-
                 except ecc.InvalidECPointException:
                     # the point might not be on the curve for some recid values
-                    print('******ecc.InvalidECPointException*********')
                     continue
                 pubkey_hex = public_key.get_public_key_hex(compressed=True)
-                try:
-                    print('pubkey_hex',pubkey_hex)
-                except:
-                    print('get error:pubkey_hex'+'\n')
-
-                try:
-                    print('pubkeys', pubkeys)
-                except:
-                    print('get error:pubkeys','\n')
-
-                with open('./update_sign.txt', 'a') as f:
-                    try:
-                        f.write('recid:  ' + 2*'\n'+str(recid) + '\n')
-                        f.write('pubkey_hex:'+ 2*'\n' + str(pubkey_hex) + '\n')
-                    except:
-                        f.write('Failed:pubkey_hex'+'\n')
-
+                trace('update_signatures.recid', index=i, recid=recid, pubkey_hex=pubkey_hex)
 
                 #原始代码有if判断
                 if pubkey_hex in pubkeys:
                 #更新代码
                 #if 1:
-                    print('*********8')
-                    print('pubkey_hex in pubkeys')
                     try:
                         public_key.verify_message_hash(sig_string, pre_hash)
                     except Exception:
@@ -833,45 +755,21 @@ class Transaction:
                     #更改代码为j = 0
                     #j = 0
                     print_error("adding sig", i, j, pubkey_hex, sig)
-                    print('ready:add_signature_to_txin')
                     self.add_signature_to_txin(i, j, sig)
-                    print('finish:add_signature_to_txin')
                     #self._inputs[i]['x_pubkeys'][j] = pubkey
                     break
 
-        with open('./Qtum_Trezor_var.txt', 'a') as f:
-            try:
-                f.write('sig_txin:' + str(txin) + '\n')
-                print('sig_txin:',txin)
-            except:
-                pass
-
-        with open('./update_sign.txt', 'a') as f:
-            try:
-                f.write('sign_txin:  ' + 2 * '\n' + str(txin) + 2*'\n')
-            except:
-                f.write('Failed:pubkey_hex' + '\n')
-
         # redo raw
         self.raw = self.serialize()
 
     def add_signature_to_txin(self, i, signingPos, sig):
-        print('into:add_signature_to_txin')
         txin = self._inputs[i]
-        with open('./Qtum_Sign_var.txt','a') as f:
-            try:
-                f.write('without_signatures_txin:'+str(txin)+'\n')
-            except:
-                pass
         txin['signatures'][signingPos] = sig
         txin['scriptSig'] = None  # force re-serialization
         txin['witness'] = None    # force re-serialization
-        with open('./Qtum_Sign_var.txt','a') as f:
-            try:
-                f.write('signatures_txin:'+str(txin)+'\n')
-            except:
-                pass
+        trace('add_signature_to_txin', index=i, signing_pos=signingPos, txin=txin)
         self.raw = None
+        self._hashes = {}
 
     def deserialize(self, force_full_parse=False):
         if self.raw is None:
@@ -880,12 +778,15 @@ class Transaction:
         if self._inputs is not None:
             return
         d = deserialize(self.raw, force_full_parse)
-        self._inputs = d['inputs']
         self._outputs = [(x['type'], x['address'], x['value']) for x in d['outputs']]
+        self.invalidate_ser_cache()
         self.locktime = d['lockTime']
         self.version = d['version']
         self.is_partial_originally = d['partial']
         self._segwit_ser = d['segwit_ser']
+        # set last: wallet transactions are shared by the commands running
+        # concurrently, which must not see a partly deserialized one
+        self._inputs = d['inputs']
         return d
 
     @classmethod
@@ -1075,48 +976,44 @@ class Transaction:
         #包括前一笔交易的hash，以及对应前一笔交易中的第几个输出的序列号(序列号4个字节)。
         return bh2u(bfh(txin['prevout_hash'])[::-1]) + int_to_hex(txin['prevout_n'], 4)
 
+    @classmethod
+    def serialize_outpoint_bytes(cls, txin):
+        return bfh(txin['prevout_hash'])[::-1] + struct.pack('<I', txin['prevout_n'])
+
     @classmethod
     def get_outpoint_from_txin(cls, txin):
         if txin['type'] == 'coinbase':
             return None
         prevout_hash = txin['prevout_hash']
         prevout_n = txin['prevout_n']
-
-        Outpoint = Print("Outpoint_from_txin")
-        Outpoint.add_var(prevout_hash = prevout_hash,\
-                        prevout_n = prevout_n)
-
-        Outpoint.read_me("这个文件夹里记录了sign_txin时,serialize_preimage下的"\
-                         "中的serialize_input下的serialize_outpoint的输出内容")
-
         return prevout_hash + ':%d' % prevout_n
 
     @classmethod
     def serialize_input(self, txin, script):
-        # Prev hash and index
-        s = self.serialize_outpoint(txin)
-        # Script length, script, sequence
-        s += var_int(len(script)//2)#除2并向下取整
-        s += script
-        s += int_to_hex(txin.get('sequence', 0xffffffff - 1), 4)
-        with open('./debug_info_var.txt','a') as f:
-            try:
-                f.write('txin:'+str(txin))
-                f.write("txin type:"+str(txin.__class__.__name__)+'\n')
-            except:
-                pass
+        return bh2u(self.serialize_input_bytes(txin, script))
 
-        return s
+    @classmethod
+    def serialize_input_bytes(cls, txin, script):
+        script = bfh(script)
+        # Prev hash and index, script length, script, sequence
+        return b''.join((
+            cls.serialize_outpoint_bytes(txin),
+            var_int_bytes(len(script)),
+            script,
+            struct.pack('<I', txin.get('sequence', 0xffffffff - 1)),
+        ))
 
     def set_rbf(self, rbf):
         nSequence = 0xffffffff - (2 if rbf else 1)
         for txin in self.inputs():
             txin['sequence'] = nSequence
+        self.invalidate_ser_cache()
 
     def BIP_LI01_sort(self):
         # See https://github.com/kristovatlas/rfc/blob/master/bips/bip-li01.mediawiki
         self._inputs.sort(key = lambda i: (i['prevout_hash'], i['prevout_n']))
         self._outputs.sort(key = lambda o: (o[2], self.pay_script(o[0], o[1])))
+        self.invalidate_ser_cache()
 
     def qtum_sort(self, sender):
         if not sender:
@@ -1130,6 +1027,7 @@ class Transaction:
                 break
         if sender_inp:
             self._inputs.insert(0, sender_inp)
+            self.invalidate_ser_cache()
         else:
             print_error('qtum_sort', self._inputs)
             raise Exception('qtum_sort - sender address not in inputs')
@@ -1142,42 +1040,70 @@ class Transaction:
         return 9 + len(script) // 2
 
     def serialize_output(self, output):
+        return bh2u(self.serialize_output_bytes(output))
+
+    def serialize_output_bytes(self, output):
         #output里面包括了'交易数量,脚本长度,脚本地址,'
         # qtum
         output_type, data, amount = output
         if output_type == 'coinstake':
             output_type = TYPE_SCRIPT
-        s = int_to_hex(amount, 8) #
-        script = self.pay_script(output_type, addr=data)
-        s += var_int(len(script)//2)
-        s += script
-        return s
+        script = bfh(self.pay_script(output_type, addr=data))
+        return int_to_bytes(amount, 8) + var_int_bytes(len(script)) + script
+
+    def invalidate_ser_cache(self):
+        """
+        Drop the cached BIP143 digests, txid and wtxid. Must be called
+        whenever inputs, their sequence numbers, signatures or outputs
+        change.
+        """
+        self._bip143_shared_fields = None
+        self._hashes = {}
+
+    def get_bip143_shared_fields(self):
+        """ hashPrevouts, hashSequence and hashOutputs, computed once per transaction """
+        if self._bip143_shared_fields is None:
+            inputs = self.inputs()
+            outputs = self.outputs()
+            hashPrevouts = Hash(b''.join(self.serialize_outpoint_bytes(txin) for txin in inputs))
+            hashSequence = Hash(b''.join(struct.pack('<I', txin.get('sequence', 0xffffffff - 1)) for txin in inputs))
+            hashOutputs = Hash(b''.join(self.serialize_output_bytes(o) for o in outputs))
+            self._bip143_shared_fields = BIP143SharedFields(hashPrevouts, hashSequence, hashOutputs)
+        return self._bip143_shared_fields
 
     def serialize_preimage(self, i):
-        nVersion = int_to_hex(self.version, 4)
-        nHashType = int_to_hex(1, 4)
-        nLocktime = int_to_hex(self.locktime, 4)
+        return bh2u(self.serialize_preimage_bytes(i))
+
+    def serialize_preimage_bytes(self, i):
         inputs = self.inputs()
         outputs = self.outputs()
-        #print('outputs.type',outputs[0])
         txin = inputs[i]
-        # TODO: py3 hex
         if self.is_segwit_input(txin):#txin是隔离见证
-            hashPrevouts = bh2u(Hash(bfh(''.join(self.serialize_outpoint(txin) for txin in inputs))))#得到所有输入的前一笔输出的hash值和对应的输出序号
-            hashSequence = bh2u(Hash(bfh(''.join(int_to_hex(txin.get('sequence', 0xffffffff - 1), 4) for txin in inputs))))#
-            hashOutputs = bh2u(Hash(bfh(''.join(self.serialize_output(o) for o in outputs))))#序列化所有输出地址
-            outpoint = self.serialize_outpoint(txin) #
-            preimage_script = self.get_preimage_script(txin)
-            scriptCode = var_int(len(preimage_script) // 2) + preimage_script
-            amount = int_to_hex(txin['value'], 8)
-            nSequence = int_to_hex(txin.get('sequence', 0xffffffff - 1), 4)
-            preimage = nVersion + hashPrevouts + hashSequence + outpoint + scriptCode + amount + nSequence + hashOutputs + nLocktime + nHashType
-        else:
-            txins = var_int(len(inputs)) + ''.join(self.serialize_input(txin, self.get_preimage_script(txin) if i==k else '') for k, txin in enumerate(inputs))
-            txouts = var_int(len(outputs)) + ''.join(self.serialize_output(o) for o in outputs)
-            #
-            preimage = nVersion + txins + txouts + nLocktime + nHashType
-        return preimage #输入的last_tx的信息
+            fields = self.get_bip143_shared_fields()
+            preimage_script = bfh(self.get_preimage_script(txin))
+            return b''.join((
+                struct.pack('<I', self.version & 0xffffffff),
+                fields.hashPrevouts,
+                fields.hashSequence,
+                self.serialize_outpoint_bytes(txin),
+                bfh(var_int(len(preimage_script))),
+                preimage_script,
+                struct.pack('<q', txin['value']),
+                struct.pack('<I', txin.get('sequence', 0xffffffff - 1)),
+                fields.hashOutputs,
+                struct.pack('<I', self.locktime),
+                struct.pack('<I', 1),  # nHashType
+            ))
+        buf = bytearray(struct.pack('<I', self.version & 0xffffffff))
+        buf += var_int_bytes(len(inputs))
+        for k, txin in enumerate(inputs):
+            buf += self.serialize_input_bytes(txin, self.get_preimage_script(txin) if i==k else '')
+        buf += var_int_bytes(len(outputs))
+        for o in outputs:
+            buf += self.serialize_output_bytes(o)
+        buf += struct.pack('<I', self.locktime)
+        buf += struct.pack('<I', 1)  # nHashType
+        return bytes(buf) #输入的last_tx的信息
 
     def is_segwit(self):
         if not self.is_partial_originally:
@@ -1195,48 +1121,60 @@ class Transaction:
             return network_ser
 
     def serialize_to_network(self, estimate_size=False, witness=True):
-        #print("into serialize_to_network!!!")
-        nVersion = int_to_hex(self.version, 4)
-        nLocktime = int_to_hex(self.locktime, 4)
+        return bh2u(self.serialize_to_network_bytes(estimate_size, witness))
+
+    def serialize_to_network_bytes(self, estimate_size=False, witness=True):
         inputs = self.inputs()
         outputs = self.outputs()
-        txins = var_int(len(inputs)) + ''.join(self.serialize_input(txin, self.input_script(txin, estimate_size)) for txin in inputs)
-        txouts = var_int(len(outputs)) + ''.join(self.serialize_output(o) for o in outputs)
-        if witness and self.is_segwit():
-            marker = '00'
-            flag = '01'
-            witness = ''.join(self.serialize_witness(x, estimate_size) for x in inputs)
-            return nVersion + marker + flag + txins + txouts + witness + nLocktime
-        else:
-            #print("nVersion:",nVersion)
-            #print('txins:',txins)
-            #print('txouts:',txouts)
-            #print('nLocktime:',nLocktime)
-            #print('total:',nVersion + txins + txouts + nLocktime)
-            return nVersion + txins + txouts + nLocktime
+        use_witness = witness and self.is_segwit()
+        buf = bytearray(struct.pack('<I', self.version & 0xffffffff))
+        if use_witness:
+            buf += b'\x00\x01'  # marker and flag
+        buf += var_int_bytes(len(inputs))
+        for txin in inputs:
+            buf += self.serialize_input_bytes(txin, self.input_script(txin, estimate_size))
+        buf += var_int_bytes(len(outputs))
+        for o in outputs:
+            buf += self.serialize_output_bytes(o)
+        if use_witness:
+            for txin in inputs:
+                buf += bfh(self.serialize_witness(txin, estimate_size))
+        buf += struct.pack('<I', self.locktime)
+        return bytes(buf)
+
+    def _get_hash(self, witness):
+        # only complete transactions are cached: the inputs of incomplete
+        # ones are still being filled in by the wallet
+        key = (witness, self.version, self.locktime)
+        _hash = self._hashes.get(key)
+        if _hash is None:
+            _hash = bh2u(Hash(self.serialize_to_network_bytes(witness=witness))[::-1])
+            if self.is_complete():
+                self._hashes[key] = _hash
+        return _hash
 
     def txid(self):
         self.deserialize()
         all_segwit = all(self.is_segwit_input(x) for x in self.inputs())
         if not all_segwit and not self.is_complete():
             return None
-        ser = self.serialize_to_network(witness=False)
-        return bh2u(Hash(bfh(ser))[::-1])
+        return self._get_hash(witness=False)
 
     def wtxid(self):
         self.deserialize()
         if not self.is_complete():
             return None
-        ser = self.serialize_to_network(witness=True)
-        return bh2u(Hash(bfh(ser))[::-1])
+        return self._get_hash(witness=True)
 
     def add_inputs(self, inputs):
         self._inputs.extend(inputs)
         self.raw = None
+        self.invalidate_ser_cache()
 
     def add_outputs(self, outputs):
         self._outputs.extend(outputs)
         self.raw = None
+        self.invalidate_ser_cache()
 
     def input_value(self):
         return sum(x['value'] for x in self.inputs())
@@ -1250,7 +1188,6 @@ class Transaction:
     def is_final(self):
         return not any([x.get('sequence', 0xffffffff - 1) < 0xffffffff - 1 for x in self.inputs()])
 
-    @profiler
     def estimated_size(self):
         """Return an estimated virtual tx size in vbytes.
         BIP-0141 defines 'Virtual transaction size' to be weight/4 rounded up.
@@ -1265,7 +1202,7 @@ class Transaction:
     def estimated_input_weight(cls, txin):#估计输入重量
         '''Return an estimate of serialized input weight in weight units.'''
         script = cls.input_script(txin, True)
-        input_size = len(cls.serialize_input(txin, script)) // 2
+        input_size = len(cls.serialize_input_bytes(txin, script))
 
         # note: we should actually branch based on tx.is_segwit()
         # only if none of the inputs have a witness, is the size actually 0
@@ -1281,7 +1218,9 @@ class Transaction:
 
     def estimated_total_size(self):
         """Return an estimated total transaction size in bytes."""
-        return len(self.serialize(True)) // 2 if not self.is_complete() or self.raw is None else len(self.raw) // 2  # ASCII hex string
+        if self.raw is not None and self.is_complete():
+            return len(self.raw) // 2  # ASCII hex string
+        return len(self.serialize_to_network_bytes(estimate_size=True))
 
     def estimated_witness_size(self):
         """Return an estimate of witness size in bytes."""
@@ -1289,9 +1228,8 @@ class Transaction:
             return 0
         inputs = self.inputs()
         estimate = not self.is_complete()
-        witness = ''.join(self.serialize_witness(x, estimate) for x in inputs)
-        witness_size = len(witness) // 2 + 2  # include marker and flag
-        return witness_size
+        witness_size = sum(len(self.serialize_witness(x, estimate)) for x in inputs) // 2
+        return witness_size + 2  # include marker and flag
 
     def estimated_base_size(self):
         """Return an estimated base transaction size in bytes."""
@@ -1300,7 +1238,7 @@ class Transaction:
     def estimated_weight(self):
         """Return an estimate of transaction weight."""
         total_tx_size = self.estimated_total_size()
-        base_tx_size = self.estimated_base_size()
+        base_tx_size = total_tx_size - self.estimated_witness_size()
         return 3 * base_tx_size + total_tx_size
 
     def signature_count(self):
@@ -1325,25 +1263,7 @@ class Transaction:
         #使用公钥和私钥进行签名,公钥是X点坐标
         for i, txin in enumerate(self.inputs()):#txin:addresses contains in input
             pubkeys, x_pubkeys = self.get_sorted_pubkeys(txin)#从txin中得到
-            keystore_Myfile = Print('(x_)pubkeys')
-            keystore_Myfile.add_var(txin = txin,pubkeys = pubkeys,x_pubkeys = x_pubkeys)
-
-            with open('./QE_sign.txt','a') as f:
-                try:
-                    f.write('pubkeys:'+ 2*'\n'+str(pubkeys)+ 2*'\n')
-                    f.write('x_pubkeys:' + 2*'\n'+ str(x_pubkeys) + 2*'\n')
-                except:
-                    f.write('Failed written pubkeys!' + 2*'\n')
-
-            with open('./debug_info_var.txt','a') as f:
-                try:
-                    f.write('txin:' + str(txin) + 2*'\n')
-                    f.write('pubkeys:'+str(pubkeys)+ 2*'\n')
-                    f.write('x_pubkeys:' + str(x_pubkeys) + 2*'\n')
-                except:
-                    f.write('txin:' + str(txin) + 2*'\n')
-                    f.write('tx_external_keypairs: can not get' + 'self.tx_external_keypairs' + 2*'\n')
-                    f.write('Transaction.sign_info:not found' + 'Transaction.__class__.__name__' + 2*'\n')
+            trace('sign.input', index=i, txin=txin, pubkeys=pubkeys, x_pubkeys=x_pubkeys)
             #公钥和压缩公钥
             for j, (pubkey, x_pubkey) in enumerate(zip(pubkeys, x_pubkeys)):#同时得到公钥#
                 # 和压缩公钥
@@ -1358,60 +1278,22 @@ class Transaction:
                     continue
                 print_error("adding signature for", _pubkey)#don't know
                 sec, compressed = keypairs.get(_pubkey)   #从keypairs得到私钥和压缩公钥
-
-                keystore_Myfile.add_var(keypairs = keypairs ,sec = sec,compressed = compressed)
-
                 sig = self.sign_txin(i, sec)  #对交易中的输入的第i个地址的私钥进行签名
-
-                keystore_Myfile.add_var(sig = sig)
-
-                with open('./QE_sign.txt', 'a') as f:
-                    try:
-                        f.write('UNsigned_txin:' + 2 * '\n' + str(txin) + 2 * '\n')
-                    except:
-                        f.write('Failed written UNsigned_txin!' + 2 * '\n')
-
                 self.add_signature_to_txin(i, j, sig)
 
-                with open('./QE_sign.txt', 'a') as f:
-                    try:
-                        f.write('signed_txin:' + 2 * '\n' + str(txin) + 2 * '\n')
-                    except:
-                        f.write('Failed written signedtxin!' + 2 * '\n')
-
         print_error("is_complete", self.is_complete())
         self.raw = self.serialize()
 
     def sign_txin(self, txin_index, privkey_bytes) -> str:
-        pre_hash = Hash(bfh(self.serialize_preimage(txin_index)))
-
-        with open('./QE_sign.txt', 'a') as f:
-            try:
-                f.write('pre_hash:' +2*'\n' + str(pre_hash) + 2 * '\n')
-                #f.write('x_pubkeys:' + str(x_pubkeys) + 2 * '\n')
-            except:
-                f.write('Failed written pre_hash!' + 2 * '\n')
-
+        pre_hash = Hash(self.serialize_preimage_bytes(txin_index))
         #获取txin[txin_index]的preimage的信息,对这些信息bfh = bytes.fromhex()后
         # ,即将16进制字符串转为bytes(字节)形式进行hash
         privkey = ecc.ECPrivkey(privkey_bytes)
         #print("privkey",privkey._privkey)
         #print("pubkey",privkey._pubkey)
         sig = privkey.sign_transaction(pre_hash)#prehash完成私钥签名
-
-
-        with open('./QE_sign.txt','a') as f:
-            try:
-                f.write('origin_signatures:'+2*'\n'+str(sig)+2*'\n')
-            except:
-                f.write('Failed written pre_hash!' + 2 * '\n')
-
         sig = bh2u(sig) + '01'
-        with open('./QE_sign.txt','a') as f:
-            try:
-                f.write('add_01_signatures:'+2*'\n'+str(sig)+2*'\n')
-            except:
-                pass
+        trace('sign_txin', index=txin_index, pre_hash=pre_hash, sig=sig)
         return sig
 
     def get_outputs(self):
@@ -21,9 +21,11 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import atexit
 import binascii
 import os, sys, re, json
 from collections import defaultdict
+from contextlib import contextmanager
 from datetime import datetime
 from decimal import Decimal
 import traceback
@@ -135,6 +137,9 @@ class PrintError(object):
         return self.__class__.__name__
 
     def print_error(self, *msg):
+        # the arguments are only formatted in verbose mode
+        if not is_verbose:
+            return
         print_error("[%s]" % self.diagnostic_name(), *msg)
 
     def print_stderr(self, *msg):
@@ -229,6 +234,58 @@ class DaemonThread(threading.Thread, PrintError):
         self.print_error("stopped")
 
 
+class RWLock(object):
+    """ Lock held by any number of readers or by one writer. Waiting
+    writers keep new readers out, so that they are not starved. """
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    def acquire_read(self):
+        with self.cond:
+            while self.writer or self.waiting_writers:
+                self.cond.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.cond:
+            self.readers -= 1
+            if not self.readers:
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        with self.cond:
+            self.waiting_writers += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.waiting_writers -= 1
+            self.writer = True
+
+    def release_write(self):
+        with self.cond:
+            self.writer = False
+            self.cond.notify_all()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
 is_verbose = False
 def set_verbosity(b):
     global is_verbose
@@ -693,7 +750,7 @@ class SocketPipe:
             if response is not None:
                 return response
             try:
-                data = self.socket.recv(1024)
+                data = self.socket.recv(65536)
             except socket.timeout:
                 raise timeout
             except ssl.SSLError:
@@ -702,8 +759,9 @@ class SocketPipe:
                 if err.errno == 60:
                     raise timeout
                 elif err.errno in [11, 35, 10035]:
-                    # print_error("socket errno %d (resource temporarily unavailable)"% err.errno)
-                    time.sleep(0.2)
+                    # resource temporarily unavailable: everything has been
+                    # read from the non-blocking socket. Callers select()
+                    # before reading again, so there is no need to sleep.
                     raise timeout
                 else:
                     print_error("pipe: socket error", err)
@@ -817,57 +875,85 @@ def make_dir(path, allow_symlink=True):
         os.chmod(path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
 
 
-class Print(object):
+class Tracer(PrintError):
     """
-    get the infomation of the var ,include the print path of the var and the
-    function name of var
-    reference:
-    https://www.cnblogs.com/snow-backup/p/4152837.html
+    Opt-in structured tracing, disabled by default. trace() records are
+    json lines; they are queued by the traced thread and appended to the
+    trace file in batches by a daemon thread, so traced code never waits
+    on file I/O.
     """
 
-    def __init__(self, dir_name):
-        # make dir
-        import os
-        import time
-        import re
-        self.path = '/home/tete/Desktop/Debug_info/' + str(dir_name) + re.sub('\s', '_', time.asctime()[4:-5]) + '/'
-        try:
-            os.mkdir(self.path)
-        except:
-            pass
-
-    def add_var(self, **kwargs):  #
-        with open(self.path + '/var.txt', 'a') as f:
-            import sys
-            import os
-            f.write('file_name:  ')
+    def __init__(self):
+        self.path = None
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def enable(self, path):
+        with self.lock:
+            self.path = path
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='Tracer', daemon=True)
+                self.thread.start()
+                atexit.register(self.flush)
+
+    def disable(self):
+        self.flush()
+        self.path = None
+
+    def add(self, event, fields):
+        record = {'time': time.time(), 'event': event}
+        record.update(fields)
+        # serialize now, later the traced objects may have changed
+        self.queue.put(json.dumps(record, default=self.format_value))
+
+    @staticmethod
+    def format_value(obj):
+        # callers pass raw values, formatted only when tracing is on
+        if isinstance(obj, (bytes, bytearray)):
+            return bh2u(obj)
+        if isinstance(obj, (set, frozenset, type({}.keys()))):
+            return list(obj)
+        return str(obj)
+
+    def flush(self):
+        """ wait until the queued records are written """
+        if self.thread is not None:
+            self.queue.join()
+
+    def run(self):
+        while True:
+            lines = [self.queue.get()]
+            while len(lines) < TRACE_BATCH_SIZE:
+                try:
+                    lines.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
             try:
-                f.write(os.path.basename(__file__))
-                f.write(os.path.realpath(sys.argv[0]))
-            except:
-                f.write(os.path.realpath(sys.argv[0]) )
-            f.write(sys.argv[0][sys.argv[0].rfind(os.sep) + 1:])
-            f.write('\n')
-            f.write('func_name:   ')
-            f.write(sys._getframe().f_back.f_code.co_name)
-            f.write('\n')
-            for key, value in kwargs.items():
-                f.write('{}:{!s:3}'.format(key, value))
-                f.write('\n' * 2)
-
-    def add_step(self, text):  #
-        with open(self.path + '/step.txt', 'a') as f:
-            import os
-            import sys
-            f.write('file_name:  ')
-            f.write(sys.argv[0][sys.argv[0].rfind(os.sep) + 1:])
-            f.write('\n')
-            f.write('func_name:   ')
-            f.write(sys._getframe().f_back.f_code.co_name)
-            f.write('\n')
-            f.write(text)
-            f.write('\n' * 2)
-
-    def read_me(self, text):
-        with open(self.path + '/read_me.txt', 'a') as f:
-            f.write(text)
+                path = self.path
+                if path:
+                    with open(path, 'a', encoding='utf-8') as f:
+                        f.write('\n'.join(lines) + '\n')
+            except OSError as e:
+                self.print_error('cannot write trace file', e)
+            finally:
+                for _ in lines:
+                    self.queue.task_done()
+
+
+TRACE_BATCH_SIZE = 1000
+tracer = Tracer()
+
+
+def set_tracing(path):
+    """ write trace() records to path, or disable tracing if path is None """
+    if path:
+        tracer.enable(path)
+    else:
+        tracer.disable()
+
+
+def trace(event, **fields):
+    if tracer.path is None:
+        return
+    tracer.add(event, fields)
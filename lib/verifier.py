@@ -111,7 +111,8 @@ class SPV(ThreadJob):
         self.print_error("verified %s" % tx_hash)
         self.wallet.add_verified_tx(tx_hash, (tx_height, header.get('timestamp'), pos))
         if self.is_up_to_date() and self.wallet.is_up_to_date():
-            self.wallet.save_verified_tx(write=True)
+            self.wallet.save_verified_tx()
+            self.wallet.schedule_write()
 
     @classmethod
     def hash_merkle_root(cls, merkle_s, target_hash, pos):
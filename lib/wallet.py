@@ -32,15 +32,18 @@ import time
 import copy
 import errno
 import json
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 import traceback
 import sys
 import itertools
+import bisect
+import heapq
 from operator import itemgetter
-from functools import reduce
 
 from .i18n import _
 from .util import NotEnoughFunds, PrintError, UserCancelled, profiler, format_satoshis, InvalidPassword, WalletFileException, TimeoutException
+from .util import ThreadJob
+from .util import trace
 from .qtum import *
 from .version import *
 from .keystore import load_keystore, Hardware_KeyStore
@@ -69,6 +72,9 @@ TX_STATUS = [
     _('Local'),
 ]
 
+# seconds a deferred wallet write may wait for more changes
+WRITE_DELAY = 10
+
 TX_HEIGHT_LOCAL = -2
 TX_HEIGHT_UNCONF_PARENT = -1
 TX_HEIGHT_UNCONFIRMED = 0
@@ -157,6 +163,238 @@ def sweep(privkeys, network, config, recipient, fee=None, imax=100):
     return tx
 
 
+# balance is (confirmed, unconfirmed, unmatured); utxos are in the format
+# of get_addr_utxo. unmatured is set if the balance depends on local_height.
+AddrIndexEntry = namedtuple('AddrIndexEntry', ['balance', 'utxos', 'local_height', 'unmatured'])
+
+
+class HistoryTimeline(object):
+    """
+    Transactions of a set of addresses sorted by get_txpos, with the
+    running balance after each of them. Changed transactions are marked
+    with invalidate() and moved to their new position on the next
+    refresh, which only recomputes the running balances after the first
+    moved position.
+    """
+
+    def __init__(self, domain=None):
+        # None means all addresses of the wallet
+        self.domain = domain
+        # the addresses of the wallet at the last rebuild, for domain None
+        self.addresses = None
+        self.keys = []        # (txpos, tx_hash), sorted
+        self.deltas = []
+        self.timestamps = []  # None for unconfirmed transactions
+        self.balances = []    # running sum of deltas
+        self.max_ts = []      # prefix max of timestamps, for bisect
+        self.min_ts = []      # suffix min of timestamps, for bisect
+        self.positions = {}   # tx_hash -> key
+        self.dirty = set()
+
+    def invalidate(self, tx_hash):
+        self.dirty.add(tx_hash)
+
+    def get_total(self):
+        return self.balances[-1] if self.balances else 0
+
+    def refresh(self, wallet):
+        """ Callers hold wallet.lock and wallet.transaction_lock """
+        domain = self.domain if self.domain is not None else set(wallet.get_addresses())
+        if domain != self.addresses or len(self.dirty) > len(self.keys) // 4:
+            self.rebuild(wallet, domain)
+            return
+        if not self.dirty:
+            return
+        first = len(self.keys)
+        for tx_hash in self.dirty:
+            key = self.positions.pop(tx_hash, None)
+            if key is not None:
+                i = bisect.bisect_left(self.keys, key)
+                del self.keys[i], self.deltas[i], self.timestamps[i]
+                first = min(first, i)
+            # the transaction is in the local history of these addresses
+            addrs = [addr for addr in set(itertools.chain(wallet.txi.get(tx_hash, []), wallet.txo.get(tx_hash, [])))
+                     if addr in domain and tx_hash in wallet._history_local.get(addr, ())]
+            if not addrs:
+                continue
+            key, delta, timestamp = self.make_row(wallet, tx_hash, addrs)
+            i = bisect.bisect_left(self.keys, key)
+            self.keys.insert(i, key)
+            self.deltas.insert(i, delta)
+            self.timestamps.insert(i, timestamp)
+            self.positions[tx_hash] = key
+            first = min(first, i)
+        self.dirty.clear()
+        self.update_sums(first)
+
+    def rebuild(self, wallet, domain):
+        # from the local history of the domain, not every transaction
+        tx_addrs = defaultdict(list)
+        for addr in domain:
+            for tx_hash in wallet._history_local.get(addr, ()):
+                tx_addrs[tx_hash].append(addr)
+        rows = [self.make_row(wallet, tx_hash, addrs) for tx_hash, addrs in tx_addrs.items()]
+        rows.sort(key=itemgetter(0))
+        self.keys = [row[0] for row in rows]
+        self.deltas = [row[1] for row in rows]
+        self.timestamps = [row[2] for row in rows]
+        self.positions = {key[1]: key for key in self.keys}
+        self.addresses = domain if self.domain is None else None
+        self.dirty.clear()
+        self.balances = []
+        self.max_ts = []
+        self.min_ts = []
+        self.update_sums(0)
+
+    @classmethod
+    def make_row(cls, wallet, tx_hash, addrs):
+        delta = sum(wallet.get_tx_delta(tx_hash, addr) for addr in addrs)
+        timestamp = wallet.get_tx_height(tx_hash)[2]
+        return (wallet.get_txpos(tx_hash), tx_hash), delta, timestamp
+
+    def update_sums(self, first):
+        n = len(self.keys)
+        inf = float('inf')
+        del self.balances[first:]
+        del self.max_ts[first:]
+        balance = self.balances[-1] if first else 0
+        max_ts = self.max_ts[-1] if first else -inf
+        for i in range(first, n):
+            balance += self.deltas[i]
+            ts = self.timestamps[i]
+            max_ts = max(max_ts, inf if ts is None else ts)
+            self.balances.append(balance)
+            self.max_ts.append(max_ts)
+        # suffix minimums: recompute the changed tail, then walk down
+        # until the values before it stop changing
+        del self.min_ts[first:]
+        tail = []
+        m = inf
+        for i in range(n - 1, first - 1, -1):
+            ts = self.timestamps[i]
+            m = min(m, inf if ts is None else ts)
+            tail.append(m)
+        tail.reverse()
+        self.min_ts.extend(tail)
+        for i in range(first - 1, -1, -1):
+            ts = self.timestamps[i]
+            m = min(m, inf if ts is None else ts)
+            if self.min_ts[i] == m:
+                break
+            self.min_ts[i] = m
+
+    def get_rows(self, from_timestamp=None, to_timestamp=None, offset=0, limit=None, newest_first=False,
+                 from_height=None, to_height=None, after=None):
+        """ list of (tx_hash, delta, balance). after is the key of the
+        last row of the previous page. """
+        start, end = 0, len(self.keys)
+        now = time.time()
+        # keys are ((height, pos), tx_hash); unconfirmed transactions come
+        # last, with heights above any block
+        if from_height:
+            start = bisect.bisect_left(self.keys, ((from_height, -1),))
+        if to_height:
+            end = bisect.bisect_left(self.keys, ((to_height, -1),))
+        if after is not None:
+            if newest_first:
+                end = min(end, bisect.bisect_left(self.keys, after))
+            else:
+                start = max(start, bisect.bisect_right(self.keys, after))
+        if from_timestamp:
+            start = max(start, bisect.bisect_left(self.max_ts, from_timestamp))
+        if to_timestamp and to_timestamp <= now:
+            end = min(end, bisect.bisect_left(self.min_ts, to_timestamp))
+        indices = range(end - 1, start - 1, -1) if newest_first else range(start, end)
+        if from_timestamp or to_timestamp:
+            # timestamps are not strictly monotonic: filter within the bounds
+            indices = [i for i in indices
+                       if (not from_timestamp or (self.timestamps[i] or now) >= from_timestamp)
+                       and (not to_timestamp or (self.timestamps[i] or now) < to_timestamp)]
+        indices = indices[offset:None if limit is None else offset + limit]
+        return [(self.keys[i][1], self.deltas[i], self.balances[i]) for i in indices]
+
+
+class TokenTransfers(object):
+    """
+    Transfer events of the token history of a contract_bind key, sorted
+    by the (height, call_index, log_index) of the history. Kept up to
+    date when the history or one of its receipts changes, by removing
+    and inserting the transfers of the changed transactions only.
+    """
+
+    def __init__(self, key):
+        self.contract_addr, bind_addr = key.split('_')
+        _, hash160b = b58_address_to_hash160(bind_addr)
+        self.hash160 = bh2u(hash160b).zfill(64)
+        # txid -> [(height, log_index)] of the history
+        self.history = defaultdict(list)
+        # sorted (height, call_index, log_index, txid)
+        self.positions = []
+        # (txid, call_index, log_index) -> (from, to, amount)
+        self.transfers = {}
+
+    def set_history(self, hist, get_events):
+        new = defaultdict(list)
+        for txid, height, log_index in hist:
+            new[txid].append((height, log_index))
+        for txid in [txid for txid in self.history if self.history[txid] != new.get(txid)]:
+            self.remove(txid)
+        for txid, entries in new.items():
+            if txid not in self.history:
+                self.history[txid] = entries
+                self._add(txid, entries, get_events(txid))
+
+    def update_receipt(self, txid, events):
+        entries = self.history.get(txid)
+        if entries:
+            self._remove(txid, entries)
+            self._add(txid, entries, events)
+
+    def remove(self, txid):
+        self._remove(txid, self.history.pop(txid, []))
+
+    def _add(self, txid, entries, events):
+        for height, log_index in entries:
+            # the log index of the history applies to every contract call
+            for (call_index, i), event in events.items():
+                if i != log_index:
+                    continue
+                address, from_addr, to_addr, amount, topics = event
+                if address != self.contract_addr or self.hash160 not in topics:
+                    continue
+                bisect.insort(self.positions, (height, call_index, log_index, txid))
+                self.transfers[(txid, call_index, log_index)] = (from_addr, to_addr, amount)
+
+    def _remove(self, txid, entries):
+        for height, log_index in entries:
+            lo = bisect.bisect_left(self.positions, (height,))
+            hi = bisect.bisect_left(self.positions, (height + 1,))
+            kept = []
+            for position in self.positions[lo:hi]:
+                if position[3] == txid and position[2] == log_index:
+                    self.transfers.pop((txid, position[1], log_index), None)
+                else:
+                    kept.append(position)
+            self.positions[lo:hi] = kept
+
+    def iter_newest_first(self):
+        """ (height, call_index, log_index, txid, from, to, amount) """
+        for position in reversed(self.positions):
+            height, call_index, log_index, txid = position
+            yield position + self.transfers[(txid, call_index, log_index)]
+
+
+class WalletWriter(ThreadJob):
+    """ Writes the wallet when a deferred write is due. Run by the network
+    thread, so that wallet events of one burst end up in one write. """
+
+    def __init__(self, wallet):
+        self.wallet = wallet
+
+    def run(self):
+        self.wallet.write_if_due()
+
+
 class AddTransactionException(Exception):
     pass
 
@@ -204,6 +442,11 @@ class Abstract_Wallet(PrintError):
         self.token_history = storage.get('addr_token_history', {})
         # txid -> tx receipt
         self.tx_receipt = storage.get('tx_receipt', {})
+        # txid -> decoded Transfer logs of the receipt, and token key ->
+        # TokenTransfers of its history, made on demand and then kept up to
+        # date. Access with self.token_lock.
+        self._transfer_events = {}
+        self._token_index = {}
 
         self.receive_requests = storage.get('payment_requests', {})
 
@@ -213,12 +456,33 @@ class Abstract_Wallet(PrintError):
         # Transactions pending verification.  txid -> tx_height. Access with self.lock.
         self.unverified_tx = defaultdict(int)
 
+        # address -> AddrIndexEntry. Entries are dropped when a transaction
+        # touching the address is added, removed or changes height.
+        # Access with self.lock and self.transaction_lock.
+        self._addr_index = {}
+        # history of all wallet addresses, same locking
+        self._history = HistoryTimeline()
+        # address -> set(txid) of txi and txo, made on first use of
+        # _history_local. Access with self.transaction_lock.
+        self._local_history = None
+
+        # sections ('transactions', 'verified_tx') that changed since they
+        # were put into storage, and when a deferred write is due. They are
+        # put right before the storage is written. Access with self.lock.
+        self._unsaved = set()
+        # storage key -> items of that section of _put_transactions that
+        # changed since it was put, None if all of them did. Access with
+        # self.transaction_lock (self.token_lock for the token sections).
+        self._unsaved_items = {}
+        self._write_due = None
+        self.writer = None
+        storage.add_write_hook(self.put_unsaved)
+
         self.load_keystore()
         self.load_addresses()
         self.test_addresses_sanity()
 
         self.load_transactions()
-        self.load_local_history()
         self.load_token_txs()
         self.check_history()
         self.check_token_history()
@@ -251,70 +515,133 @@ class Abstract_Wallet(PrintError):
 
     @profiler
     def load_transactions(self):
-        # load txi, txo, tx_fees
+        # load txi, txo, tx_fees. The inputs of txi stay lists as loaded
+        # until add_transaction makes them sets to add to them
         self.txi = self.storage.get('txi', {})
-        for txid, d in list(self.txi.items()):
-            for addr, lst in d.items():
-                self.txi[txid][addr] = set([tuple(x) for x in lst])
         self.txo = self.storage.get('txo', {})
         self.tx_fees = self.storage.get('tx_fees', {})
         tx_list = self.storage.get('transactions', {})
-        # load transactions
+        # load transactions. They keep their raw hex and are only
+        # deserialized when their inputs or outputs are first needed
         self.transactions = {}
         for tx_hash, raw in tx_list.items():
-            tx = Transaction(raw)
-            self.transactions[tx_hash] = tx
-            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None:
+            if tx_hash in self.txi or tx_hash in self.txo:
+                self.transactions[tx_hash] = Transaction(raw)
+            else:
                 self.print_error("removing unreferenced tx", tx_hash)
-                self.transactions.pop(tx_hash)
+                self._note_unsaved('transactions', [tx_hash])
         # load spent_outpoints
         _spent_outpoints = self.storage.get('spent_outpoints', {})
         self.spent_outpoints = defaultdict(dict)
         for prevout_hash, d in _spent_outpoints.items():
-            for prevout_n_str, spending_txid in d.items():
-                prevout_n = int(prevout_n_str)
-                self.spent_outpoints[prevout_hash][prevout_n] = spending_txid
+            self.spent_outpoints[prevout_hash] = {int(n): txid for n, txid in d.items()}
 
     @profiler
     def load_local_history(self):
-        self._history_local = {}  # address -> set(txid)
-        for txid in itertools.chain(self.txi, self.txo):
-            self._add_tx_to_local_history(txid)
+        history_local = defaultdict(set)  # address -> set(txid)
+        with self.transaction_lock:
+            for d in (self.txi, self.txo):
+                for txid, addrs in d.items():
+                    for addr in addrs:
+                        history_local[addr].add(txid)
+            self._local_history = dict(history_local)
+
+    @property
+    def _history_local(self):
+        with self.transaction_lock:
+            if self._local_history is None:
+                self.load_local_history()
+            return self._local_history
 
+    @profiler
     def remove_local_transactions_we_dont_have(self):
         txid_set = set(self.txi) | set(self.txo)
-        for txid in txid_set:
+        for txid in txid_set.difference(self.transactions):
             tx_height = self.get_tx_height(txid)[0]
-            if tx_height == TX_HEIGHT_LOCAL and txid not in self.transactions:
+            if tx_height == TX_HEIGHT_LOCAL:
                 self.remove_transaction(txid)
 
-    @profiler
     def save_transactions(self, write=False):
-        with self.transaction_lock, self.token_lock:
-            tx = {}
-            for k, v in self.transactions.items():
-                tx[k] = str(v)
-            self.storage.put('transactions', tx)
-            self.storage.put('txi', self.txi)
-            self.storage.put('txo', self.txo)
-            self.storage.put('tx_fees', self.tx_fees)
-            self.storage.put('addr_history', self.history)
-            self.storage.put('addr_token_history', self.token_history)
-            self.storage.put('tx_receipt', self.tx_receipt)
-            self.storage.put('spent_outpoints', self.spent_outpoints)
-
-            token_txs = {}
-            for txid, tx in self.token_txs.items():
-                token_txs[txid] = str(tx)
-            self.storage.put('token_txs', token_txs)
-            if write:
-                self.storage.write()
+        with self.lock:
+            self._unsaved.add('transactions')
+        if write:
+            self.storage.write()
 
     def save_verified_tx(self, write=False):
         with self.lock:
-            self.storage.put('verified_tx3', self.verified_tx)
-            if write:
-                self.storage.write()
+            self._unsaved.add('verified_tx')
+        if write:
+            self.storage.write()
+
+    def schedule_write(self):
+        '''Write the wallet within WRITE_DELAY seconds. Later calls until
+        then share the same write. Without a network thread to run the
+        writer, the wallet is written right away.'''
+        if self.writer is None:
+            self.storage.write()
+            return
+        with self.lock:
+            if self._write_due is None:
+                self._write_due = time.time() + WRITE_DELAY
+
+    def write_if_due(self):
+        with self.lock:
+            if self._write_due is None or time.time() < self._write_due:
+                return
+            self._write_due = None
+        self.storage.write()
+
+    @profiler
+    def put_unsaved(self):
+        with self.lock:
+            unsaved = self._unsaved
+            self._unsaved = set()
+        if 'transactions' in unsaved:
+            self._put_transactions()
+        if 'verified_tx' in unsaved:
+            with self.lock:
+                self.storage.put('verified_tx3', self.verified_tx)
+
+    def _note_unsaved(self, key, items):
+        """ note the items of section key of _put_transactions that
+        changed, or all of them if items is None """
+        noted = self._unsaved_items.setdefault(key, set())
+        if items is None:
+            self._unsaved_items[key] = None
+        elif noted is not None:
+            noted.update(items)
+
+    def _put_transactions(self):
+        with self.transaction_lock, self.token_lock:
+            unsaved = self._unsaved_items
+            self._unsaved_items = {}
+            self._put_raw_transactions('transactions', self.transactions, unsaved.get('transactions', set()))
+            for key, value in [('txi', self.txi),
+                               ('txo', self.txo),
+                               ('tx_fees', self.tx_fees),
+                               ('addr_history', self.history),
+                               ('addr_token_history', self.token_history),
+                               ('tx_receipt', self.tx_receipt),
+                               ('spent_outpoints', self.spent_outpoints)]:
+                items = unsaved.get(key, set())
+                if items is None:
+                    self.storage.put(key, value)
+                else:
+                    self.storage.put_items(key, value, items)
+            self._put_raw_transactions('token_txs', self.token_txs, unsaved.get('token_txs', set()))
+
+    def _put_raw_transactions(self, key, transactions, items):
+        # the storage holds the raw hex of the transactions
+        raw = self.storage.get(key)
+        if items is None or raw is None:
+            self.storage.put(key, {txid: str(tx) for txid, tx in transactions.items()})
+            return
+        for txid in items:
+            if txid in transactions:
+                raw[txid] = str(transactions[txid])
+            else:
+                raw.pop(txid, None)
+        self.storage.put_items(key, raw, items)
 
     def clear_history(self):
         with self.lock:
@@ -329,6 +656,15 @@ class Abstract_Wallet(PrintError):
                 self.token_history = {}
                 self.tx_receipt = {}
                 self.token_txs = {}
+                self._transfer_events = {}
+                self._token_index = {}
+                self._addr_index = {}
+                self._history = HistoryTimeline()
+                self._local_history = None
+                # all of them are new objects
+                self._unsaved_items = dict.fromkeys(['transactions', 'txi', 'txo', 'tx_fees', 'addr_history',
+                                                     'addr_token_history', 'tx_receipt', 'spent_outpoints',
+                                                     'token_txs'])
                 self.save_transactions()
 
     @profiler
@@ -338,6 +674,8 @@ class Abstract_Wallet(PrintError):
         hist_addrs_not_mine = list(filter(lambda k: not self.is_mine(k), self.history.keys()))
         for addr in hist_addrs_not_mine:
             self.history.pop(addr)
+            with self.transaction_lock:
+                self._note_unsaved('addr_history', [addr])
             save = True
 
         for addr in hist_addrs_mine:
@@ -381,11 +719,12 @@ class Abstract_Wallet(PrintError):
         with self.lock:
             self.up_to_date = up_to_date
         if up_to_date:
-            self.save_transactions(write=True)
+            self.save_transactions()
             # if the verifier is also up to date, persist that too;
             # otherwise it will persist its results when it finishes
             if self.verifier and self.verifier.is_up_to_date():
-                self.save_verified_tx(write=True)
+                self.save_verified_tx()
+            self.schedule_write()
 
     def is_up_to_date(self):
         with self.lock: return self.up_to_date
@@ -444,19 +783,23 @@ class Abstract_Wallet(PrintError):
                 and tx_hash in self.verified_tx:
             with self.lock:
                 self.verified_tx.pop(tx_hash)
+                self._on_tx_changed(tx_hash)
             if self.verifier:
                 self.verifier.remove_spv_proof_for_tx(tx_hash)
 
         # tx will be verified only if height > 0
         if tx_hash not in self.verified_tx:
             with self.lock:
-                self.unverified_tx[tx_hash] = tx_height
+                if self.unverified_tx.get(tx_hash) != tx_height:
+                    self.unverified_tx[tx_hash] = tx_height
+                    self._on_tx_changed(tx_hash)
 
     def add_verified_tx(self, tx_hash, info):
         # Remove from the unverified map and add to the verified map and
         with self.lock:
             self.unverified_tx.pop(tx_hash, None)
             self.verified_tx[tx_hash] = info  # (tx_height, timestamp, pos)
+            self._on_tx_changed(tx_hash)
         height, conf, timestamp = self.get_tx_height(tx_hash)
         if isinstance(height, tuple):
             print('catch you add_verified_tx', height)
@@ -479,6 +822,7 @@ class Abstract_Wallet(PrintError):
                     # fixme: use block hash, not timestamp
                     if not header or header.get('timestamp') != timestamp:
                         self.verified_tx.pop(tx_hash, None)
+                        self._on_tx_changed(tx_hash)
                         txs.add(tx_hash)
         return txs
 
@@ -644,47 +988,41 @@ class Abstract_Wallet(PrintError):
         received = {}
         sent = {}
         for tx_hash, height in h:
-            l = self.txo.get(tx_hash, {}).get(address, [])
-            for n, v, is_cb in l:
-                received[tx_hash + ':%d'%n] = (height, v, is_cb)
-        for tx_hash, height in h:
-            l = self.txi.get(tx_hash, {}).get(address, [])
-            for txi, v in l:
-                sent[txi] = height
+            d = self.txo.get(tx_hash)
+            if d and address in d:
+                for n, v, is_cb in d[address]:
+                    received[tx_hash + ':%d'%n] = (height, v, is_cb)
+            d = self.txi.get(tx_hash)
+            if d and address in d:
+                for txi, v in d[address]:
+                    sent[txi] = height
         return received, sent
 
-    def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
-        out = []
-        for txo, v in coins.items():
-            tx_height, value, is_cb = v
-            prevout_hash, prevout_n = txo.split(':')
-            x = {
-                'address':address,
-                'value':value,
-                'prevout_n':int(prevout_n),
-                'prevout_hash':prevout_hash,
-                'height':tx_height,
-                'coinbase':is_cb
-            }
-            out.append(x)
-        return out
-
-    # return the total amount ever received by an address
-    def get_addr_received(self, address):
-        received, sent = self.get_addr_io(address)
-        return sum([v for height, v, is_cb in received.values()])
+    def _on_tx_changed(self, tx_hash):
+        """ drop the address index entries and history position derived from tx_hash """
+        with self.transaction_lock:
+            for addr in itertools.chain(self.txi.get(tx_hash, []), self.txo.get(tx_hash, [])):
+                self._addr_index.pop(addr, None)
+            self._history.invalidate(tx_hash)
 
-    # return the balance of a bitcoin address: confirmed and matured, unconfirmed, unmatured
-    def get_addr_balance(self, address):
+    def _get_addr_index(self, address, local_height):
+        with self.lock, self.transaction_lock:
+            entry = self._addr_index.get(address)
+            # coinbase maturity is the only thing that depends on local_height
+            if entry is None or (entry.unmatured and entry.local_height != local_height):
+                entry = self._build_addr_index(address, local_height)
+                self._addr_index[address] = entry
+            return entry
+
+    def _build_addr_index(self, address, local_height):
         received, sent = self.get_addr_io(address)
         c = u = x = 0
-        local_height = self.get_local_height()
+        unmatured = False
+        utxos = []
         for txo, (tx_height, v, is_cb) in received.items():
             if is_cb and tx_height + COINBASE_MATURITY > local_height:
                 x += v
+                unmatured = True
             elif tx_height > 0:
                 c += v
             else:
@@ -694,7 +1032,30 @@ class Abstract_Wallet(PrintError):
                     c -= v
                 else:
                     u -= v
-        return c, u, x
+            else:
+                prevout_hash, prevout_n = txo.split(':')
+                utxos.append({
+                    'address':address,
+                    'value':v,
+                    'prevout_n':int(prevout_n),
+                    'prevout_hash':prevout_hash,
+                    'height':tx_height,
+                    'coinbase':is_cb
+                })
+        return AddrIndexEntry((c, u, x), utxos, local_height, unmatured)
+
+    def get_addr_utxo(self, address):
+        entry = self._get_addr_index(address, self.get_local_height())
+        return [dict(x) for x in entry.utxos]
+
+    # return the total amount ever received by an address
+    def get_addr_received(self, address):
+        received, sent = self.get_addr_io(address)
+        return sum([v for height, v, is_cb in received.values()])
+
+    # return the balance of a bitcoin address: confirmed and matured, unconfirmed, unmatured
+    def get_addr_balance(self, address):
+        return self._get_addr_index(address, self.get_local_height()).balance
 
     def get_spendable_coins(self, domain, config):
         confirmed_only = config.get('confirmed_only', False)
@@ -707,15 +1068,15 @@ class Abstract_Wallet(PrintError):
         domain = set(domain)
         if exclude_frozen:
             domain = set(domain) - self.frozen_addresses
-        for addr in domain:
-            utxos = self.get_addr_utxo(addr)
-            for x in utxos:
-                if confirmed_only and x['height'] <= 0:
-                    continue
-                if mature and x['coinbase'] and x['height'] + COINBASE_MATURITY > self.get_local_height():
-                    continue
-                coins.append(x)
-                continue
+        local_height = self.get_local_height()
+        with self.lock, self.transaction_lock:
+            for addr in domain:
+                for x in self._get_addr_index(addr, local_height).utxos:
+                    if confirmed_only and x['height'] <= 0:
+                        continue
+                    if mature and x['coinbase'] and x['height'] + COINBASE_MATURITY > local_height:
+                        continue
+                    coins.append(dict(x))
         return coins
 
     def dummy_address(self):
@@ -728,9 +1089,11 @@ class Abstract_Wallet(PrintError):
 
     def get_addresses_sort_by_balance(self):
         addrs = []
-        for addr in self.get_addresses():
-            c, u, x = self.get_addr_balance(addr)
-            addrs.append((addr, c + u))
+        local_height = self.get_local_height()
+        with self.lock, self.transaction_lock:
+            for addr in self.get_addresses():
+                c, u, x = self._get_addr_index(addr, local_height).balance
+                addrs.append((addr, c + u))
         return list([addr[0] for addr in sorted(addrs, key=lambda y: (-int(y[1]), y[0]))])
 
     def get_spendable_addresses(self, min_amount=0.000000001):
@@ -749,11 +1112,13 @@ class Abstract_Wallet(PrintError):
             domain = self.get_addresses()
         domain = set(domain)
         cc = uu = xx = 0
-        for addr in domain:
-            c, u, x = self.get_addr_balance(addr)
-            cc += c
-            uu += u
-            xx += x
+        local_height = self.get_local_height()
+        with self.lock, self.transaction_lock:
+            for addr in domain:
+                c, u, x = self._get_addr_index(addr, local_height).balance
+                cc += c
+                uu += u
+                xx += x
         return cc, uu, xx
 
     def get_address_history(self, addr):
@@ -762,8 +1127,12 @@ class Abstract_Wallet(PrintError):
         # so we need to take that too here, to enforce order of locks
         with self.lock, self.transaction_lock:
             related_txns = self._history_local.get(addr, set())
+            # same heights as get_tx_height, without computing confirmations
             for tx_hash in related_txns:
-                tx_height = self.get_tx_height(tx_hash)[0]
+                if tx_hash in self.verified_tx:
+                    tx_height = self.verified_tx[tx_hash][0]
+                else:
+                    tx_height = self.unverified_tx.get(tx_hash, TX_HEIGHT_LOCAL)
                 h.append((tx_hash, tx_height))
         return h
 
@@ -920,6 +1289,7 @@ class Abstract_Wallet(PrintError):
                 prevout_n = txi['prevout_n']
                 ser = prevout_hash + ':%d' % prevout_n
                 self.spent_outpoints[prevout_hash][prevout_n] = tx_hash
+                self._note_unsaved('spent_outpoints', [prevout_hash])
                 add_value_from_prev_output()
 
             # add outputs
@@ -938,14 +1308,21 @@ class Abstract_Wallet(PrintError):
                     dd = self.txi.get(next_tx, {})
                     if dd.get(addr) is None:
                         dd[addr] = set()
+                    elif not isinstance(dd[addr], set):
+                        dd[addr] = set(map(tuple, dd[addr]))
                     if (ser, v) not in dd[addr]:
                         dd[addr].add((ser, v))
+                    self._note_unsaved('txi', [next_tx])
                     self._add_tx_to_local_history(next_tx)
+                    self._on_tx_changed(next_tx)
 
             # add to local history
             self._add_tx_to_local_history(tx_hash)
+            self._on_tx_changed(tx_hash)
             # save
             self.transactions[tx_hash] = tx
+            for key in ['transactions', 'txi', 'txo', 'spent_outpoints']:
+                self._note_unsaved(key, [tx_hash])
             return True
 
     def remove_transaction(self, tx_hash):
@@ -959,6 +1336,7 @@ class Abstract_Wallet(PrintError):
                     prevout_hash = txin['prevout_hash']
                     prevout_n = txin['prevout_n']
                     self.spent_outpoints[prevout_hash].pop(prevout_n, None)
+                    self._note_unsaved('spent_outpoints', [prevout_hash])
                     if not self.spent_outpoints[prevout_hash]:
                         self.spent_outpoints.pop(prevout_hash)
             else:  # expensive but always works
@@ -966,6 +1344,7 @@ class Abstract_Wallet(PrintError):
                     for prevout_n, spending_txid in d.items():
                         if spending_txid == tx_hash:
                             self.spent_outpoints[prevout_hash].pop(prevout_n, None)
+                            self._note_unsaved('spent_outpoints', [prevout_hash])
                             if not self.spent_outpoints[prevout_hash]:
                                 self.spent_outpoints.pop(prevout_hash)
             # Remove this tx itself; if nothing spends from it.
@@ -979,8 +1358,11 @@ class Abstract_Wallet(PrintError):
             tx = self.transactions.pop(tx_hash, None)
             remove_from_spent_outpoints()
             self._remove_tx_from_local_history(tx_hash)
+            self._on_tx_changed(tx_hash)
             self.txi.pop(tx_hash, None)
             self.txo.pop(tx_hash, None)
+            for key in ['transactions', 'txi', 'txo', 'spent_outpoints']:
+                self._note_unsaved(key, [tx_hash])
 
     def receive_tx_callback(self, tx_hash, tx, tx_height):
         self.add_unverified_tx(tx_hash, tx_height)
@@ -994,9 +1376,12 @@ class Abstract_Wallet(PrintError):
                     # make tx local
                     self.unverified_tx.pop(tx_hash, None)
                     self.verified_tx.pop(tx_hash, None)
+                    self._on_tx_changed(tx_hash)
                     if self.verifier:
                         self.verifier.remove_spv_proof_for_tx(tx_hash)
             self.history[addr] = hist
+            with self.transaction_lock:
+                self._note_unsaved('addr_history', [addr])
 
         for tx_hash, tx_height in hist:
             # add it in case it was previously unconfirmed
@@ -1008,58 +1393,46 @@ class Abstract_Wallet(PrintError):
             self.add_transaction(tx_hash, tx, allow_unrelated=True)
 
         # Store fees
-        self.tx_fees.update(tx_fees)
-
-    def get_history(self, domain=None, from_timestamp=None, to_timestamp=None):
-
-        # get domain
-        if domain is None:
-            domain = self.get_addresses()
-        domain = set(domain)
-        # 1. Get the history of each address in the domain, maintain the
-        #    delta of a tx as the sum of its deltas on domain addresses
-        tx_deltas = defaultdict(int)
-        for addr in domain:
-            h = self.get_address_history(addr)
-            for tx_hash, height in h:
-                delta = self.get_tx_delta(tx_hash, addr)
-                if delta is None or tx_deltas[tx_hash] is None:
-                    tx_deltas[tx_hash] = None
-                else:
-                    tx_deltas[tx_hash] += delta
-
-        # 2. create sorted history
-        history = []
-        for tx_hash in tx_deltas:
-            delta = tx_deltas[tx_hash]
-            height, conf, timestamp = self.get_tx_height(tx_hash)
-            history.append((tx_hash, height, conf, timestamp, delta))
+        with self.transaction_lock:
+            self.tx_fees.update(tx_fees)
+            self._note_unsaved('tx_fees', tx_fees)
 
-        history.sort(key=lambda x: self.get_txpos(x[0]))
-        history.reverse()
+    def get_history(self, domain=None, from_timestamp=None, to_timestamp=None,
+                    offset=0, limit=None, newest_first=False):
+        return list(self.iter_history(domain, from_timestamp, to_timestamp,
+                                      offset, limit, newest_first))
 
-        # 3. add balance
-        c, u, x = self.get_balance(domain)
-        balance = c + u + x
-        h2 = []
-        for tx_hash, height, conf, timestamp, delta in history:
-            if from_timestamp and (timestamp or time.time()) < from_timestamp:
-                continue
-            if to_timestamp and (timestamp or time.time()) >= to_timestamp:
-                continue
-            h2.append((tx_hash, height, conf, timestamp, delta, balance))
-            if balance is None or delta is None:
-                balance = None
+    def iter_history(self, domain=None, from_timestamp=None, to_timestamp=None,
+                     offset=0, limit=None, newest_first=False,
+                     from_height=None, to_height=None, after=None):
+        """
+        Yield (tx_hash, height, conf, timestamp, delta, balance) ordered by
+        position in the blockchain, oldest first unless newest_first.
+        offset and limit apply after the height and timestamp filters.
+        after is the (get_txpos, tx_hash) of the last transaction of a
+        previous page; the rows that follow it are yielded. The history of
+        all addresses is kept up to date between calls; other domains
+        are computed on each call, from the history of their addresses.
+        """
+        with self.lock, self.transaction_lock:
+            addresses = self.get_addresses()
+            if domain is not None and set(domain) != set(addresses):
+                timeline = HistoryTimeline(set(domain))
             else:
-                balance -= delta
-        h2.reverse()
-
-        if not from_timestamp and not to_timestamp:
-            # fixme: this may happen if history is incomplete
-            if balance not in [None, 0]:
+                timeline = self._history
+                domain = addresses
+            timeline.refresh(self)
+            c, u, x = self.get_balance(domain)
+            # non-zero if history is incomplete
+            balance_offset = c + u + x - timeline.get_total()
+            if not from_timestamp and not to_timestamp and balance_offset:
                 self.print_error("Error: history not synchronized")
-                return []
-        return h2
+                return
+            rows = timeline.get_rows(from_timestamp, to_timestamp, offset, limit, newest_first,
+                                     from_height, to_height, after)
+        for tx_hash, delta, balance in rows:
+            height, conf, timestamp = self.get_tx_height(tx_hash)
+            yield tx_hash, height, conf, timestamp, delta, balance + balance_offset
 
     def get_label(self, tx_hash):
         label = self.labels.get(tx_hash, '')
@@ -1162,17 +1535,8 @@ class Abstract_Wallet(PrintError):
             raise Exception('Dynamic fee estimates not available')
 
         for item in inputs:#打印don't know
-            with open('./add_input_info.txt', 'a') as f:
-                try:
-                    f.write('file:wallet,func:add_input_info,var:item:' + str(item) + '\n')
-                except:
-                    pass
             self.add_input_info(item)
-            with open('./add_input_info.txt', 'a') as f:
-                try:
-                    f.write('file:wallet,var:add_input_info(item)' +str(item)+ '\n')
-                except:
-                    pass
+            trace('add_input_info', txin=item)
 
         # change address:找零地址
         if change_addr:#合约时必然执行该步骤,change_addr就是sender
@@ -1222,13 +1586,7 @@ class Abstract_Wallet(PrintError):
             outputs[i_max] = (_type, data, amount)
             tx = Transaction.from_io(inputs, outputs[:])#相当于找零全部放在一个地址上
 
-        with open('./debug_info_var.txt', 'a') as f:
-            try:
-                f.write('file:wallet,var:tx,' + str(tx) + '\n')
-            except:
-                pass
-
-                # Sort the inputs and outputs deterministically
+        # Sort the inputs and outputs deterministically
         #确切的排列input和output
         # tx.BIP_LI01_sort()
         #在发送token时该步骤不会执行
@@ -1259,16 +1617,25 @@ class Abstract_Wallet(PrintError):
             return True
         return False
 
+    @profiler
     def load_unverified_transactions(self):
+        # add_unverified_tx is a no-op for verified transactions that are
+        # still mined, which is nearly all of them when opening a wallet
+        unconfirmed = (TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT)
+        verified_tx = self.verified_tx
         # review transactions that are in the history
         for addr, hist in self.history.items():
             for tx_hash, tx_height in hist:
+                if tx_hash in verified_tx and tx_height not in unconfirmed:
+                    continue
                 # add it in case it was previously unconfirmed
                 self.add_unverified_tx(tx_hash, tx_height)
 
         # review transactions that are in the token history
         for key, token_hist in self.token_history.items():
             for txid, height, log_index in token_hist:
+                if txid in verified_tx and height not in unconfirmed:
+                    continue
                 self.add_unverified_tx(txid, height)
 
     def start_threads(self, network):
@@ -1276,17 +1643,20 @@ class Abstract_Wallet(PrintError):
         if self.network is not None:
             self.verifier = SPV(self.network, self)
             self.synchronizer = Synchronizer(self, network)
-            network.add_jobs([self.verifier, self.synchronizer])
+            self.writer = WalletWriter(self)
+            network.add_jobs([self.verifier, self.synchronizer, self.writer])
         else:
             self.verifier = None
             self.synchronizer = None
+            self.writer = None
 
     def stop_threads(self):
         if self.network:
-            self.network.remove_jobs([self.synchronizer, self.verifier])
+            self.network.remove_jobs([self.synchronizer, self.verifier, self.writer])
             self.synchronizer.release()
             self.synchronizer = None
             self.verifier = None
+            self.writer = None
             # Now no references to the syncronizer or verifier
             # remain so they will be GC-ed
             self.storage.put('stored_height', self.get_local_height())
@@ -1420,12 +1790,6 @@ class Abstract_Wallet(PrintError):
         if tx.is_complete():
             return False
         for k in self.get_keystores():
-            with open('./debug_info_step.txt','a') as f:
-                try:
-                    f.write('file_name:wallet.py,function_name:can_sign:' + '\n'+'step 0: call wallet.can_sign' + '\n')
-                except:
-                    f.write('file_name:wallet.py,function_name:can_sign:' + '\n'+'step 0 Fasle: call wallet.can_sign' + '\n')
-
             if k.can_sign(tx):
                 return True
         return False
@@ -1467,25 +1831,8 @@ class Abstract_Wallet(PrintError):
         if any([(isinstance(k, Hardware_KeyStore) and k.can_sign(tx)) for k in self.get_keystores()]):
             self.add_hw_info(tx)
         # sign. start with ready keystores.
-
-        with open('./debug_info_var.txt', 'a') as f:
-            try:
-                f.write('file_name:wallet.py,var_name:self.get_keystores()' + '\n' +str(self.get_keystores()) +'\n')
-                f.write('file_name:wallet.py,var_name:self.get_keystores()_has_sorted' + '\n' +str(sorted(self.get_keystores(), key=lambda ks: ks.ready_to_sign(), reverse=True)) +'\n')
-            except:
-                f.write('self.get_keystores():Get Failed')
-
         for k in sorted(self.get_keystores(), key=lambda ks: ks.ready_to_sign(), reverse=True):
-            with open('./debug_info_var.txt', 'a') as f:
-                try:#don't print ///
-                    f.write('file_name:wallet.py,var_name:self.get_keystores()_item' + '\n' +str(k) +'\n')
-                except:
-                    pass
-            with open('./debug_info_step.txt','a') as f:
-                try:
-                    f.write('file_name:wallet.py,function_name:sign_transaction:' + '\n'+'step 2: call wallet.sign_transaction' + '\n')
-                except:
-                    f.write('file_name:wallet.py,function_name:sign_transaction:' + '\n'+'step 2 Fasle: call wallet.sign_transaction' + '\n')
+            trace('wallet.sign_transaction', keystore=k.__class__.__name__)
             try:
                 if k.can_sign(tx):#bool(self.get_tx_derivations(tx))
                     #k 是类BIP32_KeyStore的一个实例
@@ -1686,6 +2033,8 @@ class Abstract_Wallet(PrintError):
     def add_address(self, address):
         if address not in self.history:
             self.history[address] = []
+            with self.transaction_lock:
+                self._note_unsaved('addr_history', [address])
         if self.synchronizer:
             self.synchronizer.add(address)
 
@@ -1786,6 +2135,9 @@ class Abstract_Wallet(PrintError):
             hist = self.token_history.pop(key)
             for txid, height, log_index in hist:
                 self.token_txs.pop(txid)
+            with self.token_lock:
+                self._note_unsaved('addr_token_history', [key])
+                self._note_unsaved('token_txs', [txid for txid, height, log_index in hist])
             save = True
         if save:
             self.save_transactions()
@@ -1793,20 +2145,22 @@ class Abstract_Wallet(PrintError):
     @profiler
     def load_token_txs(self):
         token_tx_list = self.storage.get('token_txs', {})
-        # token_hist_txids = reduce(lambda x, y: x+y, list([[y[0] for y in x] for x in self.token_history.values()]))
-        if self.token_history:
-            token_hist_txids = [x2[0] for x2 in reduce(lambda x1, y1: x1+y1, self.token_history.values())]
-        else:
-            token_hist_txids = []
+        token_hist_txids = set(txid for hist in self.token_history.values() for txid, height, log_index in hist)
         self.token_txs = {}
         for tx_hash, raw in token_tx_list.items():
             if tx_hash in token_hist_txids:
                 tx = Transaction(raw)
                 self.token_txs[tx_hash] = tx
+            else:
+                self._note_unsaved('token_txs', [tx_hash])
 
     def receive_token_history_callback(self, key, hist):
         with self.token_lock:
             self.token_history[key] = hist
+            self._note_unsaved('addr_token_history', [key])
+            index = self._token_index.get(key)
+            if index is not None:
+                index.set_history(hist, self.get_transfer_events)
 
     def receive_tx_receipt_callback(self, tx_hash, tx_receipt):
         self.add_tx_receipt(tx_hash, tx_receipt)
@@ -1825,11 +2179,17 @@ class Abstract_Wallet(PrintError):
                 return
         with self.token_lock:
             self.tx_receipt[tx_hash] = tx_receipt
+            self._note_unsaved('tx_receipt', [tx_hash])
+            self._transfer_events.pop(tx_hash, None)
+            events = self.get_transfer_events(tx_hash)
+            for index in self._token_index.values():
+                index.update_receipt(tx_hash, events)
 
     def add_token_transaction(self, tx_hash, tx):
         with self.token_lock:
             assert tx.is_complete(), 'incomplete tx'
             self.token_txs[tx_hash] = tx
+            self._note_unsaved('token_txs', [tx_hash])
             return True
 
     def delete_token(self, key):
@@ -1838,54 +2198,68 @@ class Abstract_Wallet(PrintError):
                 self.tokens.pop(key)
             if key in self.token_history:
                 self.token_history.pop(key)
+                self._note_unsaved('addr_token_history', [key])
+            self._token_index.pop(key, None)
 
-    def get_token_history(self, contract_addr=None, bind_addr=None, from_timestamp=None, to_timestamp=None):
+    def get_token_history(self, contract_addr=None, bind_addr=None, from_timestamp=None, to_timestamp=None,
+                          offset=0, limit=None):
+        """
+        List of (from, to, amount, token, txid, height, conf, timestamp,
+        call_index, log_index) of token transfers, newest first. Transfers
+        of unconfirmed transactions count as happening now in the
+        timestamp range; offset and limit apply after it. The sorted
+        transfers of the tokens are merged until the page is complete.
+        """
         with self.lock, self.token_lock:
-            h = []  # from, to, amount, token, txid, height, conf, timestamp, call_index, log_index
-            keys = []
-            for token_key in self.tokens.keys():
-                if contract_addr and contract_addr in token_key \
-                        or bind_addr and bind_addr in token_key \
+            streams = []
+            for key in self.tokens.keys():
+                if contract_addr and contract_addr in key \
+                        or bind_addr and bind_addr in key \
                         or not bind_addr and not contract_addr:
-                    keys.append(token_key)
-            for key in keys:
-                contract_addr, bind_addr = key.split('_')
-                for txid, height, log_index in self.token_history.get(key, []):
-                    height, conf, timestamp = self.get_tx_height(txid)
-                    for call_index, contract_call in enumerate(self.tx_receipt.get(txid, [])):
-                        logs = contract_call.get('log', [])
-                        if len(logs) > log_index:
-                            log = logs[log_index]
-
-                            # check contarct address
-                            if contract_addr != log.get('address', ''):
-                                print('contract address mismatch')
-                                continue
-
-                            # check topic name
-                            topics = log.get('topics', [])
-                            if len(topics) < 3:
-                                print('not enough topics')
-                                continue
-                            if topics[0] != TOKEN_TRANSFER_TOPIC:
-                                print('topic mismatch')
-                                continue
-
-                            # check user bind address
-                            _, hash160b = b58_address_to_hash160(bind_addr)
-                            hash160 = bh2u(hash160b).zfill(64)
-                            if hash160 not in topics:
-                                print('address mismatch')
-                                continue
-                            amount = int(log.get('data'), 16)
-                            from_addr = topics[1][-40:]
-                            to_addr = topics[2][-40:]
-                            h.append(
-                                (from_addr, to_addr, amount, self.tokens[key], txid,
-                                 height, conf, timestamp, call_index, log_index))
-                        else:
-                            continue
-            return sorted(h, key=itemgetter(5, 8, 9), reverse=True)
+                    token = self.tokens[key]
+                    streams.append(((item, token) for item in self.get_token_transfers(key).iter_newest_first()))
+            h = []
+            now = time.time()
+            skip = offset
+            for item, token in heapq.merge(*streams, key=itemgetter(0), reverse=True):
+                if limit is not None and len(h) >= limit:
+                    break
+                _, call_index, log_index, txid, from_addr, to_addr, amount = item
+                height, conf, timestamp = self.get_tx_height(txid)
+                if from_timestamp and (timestamp or now) < from_timestamp \
+                        or to_timestamp and (timestamp or now) >= to_timestamp:
+                    continue
+                if skip:
+                    skip -= 1
+                    continue
+                h.append((from_addr, to_addr, amount, token, txid,
+                          height, conf, timestamp, call_index, log_index))
+        return h
+
+    def get_token_transfers(self, key):
+        """ TokenTransfers of the token history of key. Callers hold
+        self.token_lock """
+        index = self._token_index.get(key)
+        if index is None:
+            index = self._token_index[key] = TokenTransfers(key)
+            index.set_history(self.token_history.get(key, []), self.get_transfer_events)
+        return index
+
+    def get_transfer_events(self, txid):
+        """ (call_index, log_index) -> (contract, from, to, amount, topics)
+        of the Transfer logs in the receipt of txid, decoded once """
+        events = self._transfer_events.get(txid)
+        if events is None:
+            events = {}
+            for call_index, contract_call in enumerate(self.tx_receipt.get(txid, [])):
+                for log_index, log in enumerate(contract_call.get('log', [])):
+                    topics = log.get('topics', [])
+                    if len(topics) < 3 or topics[0] != TOKEN_TRANSFER_TOPIC:
+                        continue
+                    events[(call_index, log_index)] = (log.get('address', ''), topics[1][-40:], topics[2][-40:],
+                                                       int(log.get('data'), 16), frozenset(topics))
+            self._transfer_events[txid] = events
+        return events
 
 
 class Simple_Wallet(Abstract_Wallet):
@@ -2003,6 +2377,10 @@ class Imported_Wallet(Simple_Wallet):#2018.07.08
                         transactions_new.add(tx_hash)
             transactions_to_remove -= transactions_new #?
             self.history.pop(address, None)
+            self._addr_index.pop(address, None)
+            with self.transaction_lock:
+                self._note_unsaved('addr_history', [address])
+                self._note_unsaved('tx_fees', transactions_to_remove)
 
             for tx_hash in transactions_to_remove:
                 self.remove_transaction(tx_hash)